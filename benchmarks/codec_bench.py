@@ -0,0 +1,52 @@
+"""
+Micro-benchmarks of the MQTT payload encodings: bytes on the wire per message and
+the cost of encoding (API) and decoding (bridge) each, for JSON and binary records
+with and without a trace envelope.
+
+Run from the repository root:
+
+    PYTHONPATH=. python benchmarks/codec_bench.py
+"""
+import json
+import time
+import timeit
+
+from src.core.codec import decode_record, encode_message
+from src.services.mqtt_service import decode_message
+
+TOPIC = "battery/rack-07/charge"
+TIME_NS = 1792326896000000000
+TRACE = {"id": "4f1c2b9a7d3e4c5f8a6b0e1d2c3f4a5b",
+         "stages": {"api_received": TIME_NS, "published": TIME_NS + 41000}}
+
+VARIANTS = [
+    ("int value", {"value": 42}),
+    ("float value + unit", {"value": 42.5, "unit": "kW"}),
+    ("float value + unit + trace", {"value": 42.5, "unit": "kW", "trace": TRACE}),
+]
+
+
+def encoder(fmt, variant):
+    return lambda: encode_message(fmt, "charge", variant["value"], TIME_NS, unit=variant.get("unit"),
+                                  battery_id="rack-07", trace=variant.get("trace"))
+
+
+def main(number=20000, repeat=5):
+    def best(fn):
+        return min(timeit.repeat(fn, number=number, repeat=repeat)) / number * 1e6
+
+    print(f"{'payload':<28} {'format':<7} {'bytes':>6} {'encode µs':>10} {'decode µs':>10} {'bridge µs':>10}")
+    for name, variant in VARIANTS:
+        for fmt in ("json", "binary"):
+            encode = encoder(fmt, variant)
+            payload = encode()
+            payload = payload.encode() if isinstance(payload, str) else payload
+            decode = (lambda: json.loads(payload)) if fmt == "json" else (lambda: decode_record(payload, "charge"))
+            # What the bridge does per message: topic mapping, decoding and the trace mark
+            bridge = (lambda: decode_message(TOPIC, payload, time.time_ns()))
+            print(f"{name:<28} {fmt:<7} {len(payload):>6} {best(encode):>10.2f} {best(decode):>10.2f} "
+                  f"{best(bridge):>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+"""
+Micro-benchmarks of the hot store: the cost a write adds for keeping its points, and the
+cost of answering the dashboard's /read of the last hour from memory.
+
+Run from the repository root:
+
+    PYTHONPATH=. python benchmarks/hot_store_bench.py [batteries]
+"""
+import sys
+import time
+import timeit
+
+from src.core.validation import ValidRecord
+from src.services.hot_store import HotStore
+
+NS = 1_000_000_000
+POINTS = 3600  # an hour at one value per second
+
+
+class NoData:
+    """Query API of an empty InfluxDB, to warm the store without a server."""
+
+    def query_stream(self, query):
+        return iter(())
+
+
+def main(batteries, number=20, repeat=3):
+    def best(fn, n=number):
+        return min(timeit.repeat(fn, number=n, repeat=repeat)) / n
+
+    store = HotStore(retention=3600, points=POINTS, slots=batteries, shared=False)
+    store.warm_from(NoData(), "bench")
+    now = time.time_ns() // NS * NS
+    records = [ValidRecord((("charge", float(i)), ("discharge", i % 7)), None, now - (POINTS - i) * NS, f"b{b}")
+               for i in range(POINTS) for b in range(batteries)]
+
+    started = time.perf_counter()
+    for record in records:
+        store.add([record])
+    add_us = (time.perf_counter() - started) / len(records) * 1e6
+    stats = store.stats()
+    print(f"{batteries} batteries x {POINTS} points: {stats['bytes'] / 2**20:.1f} MiB, {stats['points']} points")
+    print(f"add per record:        {add_us:8.2f} µs")
+    print(f"read 1 battery, 1h:    {best(lambda: store.read(now - 3600 * NS, now, 'b0')) * 1000:8.2f} ms")
+    print(f"read 1 battery, 1 min: {best(lambda: store.read(now - 60 * NS, now, 'b0')) * 1000:8.2f} ms")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 16)
@@ -0,0 +1,492 @@
+"""
+End-to-end load test of the ingest pipeline:
+
+    generator --MQTT--> broker --> bridge (mqtt_service) --HTTP--> API --> write pipeline --> InfluxDB
+    generator --HTTP--> API --> write pipeline --> InfluxDB
+
+Thousands of simulated batteries publish charge values at a fixed total rate. The
+bridge and the API run in this process against a local MQTT broker, and InfluxDB is
+replaced by a stand-in client that records the line protocol it receives. Every
+record carries its send time as timestamp, so the stand-in measures end-to-end
+latency when the point would have reached InfluxDB.
+
+Reported per transport: throughput, p50/p95/p99 latency, drops (sent but never
+written) with the reasons the stages counted, and CPU seconds per stage, sampled
+from /proc per thread (Linux). The generators run in their own processes; the bridge,
+the API (on werkzeug's threaded server) and the write pipeline share one interpreter,
+so absolute numbers are pessimistic. Compare runs of the same settings across versions:
+
+    PYTHONPATH=. python benchmarks/pipeline_bench.py --batteries 2000 --rate 5000 --duration 20 \\
+        --output before.json
+    PYTHONPATH=. python benchmarks/pipeline_bench.py --batteries 2000 --rate 5000 --duration 20 \\
+        --output after.json --compare before.json
+
+The MQTT transport needs a broker (``--broker``, default localhost:1883), e.g.
+``mosquitto -v``.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import subprocess
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from unittest import mock
+
+import numpy as np
+
+STAGES = ("generator", "bridge", "api", "writer", "influx")
+
+
+class FakeWriteApi:
+    """Stand-in for InfluxDB's synchronous WriteApi: records arrival latency of every line."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.lines = 0
+        self.requests = 0
+        self.latencies_ns = []
+        self.last_write = None  # monotonic time of the last request
+        self.cpu = 0.0
+        self._lock = threading.Lock()
+
+    def write(self, bucket, org, record, **kwargs):
+        started = time.thread_time()
+        if self.latency:
+            time.sleep(self.latency)
+        arrived = time.time_ns()
+        records = record if isinstance(record, (list, tuple)) else [record]
+        latencies = []
+        for item in records:
+            text = item if isinstance(item, str) else item.to_line_protocol()
+            for line in text.split("\n"):
+                if line:
+                    latencies.append(arrived - int(line.rsplit(" ", 1)[1]))
+        with self._lock:
+            self.requests += 1
+            self.lines += len(latencies)
+            self.latencies_ns.extend(latencies)
+            self.last_write = time.monotonic()
+            self.cpu += time.thread_time() - started
+
+    def close(self):
+        pass
+
+
+class FakeInfluxClient:
+    """Stand-in for InfluxDBClient handing out the shared FakeWriteApi."""
+
+    write_api_instance = None
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def write_api(self, *args, **kwargs):
+        return FakeInfluxClient.write_api_instance
+
+    def query_api(self):
+        return None
+
+    def close(self):
+        pass
+
+
+class CpuSampler:
+    """Samples per-thread CPU time from /proc and attributes it to pipeline stages by thread name."""
+
+    def __init__(self, interval=0.2):
+        self.interval = interval
+        self.threads = {}  # native id -> (stage, cpu seconds)
+        self._baseline = {}  # native id -> cpu seconds when sampling started
+        self._tick = os.sysconf("SC_CLK_TCK")
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="bench-cpu-sampler", daemon=True)
+
+    def start(self):
+        self.sample()
+        self._baseline = {tid: cpu for tid, (_, cpu) in self.threads.items()}
+        self._thread.start()
+
+    def stop(self):
+        self.sample()
+        self._stop.set()
+        self._thread.join()
+
+    def totals(self, measured, influx_cpu, process_cpu):
+        """
+        CPU seconds per stage. ``measured`` adds CPU the stages timed themselves: the
+        generator processes, and API request threads, which end before they could be
+        sampled. "other" is the rest of this process.
+        """
+        totals = dict.fromkeys(STAGES, 0.0)
+        totals.update(measured)
+        for tid, (stage, cpu) in self.threads.items():
+            if stage in totals:
+                totals[stage] += cpu - self._baseline.get(tid, 0.0)
+        # The stand-in runs on the writer thread; report it separately
+        totals["writer"] = max(0.0, totals["writer"] - influx_cpu)
+        totals["influx"] = influx_cpu
+        totals["other"] = max(0.0, process_cpu - sum(cpu for stage, cpu in totals.items() if stage != "generator"))
+        totals["process"] = process_cpu  # without the generator processes
+        return {stage: round(cpu, 3) for stage, cpu in totals.items()}
+
+    def sample(self):
+        for thread in threading.enumerate():
+            try:
+                with open(f"/proc/self/task/{thread.native_id}/stat") as stat:
+                    fields = stat.read().rsplit(")", 1)[1].split()
+            except (OSError, TypeError):
+                continue
+            cpu = (int(fields[11]) + int(fields[12])) / self._tick  # utime + stime
+            self.threads[thread.native_id] = (stage_of(thread.name), cpu)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+
+def stage_of(name):
+    """Stage of a thread, or None for threads that time themselves (API requests)."""
+    if "process_request_thread" in name:
+        return None
+    if name.startswith(("mqtt-bridge", "paho-mqtt-client-bench-bridge")):
+        return "bridge"
+    if name.startswith(("influx-", "bench-influx")):
+        return "writer"
+    if name.startswith(("bench-api", "paho-mqtt-client-battery-api")):
+        return "api"
+    return "other"
+
+
+def timestamp_of(ns):
+    """RFC 3339 timestamp with nanoseconds, as accepted by the API."""
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(ns // 1_000_000_000)) + f".{ns % 1_000_000_000:09d}Z"
+
+
+def paced(rate, duration, counters):
+    """
+    Yield the number of messages due every 10 ms to keep ``rate`` messages per second.
+    A generator more than 100 ms behind skips the excess (counted as "generator_behind")
+    instead of bursting, so an overloaded run shows up as missed load.
+    """
+    started = time.monotonic()
+    limit = max(1, int(rate * 0.1))
+    sent = 0
+    while True:
+        elapsed = time.monotonic() - started
+        if elapsed >= duration:
+            return
+        due = int(elapsed * rate) - sent
+        if due > limit:
+            counters.count("generator_behind", due - limit)
+            sent += due - limit
+            due = limit
+        if due > 0:
+            sent += due
+            yield due
+        time.sleep(0.01)
+
+
+def mqtt_generator(index, args, batteries, counters):
+    import paho.mqtt.client as mqtt
+    from src.core.codec import encode_record
+
+    host, port = args.broker.rsplit(":", 1)
+    client = mqtt.Client(callback_api_version=mqtt.CallbackAPIVersion.VERSION2, client_id=f"bench-gen-{index}")
+    client.max_queued_messages_set(0)
+    client.connect(host, int(port))
+    client.loop_start()
+    position = 0
+    for due in paced(args.rate / args.generators, args.duration, counters):
+        for _ in range(due):
+            battery_id = batteries[position % len(batteries)]
+            position += 1
+            if args.payload == "binary":
+                payload = encode_record(float(position % 100), time.time_ns(), "kW")
+            else:
+                payload = json.dumps({"charge": float(position % 100), "unit": "kW",
+                                      "timestamp": timestamp_of(time.time_ns())})
+            result = client.publish(f"battery/{battery_id}/charge", payload, qos=args.qos)
+            counters.count("sent" if result.rc == mqtt.MQTT_ERR_SUCCESS else "publish_failed")
+    client.loop_stop()
+    client.disconnect()
+
+
+def http_generator(index, args, batteries, counters):
+    import requests
+
+    session = requests.Session()
+    position = 0
+    pending = []
+    for due in paced(args.rate / args.generators, args.duration, counters):
+        for _ in range(due):
+            battery_id = batteries[position % len(batteries)]
+            position += 1
+            pending.append({"charge": float(position % 100), "unit": "kW", "battery_id": battery_id,
+                            "timestamp": timestamp_of(time.time_ns())})
+            if len(pending) < args.http_batch:
+                continue
+            if args.http_batch == 1:
+                response = session.post(f"{args.api_url}/writeCharge", json=pending[0])
+            else:
+                response = session.post(f"{args.api_url}/writeBatch", json=pending)
+            counters.count("sent" if response.status_code == 200 else f"http_{response.status_code}", len(pending))
+            pending = []
+    session.close()
+
+
+GENERATORS = {"mqtt": mqtt_generator, "http": http_generator}
+
+
+def generator_process(transport, index, args, batteries, results):
+    """Run one generator in its own process, so the load does not compete with the pipeline for the GIL."""
+    counters = Counters()
+    GENERATORS[transport](index, args, batteries, counters)
+    counters.values["cpu_generator"] = time.process_time()
+    results.put(counters.values)
+
+
+class CpuMiddleware:
+    """WSGI middleware adding up the thread CPU time the API spends in requests."""
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+        self.cpu = 0.0
+        self._lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        started = time.thread_time()
+        try:
+            return list(self.wsgi_app(environ, start_response))
+        finally:
+            with self._lock:
+                self.cpu += time.thread_time() - started
+
+
+class Counters:
+    def __init__(self):
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def count(self, key, n=1):
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + n
+
+
+def run_transport(transport, args, app, fake, api_cpu):
+    """Drive one transport for ``args.duration`` seconds and wait for the pipeline to drain."""
+    from src.services.mqtt_service import MessageDispatcher, connect_bridge
+    from src.services.sinks import create_sink
+
+    batteries = [f"bench-{i:05d}" for i in range(args.batteries)]
+    counters = Counters()
+    sampler = CpuSampler()
+    dispatcher = bridge = None
+    written_before = fake.lines
+    writer_before = _stats(app.write_api)
+    fake.latencies_ns = []
+    fake.cpu = 0.0
+
+    if transport == "mqtt":
+        dispatcher = MessageDispatcher(create_sink(args.bridge_sink))
+        dispatcher.start()
+        host, port = args.broker.rsplit(":", 1)
+        # A clean session, so messages left over from an earlier run are not replayed into this one
+        bridge = connect_bridge(dispatcher, client_id="bench-bridge", session_expiry=0, host=host, port=int(port))
+        bridge.loop_start()
+        time.sleep(1.0)  # let the subscription settle
+
+    sampler.start()
+    api_cpu_before = api_cpu.cpu
+    cpu_started = time.process_time()
+    started = time.monotonic()
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    generators = [
+        context.Process(target=generator_process, args=(transport, i, args, batteries, results), daemon=True)
+        for i in range(args.generators)
+    ]
+    for generator in generators:
+        generator.start()
+    for _ in generators:
+        for key, value in results.get().items():
+            counters.count(key, value)
+    for generator in generators:
+        generator.join()
+    sent_for = time.monotonic() - started
+
+    # Drain: wait until everything arrived or nothing new reached the stand-in for a while
+    sent = counters.values.get("sent", 0)
+    last, quiet_since = fake.lines, time.monotonic()
+    deadline = time.monotonic() + args.drain_timeout
+    while time.monotonic() < deadline and fake.lines - written_before < sent:
+        time.sleep(0.2)
+        if fake.lines != last:
+            last, quiet_since = fake.lines, time.monotonic()
+        elif time.monotonic() - quiet_since > args.quiet:
+            break
+    cpu_total = time.process_time() - cpu_started
+    sampler.stop()
+
+    stages = {"api_writer": _delta(_stats(app.write_api), writer_before)}
+    if dispatcher is not None:
+        bridge.loop_stop()
+        bridge.disconnect()
+        stages["bridge"] = dispatcher.stats()
+        dispatcher.stop()
+
+    written = fake.lines - written_before
+    elapsed = (fake.last_write or started) - started
+    latencies = np.array(fake.latencies_ns, dtype=np.float64) / 1e6
+    percentiles = np.percentile(latencies, [50, 95, 99]) if latencies.size else [None] * 3
+    measured = {"generator": counters.values.pop("cpu_generator", 0.0), "api": api_cpu.cpu - api_cpu_before}
+    return {
+        "sent": sent,
+        "written": written,
+        "dropped": max(0, sent - written),
+        "send_rate_msg_s": round(sent / sent_for, 1),
+        "throughput_msg_s": round(written / elapsed, 1) if elapsed > 0 else 0.0,
+        "latency_ms": {
+            "p50": _round(percentiles[0]),
+            "p95": _round(percentiles[1]),
+            "p99": _round(percentiles[2]),
+            "max": _round(latencies.max()) if latencies.size else None,
+        },
+        "generator_errors": {key: value for key, value in counters.values.items() if key != "sent"},
+        "stages": stages,
+        "influx_requests": fake.requests,
+        "cpu_s": sampler.totals(measured, fake.cpu, cpu_total),
+    }
+
+
+def run(args):
+    # Configuration is read when src.core.config is imported, so the environment is set first
+    host, port = args.broker.rsplit(":", 1)
+    os.environ.update({
+        "LIVE_STATE_BACKEND": "memory",
+        "ROLLUPS_ENABLED": "false",
+        "INFLUXDB_WRITE_MODE": args.write_mode,
+        "INFLUXDB_SPOOL_DIR": args.spool_dir or tempfile.mkdtemp(prefix="bench-spool-"),
+        "MQTT_BROKER_HOST": host,
+        "MQTT_BROKER_PORT": port,
+    })
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    fake = FakeWriteApi(latency=args.influx_latency_ms / 1000.0)
+    FakeInfluxClient.write_api_instance = fake
+    with mock.patch("src.services.influx_service.InfluxDBClient", FakeInfluxClient), \
+            mock.patch("src.services.sinks.InfluxDBClient", FakeInfluxClient):
+        from src.api import create_app
+
+        app = create_app()
+        api_cpu = CpuMiddleware(app.wsgi_app)
+        app.wsgi_app = api_cpu
+        server = make_server("127.0.0.1", 0, app, threaded=True, request_handler=QuietHandler)
+        threading.Thread(target=server.serve_forever, name="bench-api-server", daemon=True).start()
+        args.api_url = f"http://127.0.0.1:{server.server_port}"
+
+        results = {}
+        transports = ("mqtt", "http") if args.transport == "both" else (args.transport,)
+        for transport in transports:
+            print(f"🚀 {transport}: {args.batteries} batteries, {args.rate} msg/s for {args.duration}s")
+            with mock.patch("src.core.config.Config.WRITE_BATCH_ENDPOINT", f"{args.api_url}/writeBatch"):
+                results[transport] = run_transport(transport, args, app, fake, api_cpu)
+            print_result(transport, results[transport])
+
+        server.shutdown()
+        app.shutdown()
+
+    config = {key: value for key, value in vars(args).items() if key not in ("output", "compare", "api_url")}
+    return {
+        "version": git_version(),
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "config": config,
+        "results": results,
+    }
+
+
+def print_result(transport, result):
+    latency = result["latency_ms"]
+    print(f"   sent {result['sent']}, written {result['written']}, dropped {result['dropped']}, "
+          f"{result['throughput_msg_s']} msg/s")
+    print(f"   latency ms p50 {latency['p50']}, p95 {latency['p95']}, p99 {latency['p99']}, max {latency['max']}")
+    print(f"   cpu s {result['cpu_s']}")
+    if result["generator_errors"]:
+        print(f"   generator errors {result['generator_errors']}")
+
+
+def compare(current, baseline):
+    """Print throughput, latency and CPU changes against a previous result file."""
+    print(f"📊 Compared with {baseline.get('version')} ({baseline.get('started_at')})")
+    for transport, result in current["results"].items():
+        before = baseline.get("results", {}).get(transport)
+        if before is None:
+            continue
+        rows = [("throughput_msg_s", result["throughput_msg_s"], before["throughput_msg_s"]),
+                ("dropped", result["dropped"], before["dropped"]),
+                ("cpu_s.process", result["cpu_s"]["process"], before["cpu_s"]["process"])]
+        rows += [(f"latency_ms.{p}", result["latency_ms"][p], before["latency_ms"][p]) for p in ("p50", "p95", "p99")]
+        for name, now, then in rows:
+            change = f"{(now - then) / then * 100:+.1f}%" if now is not None and then else "n/a"
+            print(f"   {transport:<5} {name:<18} {then!s:>10} -> {now!s:>10} ({change})")
+
+
+def git_version():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True,
+                              check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _stats(write_api):
+    return write_api.stats() if hasattr(write_api, "stats") else {}
+
+
+def _delta(after, before):
+    """Counter changes during a run; gauges such as "buffered" are kept as they are."""
+    return {key: value - before.get(key, 0) if key not in ("buffered",) else value for key, value in after.items()}
+
+
+def _round(value):
+    return None if value is None else round(float(value), 2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--transport", choices=("mqtt", "http", "both"), default="both")
+    parser.add_argument("--batteries", type=int, default=1000, help="simulated batteries")
+    parser.add_argument("--rate", type=float, default=2000, help="messages per second, all batteries together")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of load per transport")
+    parser.add_argument("--generators", type=int, default=4, help="generator processes (and MQTT clients)")
+    parser.add_argument("--qos", type=int, choices=(0, 1), default=0, help="MQTT publish QoS")
+    parser.add_argument("--payload", choices=("json", "binary"), default="json", help="MQTT payload encoding")
+    parser.add_argument("--http-batch", type=int, default=1, help="records per HTTP request (>1 uses /writeBatch)")
+    parser.add_argument("--broker", default="localhost:1883", help="MQTT broker host:port")
+    parser.add_argument("--bridge-sink", choices=("http", "influx"), default="http")
+    parser.add_argument("--write-mode", choices=("batch", "spool", "sync"), default="batch")
+    parser.add_argument("--spool-dir", help="spool directory for --write-mode spool (default: a temp dir)")
+    parser.add_argument("--influx-latency-ms", type=float, default=0, help="simulated InfluxDB request latency")
+    parser.add_argument("--drain-timeout", type=float, default=30, help="max seconds to wait for the pipeline to drain")
+    parser.add_argument("--quiet", type=float, default=3, help="stop draining after this many seconds without writes")
+    parser.add_argument("--output", default="pipeline_results.json", help="JSON result file")
+    parser.add_argument("--compare", help="previous JSON result file to compare with")
+    args = parser.parse_args()
+
+    result = run(args)
+    with open(args.output, "w") as f:
+        json.dump(result, f, indent=2)
+    print(f"✅ Results saved to {args.output}")
+    if args.compare:
+        with open(args.compare) as f:
+            compare(result, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Micro-benchmarks of the /read wire formats: body size per format and content coding,
+server-side serialization cost, and the client's cost of turning the body into the
+dashboard's ring-buffer columns.
+
+Run from the repository root:
+
+    PYTHONPATH=. python benchmarks/read_format_bench.py [rows]
+"""
+import gzip
+import json
+import sys
+import timeit
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import pyarrow as pa
+
+from src.core.read_formats import compress, serialize, zstandard
+from src.dashboard.ring_buffer import COLUMNS, RingBuffer
+
+
+def make_rows(n):
+    """An hour of raw rows alternating between charge and discharge, like /read returns them."""
+    start = datetime(2026, 10, 18, 12, tzinfo=timezone.utc)
+    rows = []
+    for i in range(n):
+        value = round(50 + 10 * np.sin(i / 50), 3)
+        rows.append({
+            "time": (start + timedelta(milliseconds=i * 3600000 // n)).isoformat(),
+            "charge": value if i % 2 == 0 else None,
+            "discharge": value if i % 2 else None,
+        })
+    return rows
+
+
+def parse_json(body):
+    buffer = RingBuffer(len(ROWS))
+    buffer.append(json.loads(body))
+    return buffer
+
+
+def parse_columns(body):
+    data = json.loads(body)
+    buffer = RingBuffer(len(ROWS))
+    times = np.array(data["time"], dtype=np.int64) * 1_000_000
+    buffer.append_columns(times, {c: np.array(data[c], dtype=float) for c in COLUMNS})
+    return buffer
+
+
+def parse_arrow(body):
+    # The dashboard's read_arrow
+    table = pa.ipc.open_stream(body).read_all().combine_chunks()
+    buffer = RingBuffer(len(ROWS))
+    buffer.append_columns(table.column("time").chunk(0).view(pa.int64()).to_numpy(),
+                          {c: table.column(c).chunk(0).to_numpy() for c in COLUMNS})
+    return buffer
+
+
+ROWS = make_rows(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
+PARSERS = {"json": parse_json, "columns": parse_columns, "arrow": parse_arrow}
+DECOMPRESS = {None: lambda body: body, "gzip": gzip.decompress}
+if zstandard is not None:
+    DECOMPRESS["zstd"] = lambda body: zstandard.ZstdDecompressor().decompress(body)
+
+
+def main(number=5, repeat=3):
+    def best(fn):
+        return min(timeit.repeat(fn, number=number, repeat=repeat)) / number * 1000
+
+    print(f"{len(ROWS)} rows")
+    print(f"{'format':<8} {'encoding':<9} {'bytes':>10} {'serialize ms':>13} {'client parse ms':>16}")
+    for fmt, parse in PARSERS.items():
+        body = serialize(ROWS, fmt, json.dumps)
+        raw = body.encode() if isinstance(body, str) else body
+        serialize_ms = best(lambda: serialize(ROWS, fmt, json.dumps))
+        for encoding, decompress in DECOMPRESS.items():
+            wire = raw if encoding is None else compress(raw, encoding)
+            parse_ms = best(lambda: parse(decompress(wire)))
+            print(f"{fmt:<8} {encoding or 'identity':<9} {len(wire):>10} {serialize_ms:>13.1f} {parse_ms:>16.1f}")
+
+
+if __name__ == "__main__":
+    main()
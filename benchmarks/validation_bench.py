@@ -0,0 +1,57 @@
+"""
+Micro-benchmarks of the per-record ingest cost: timestamp parsing, payload validation
+and point construction, compared with the dateutil-based path they replaced.
+
+Run from the repository root:
+
+    PYTHONPATH=. python benchmarks/validation_bench.py
+"""
+import timeit
+from datetime import datetime
+
+from dateutil.parser import parse
+from influxdb_client import Point
+
+from src.core.validation import CHARGE_SCHEMA, parse_timestamp_ns
+from src.services.influx_service import record_point
+
+TIMESTAMP = "2026-10-18T12:34:56.789Z"
+PAYLOAD = {"charge": 42.5, "unit": "kW", "timestamp": TIMESTAMP, "battery_id": "rack-07"}
+
+
+def legacy_record(data):
+    """The previous /writeCharge path: dateutil parse, dict copy, Point with an ISO timestamp."""
+    if "charge" not in data:
+        raise KeyError("charge")
+    timestamp = parse(data["timestamp"]).isoformat() if "timestamp" in data else datetime.utcnow().isoformat()
+    data = {**data, "timestamp": timestamp}
+    return (
+        Point("battery_data")
+        .tag("battery_id", data.get("battery_id", "default"))
+        .field("charge", data["charge"])
+        .time(data["timestamp"])
+    ).to_line_protocol()
+
+
+def current_record(data):
+    return record_point(CHARGE_SCHEMA.validate(data)).to_line_protocol()
+
+
+CASES = [
+    ("timestamp: dateutil.parse", lambda: parse(TIMESTAMP)),
+    ("timestamp: parse_timestamp_ns", lambda: parse_timestamp_ns(TIMESTAMP)),
+    ("validate: CHARGE_SCHEMA", lambda: CHARGE_SCHEMA.validate(PAYLOAD)),
+    ("record -> line protocol (legacy)", lambda: legacy_record(PAYLOAD)),
+    ("record -> line protocol (current)", lambda: current_record(PAYLOAD)),
+]
+
+
+def main(number=20000, repeat=5):
+    print(f"{'case':<36} {'µs/record':>10}")
+    for name, fn in CASES:
+        best = min(timeit.repeat(fn, number=number, repeat=repeat)) / number
+        print(f"{name:<36} {best * 1e6:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,25 @@
+import atexit
+
 from src.core.config import Config
 from src.core.flask_wrapper import FlaskWrapper
 
 
-def create_app():
+def create_app(start_clients=True):
+    """
+    Create the API app.
+
+    Args:
+        start_clients: Connect to InfluxDB and MQTT right away. The production server
+            creates the app without clients and starts them in each worker after fork
+            (see src/api/gunicorn_conf.py).
+    """
     app = FlaskWrapper(__name__)
     app.config.from_object(Config)
 
-    # Initialize InfluxDB client
-    from src.services.influx_service import setup_influxdb
-    setup_influxdb(app)
+    # Initialize InfluxDB and MQTT clients
+    if start_clients:
+        app.start_clients()
+    atexit.register(app.shutdown)
 
     # Import routes *after* setting up the app to avoid circular imports
     from src.api.routes import api_blueprint
@@ -0,0 +1,184 @@
+import threading
+import time
+
+from src.api.mqtt_publisher import mqtt_publish
+from src.core.codec import CONTENT_TYPES, encode_message
+from src.core.config import Config
+from src.core.log import get_logger
+from src.core.metrics import REGISTRY
+from src.core.tracing import mark
+
+log = get_logger(__name__)
+
+_SUPERSEDED = REGISTRY.counter(
+    "mqtt_commands_superseded_total", "Commands replaced by a newer one for the same topic before publishing",
+    ("field",))
+_PENDING = REGISTRY.gauge("mqtt_commands_pending", "Commands waiting for the next conflation tick")
+_RATE_LIMITED = REGISTRY.counter(
+    "api_commands_rate_limited_total", "Commands rejected with 429 by the per-battery rate limit", ("field",))
+
+
+class Command:
+    """A /charge or /discharge setpoint, encoded only when it is published."""
+
+    __slots__ = ("field", "value", "time_ns", "unit", "battery_id", "trace")
+
+    def __init__(self, field, value, time_ns, unit=None, battery_id=None, trace=None):
+        self.field = field
+        self.value = value
+        self.time_ns = time_ns
+        self.unit = unit
+        self.battery_id = battery_id
+        self.trace = trace
+
+
+class CommandConflator:
+    """
+    Publishes only the newest command per topic.
+
+    Commands are held until the next tick (every ``interval`` seconds); a command for a
+    topic that already has one pending replaces it, since only the latest setpoint of a
+    battery matters. A controller sending hundreds of setpoints per second therefore
+    produces at most one message per topic and tick. With an interval of 0 every command
+    is published right away.
+
+    Commands are refused while ``max_pending`` topics are waiting or the publisher's
+    outbound queue for the topic is full. A pending command the publisher drops at the
+    tick is kept for the next one unless a newer command for its topic arrived.
+    """
+
+    def __init__(self, publisher, interval=None, payload_format=None, max_pending=None):
+        self.publisher = publisher
+        self.interval = Config.COMMAND_CONFLATION_INTERVAL_MS / 1000.0 if interval is None else interval
+        self.payload_format = payload_format or Config.MQTT_PAYLOAD_FORMAT
+        self.max_pending = max_pending or Config.COMMAND_MAX_PENDING
+        self._pending = {}  # topic -> newest Command
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        _PENDING.set_function(lambda: len(self._pending))
+
+    def start(self):
+        if self.interval > 0 and self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="command-conflator", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stop ticking and publish the commands still pending."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+        with self._lock:
+            dropped, self._pending = len(self._pending), {}
+        if dropped:
+            log.error(f"❌ Dropping {dropped} commands the MQTT publisher did not accept before shutdown")
+
+    def submit(self, topic, command):
+        """
+        Queue a command for the next tick, replacing a pending one for the same topic.
+
+        Returns:
+            True if the command was queued (or published), False if it was refused
+            because ``max_pending`` topics are waiting or the publisher's outbound
+            queue is full.
+        """
+        if self._thread is None:
+            return self._publish(topic, command)
+        if self.publisher.saturated(topic):
+            return False
+        with self._lock:
+            superseded = self._pending.get(topic)
+            if superseded is None and len(self._pending) >= self.max_pending:
+                return False
+            self._pending[topic] = command
+        if superseded is not None:
+            _SUPERSEDED.labels(superseded.field).inc()
+        return True
+
+    def flush(self):
+        """
+        Publish all pending commands now. Commands the publisher drops are pending again
+        for the next tick, unless a newer one for the same topic has arrived meanwhile.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        failed = [(topic, command) for topic, command in pending.items() if not self._publish(topic, command)]
+        if not failed:
+            return
+        with self._lock:
+            for topic, command in failed:
+                self._pending.setdefault(topic, command)
+        log.warning(f"⚠️ MQTT publisher dropped {len(failed)} conflated commands, retrying them next tick")
+
+    def _publish(self, topic, command):
+        if command.trace is not None:
+            mark(command.trace, "published")
+        payload = encode_message(self.payload_format, command.field, command.value, command.time_ns,
+                                 unit=command.unit, battery_id=command.battery_id, trace=command.trace)
+        return mqtt_publish(topic=topic, command=payload, publisher=self.publisher,
+                            content_type=CONTENT_TYPES[self.payload_format])
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.flush()
+            except Exception as e:
+                log.error(f"❌ Could not publish conflated commands: {e}")
+
+
+class _TokenBucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, tokens, updated):
+        self.tokens = tokens
+        self.updated = updated
+
+
+class CommandRateLimiter:
+    """
+    Token bucket per battery: ``rate`` commands per second on average, with bursts of
+    up to ``burst``. Limits are per process, so a server with several workers admits up
+    to that many times the rate.
+    """
+
+    def __init__(self, rate=None, burst=None, max_batteries=10000):
+        self.rate = Config.COMMAND_RATE_LIMIT if rate is None else rate
+        self.burst = max(1.0, Config.COMMAND_RATE_BURST if burst is None else burst)
+        self.max_batteries = max_batteries
+        self._buckets = {}  # battery id -> _TokenBucket
+        self._lock = threading.Lock()
+
+    def acquire(self, battery_id, field=None):
+        """
+        Take a token for a command to ``battery_id``.
+
+        Returns:
+            0 if the command may proceed, otherwise the seconds until a token is available.
+        """
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(battery_id)
+            if bucket is None:
+                if len(self._buckets) >= self.max_batteries:
+                    self._prune(now)
+                bucket = self._buckets[battery_id] = _TokenBucket(self.burst, now)
+            else:
+                bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated) * self.rate)
+                bucket.updated = now
+            if bucket.tokens >= 1.0:
+                bucket.tokens -= 1.0
+                return 0.0
+            wait = (1.0 - bucket.tokens) / self.rate
+        _RATE_LIMITED.labels(field or "command").inc()
+        return wait
+
+    def _prune(self, now):
+        """Forget the buckets that have refilled completely; they behave like new ones."""
+        refill = self.burst / self.rate
+        for battery_id, bucket in list(self._buckets.items()):
+            if now - bucket.updated >= refill:
+                del self._buckets[battery_id]
@@ -0,0 +1,67 @@
+"""
+Gunicorn settings and worker lifecycle hooks for the API.
+
+The app is imported once in the master (``preload_app``) and forked into
+``API_WORKERS`` processes serving ``API_THREADS`` requests each. Every worker
+creates its own InfluxDB and MQTT clients after the fork. On SIGTERM gunicorn
+stops accepting connections, lets workers finish their requests for up to
+``API_GRACEFUL_TIMEOUT`` seconds and then runs ``worker_exit``, which flushes
+buffered writes before the process ends.
+
+Metrics use ``prometheus_client``'s multiprocess mode with their files in
+``METRICS_DIR``. It must be chosen before the library is imported, which is why this
+file sets it up before the app is preloaded.
+"""
+import os
+
+from src.core.config import Config
+
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", Config.METRICS_DIR)
+
+from src.core.log import get_logger  # noqa: E402
+from src.core.metrics import REGISTRY, clear_directory, mark_process_dead  # noqa: E402
+
+# The metrics of the previous run; cleared before the preloaded app creates its files
+clear_directory(os.environ["PROMETHEUS_MULTIPROC_DIR"])
+
+log = get_logger("src.api.gunicorn")
+
+bind = Config.API_BIND
+workers = Config.API_WORKERS
+threads = Config.API_THREADS
+worker_class = "gthread"
+timeout = Config.API_TIMEOUT
+graceful_timeout = Config.API_GRACEFUL_TIMEOUT
+preload_app = True
+
+
+def on_starting(server):
+    """
+    Create the rollup tasks once, before any worker looks them up, and remove the hot
+    store of the previous run; the first worker warms a new one.
+    """
+    from src.services.hot_store import discard_hot_store
+    from src.services.influx_service import prepare_rollups
+
+    discard_hot_store()
+    prepare_rollups()
+
+
+def post_worker_init(worker):
+    """
+    Start this worker's clients (``worker.wsgi`` is the Flask app) and keep its callback
+    gauges current in the shared metric files, so /metrics on any worker reports them.
+    """
+    worker.wsgi.start_clients(create_rollups=False)
+    REGISTRY.start_refreshing()
+    log.info(f"✅ Worker {worker.pid} ready")
+
+
+def worker_exit(server, worker):
+    """Flush buffered writes and disconnect when the worker stops."""
+    worker.wsgi.shutdown()
+
+
+def child_exit(server, worker):
+    """Drop the gauges of a worker that exited; its counters stay in the totals."""
+    mark_process_dead(worker.pid)
@@ -1,20 +1,238 @@
+import os
+import threading
+import time
+import zlib
+from collections import deque
+
 import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
 from src.core.config import Config
+from src.core.log import get_logger
+from src.core.metrics import REGISTRY
+
+log = get_logger(__name__)
+
+_PUBLISH_SECONDS = REGISTRY.histogram(
+    "mqtt_publish_duration_seconds", "Time to hand a message to the MQTT publisher connection")
+_ACK_SECONDS = REGISTRY.histogram(
+    "mqtt_publish_ack_seconds", "Time from handing a QoS 1/2 message to paho until the broker acknowledged it")
+_MESSAGES_OUT = REGISTRY.counter(
+    "mqtt_messages_out_total", "Messages handled by the MQTT publisher, by result", ("result",))
+_BUFFERED = REGISTRY.gauge(
+    "mqtt_outbound_buffered", "Messages buffered while the MQTT publisher is disconnected")
 
 
-def mqtt_publish(topic, command):
+class _PublisherConnection:
     """
-    Publishes a message to the MQTT broker.
-    This function creates a new connection per message to ensure that Flask does not
-    maintain a persistent MQTT connection.
+    A single persistent connection to the MQTT broker.
+
+    The paho network loop runs in a background thread and reconnects on its own.
+    While the connection is down, QoS 0 messages are kept in a bounded in-memory
+    queue and flushed in order as soon as the broker accepts the connection again.
+    QoS 1/2 messages are retained and re-sent by paho itself.
     """
-    try:
-        client = mqtt.Client()
-        client.connect(Config.MQTT_BROKER, Config.MQTT_PORT)
-        client.publish(topic, command)
-        client.disconnect()  # Close connection after publishing
-        print(f"✅ Published to {topic}: {command}")
-    except Exception as e:
-        print(f"❌ Failed to publish MQTT message: {e}")
 
+    def __init__(self, publisher, client_id):
+        self.publisher = publisher
+        self.client_id = client_id
+        self.connected = False
+        self.outbound = deque()
+        self.lock = threading.Lock()
+        # Acks are tracked under their own lock: paho invokes on_publish while holding its
+        # internal message mutex, which ``client.publish`` also needs.
+        self.ack_lock = threading.Lock()
+        self.pending = {}  # mid -> monotonic time the message was handed to paho
+        self.early_acks = set()
+
+        self.client = mqtt.Client(callback_api_version=mqtt.CallbackAPIVersion.VERSION2, client_id=client_id,
+                                  protocol=mqtt.MQTTv5 if publisher.v5 else mqtt.MQTTv311)
+        self.client.max_queued_messages_set(publisher.queue_size)
+        self.client.reconnect_delay_set(min_delay=publisher.reconnect_min_delay,
+                                        max_delay=publisher.reconnect_max_delay)
+        self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
+        self.client.on_publish = self._on_publish
+
+    def start(self):
+        self.client.connect_async(self.publisher.broker, self.publisher.port, self.publisher.keepalive)
+        self.client.loop_start()
+
+    def stop(self, timeout):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if not self.outbound and not self.pending:
+                break
+            time.sleep(0.01)
+        self.client.disconnect()
+        self.client.loop_stop()
+
+    def publish(self, topic, payload, qos, properties=None):
+        with self.lock:
+            if self.connected and not self.outbound:
+                if self._send(topic, payload, qos, properties):
+                    return True
+            return self._enqueue(topic, payload, qos, properties)
+
+    def _send(self, topic, payload, qos, properties=None):
+        """Hand a message to paho. Must be called with ``self.lock`` held."""
+        info = self.client.publish(topic, payload, qos=qos, properties=properties)
+        if info.rc == mqtt.MQTT_ERR_SUCCESS or (info.rc == mqtt.MQTT_ERR_NO_CONN and qos > 0):
+            # QoS > 0 messages stay in paho's session state and are re-sent on reconnect
+            with self.ack_lock:
+                if info.mid in self.early_acks:
+                    self.early_acks.discard(info.mid)
+                    self.publisher._record_ack(0.0)
+                else:
+                    self.pending[info.mid] = time.monotonic()
+            self.publisher._count("published")
+            return True
+        if info.rc == mqtt.MQTT_ERR_NO_CONN:
+            self.connected = False
+        return False
+
+    def _enqueue(self, topic, payload, qos, properties):
+        """Buffer a message until the connection is back. Must be called with ``self.lock`` held."""
+        if len(self.outbound) >= self.publisher.queue_size:
+            self.publisher._count("dropped")
+            return False
+        self.outbound.append((topic, payload, qos, properties))
+        self.publisher._count("queued")
+        return True
+
+    def _on_connect(self, client, userdata, flags, reason_code, properties):
+        if reason_code.is_failure:
+            log.error(f"❌ MQTT publisher {self.client_id} failed to connect: {reason_code}")
+            return
+
+        log.info(f"✅ MQTT publisher {self.client_id} connected to {self.publisher.broker}:{self.publisher.port}")
+        with self.lock:
+            self.connected = True
+            while self.outbound:
+                topic, payload, qos, properties = self.outbound[0]
+                if not self._send(topic, payload, qos, properties):
+                    break
+                self.outbound.popleft()
+
+    def _on_disconnect(self, client, userdata, disconnect_flags, reason_code, properties):
+        self.connected = False
+        if reason_code != 0:
+            log.warning(f"❌ MQTT publisher {self.client_id} lost connection ({reason_code}), reconnecting...")
+
+    def _on_publish(self, client, userdata, mid, reason_code, properties):
+        with self.ack_lock:
+            sent_at = self.pending.pop(mid, None)
+            if sent_at is None:
+                # Acknowledged before ``_send`` got to record the mid
+                self.early_acks.add(mid)
+                return
+        self.publisher._record_ack(time.monotonic() - sent_at)
+
+
+class MqttPublisher:
+    """
+    Long-lived MQTT publisher backed by a small pool of persistent connections.
+
+    Messages are routed to a connection by topic, so the publish order per topic is
+    preserved even when the pool holds several connections for multi-threaded servers.
+    ``publish`` never waits for the network: it either hands the message to paho or
+    buffers it while a connection is re-established. Over MQTT v5 every message carries
+    the content type of its payload encoding.
+    """
+
+    def __init__(self, broker=None, port=None, qos=None, pool_size=None, queue_size=None, keepalive=None,
+                 reconnect_min_delay=None, reconnect_max_delay=None, client_id_prefix="battery-api", protocol=None):
+        self.broker = broker or Config.MQTT_BROKER
+        self.port = port or Config.MQTT_PORT
+        self.qos = Config.MQTT_PUBLISH_QOS if qos is None else qos
+        self.queue_size = queue_size or Config.MQTT_OUTBOUND_QUEUE_SIZE
+        self.keepalive = keepalive or Config.MQTT_KEEPALIVE
+        self.reconnect_min_delay = reconnect_min_delay or Config.MQTT_RECONNECT_MIN_DELAY
+        self.reconnect_max_delay = reconnect_max_delay or Config.MQTT_RECONNECT_MAX_DELAY
+        self.v5 = (protocol or Config.MQTT_PUBLISHER_PROTOCOL) == "5"
+        self._properties = {}  # content type -> PUBLISH properties, shared by all messages
+
+        self._stats_lock = threading.Lock()
+        self._stats = {"published": 0, "queued": 0, "dropped": 0, "acked": 0, "ack_latency_ms_total": 0.0}
+
+        size = max(1, pool_size or Config.MQTT_PUBLISHER_POOL_SIZE)
+        self.connections = [
+            _PublisherConnection(self, f"{client_id_prefix}-{os.getpid()}-{i}")
+            for i in range(size)
+        ]
+        _BUFFERED.set_function(lambda: sum(len(c.outbound) for c in self.connections))
+
+    def start(self):
+        log.info(f"✅ Connecting MQTT publisher pool ({len(self.connections)}) to {self.broker}:{self.port}...")
+        for connection in self.connections:
+            connection.start()
+
+    def stop(self, timeout=5.0):
+        """Flush buffered messages and outstanding acks (bounded by ``timeout``), then disconnect."""
+        for connection in self.connections:
+            connection.stop(timeout)
+
+    def publish(self, topic, payload, qos=None, content_type=None):
+        """
+        Enqueue a message for publishing.
+
+        Args:
+            content_type: MQTT v5 content type of the payload (ignored over MQTT 3.1.1).
+
+        Returns:
+            True if the message was handed to the broker connection or buffered,
+            False if it was dropped because the outbound queue is full.
+        """
+        connection = self.connections[zlib.crc32(topic.encode()) % len(self.connections)]
+        properties = self._content_type_properties(content_type) if content_type and self.v5 else None
+        with _PUBLISH_SECONDS.time():
+            return connection.publish(topic, payload, self.qos if qos is None else qos, properties)
+
+    def saturated(self, topic):
+        """Whether the outbound queue of the topic's connection is full, so ``publish`` would drop."""
+        connection = self.connections[zlib.crc32(topic.encode()) % len(self.connections)]
+        return len(connection.outbound) >= self.queue_size
 
+    def stats(self):
+        """Counters for published, buffered, dropped and acknowledged messages."""
+        with self._stats_lock:
+            stats = dict(self._stats)
+        acked = stats.pop("ack_latency_ms_total")
+        stats["avg_ack_latency_ms"] = acked / stats["acked"] if stats["acked"] else None
+        stats["awaiting_ack"] = sum(len(c.pending) for c in self.connections)
+        stats["buffered"] = sum(len(c.outbound) for c in self.connections)
+        stats["connected"] = sum(1 for c in self.connections if c.connected)
+        return stats
+
+    def _content_type_properties(self, content_type):
+        properties = self._properties.get(content_type)
+        if properties is None:
+            properties = Properties(PacketTypes.PUBLISH)
+            properties.ContentType = content_type
+            self._properties[content_type] = properties
+        return properties
+
+    def _count(self, key):
+        with self._stats_lock:
+            self._stats[key] += 1
+        _MESSAGES_OUT.labels(key).inc()
+
+    def _record_ack(self, latency):
+        _ACK_SECONDS.observe(latency)
+        with self._stats_lock:
+            self._stats["acked"] += 1
+            self._stats["ack_latency_ms_total"] += latency * 1000.0
+
+
+def mqtt_publish(topic, command, publisher, qos=None, content_type=None):
+    """
+    Publishes a message to the MQTT broker through the app's persistent publisher.
+
+    Returns:
+        True if the message was accepted for delivery, False if it was dropped.
+    """
+    try:
+        return publisher.publish(topic, command, qos=qos, content_type=content_type)
+    except Exception as e:
+        log.error(f"❌ Failed to publish MQTT message: {e}")
+        return False
@@ -1,72 +1,168 @@
+import itertools
+import math
 import json
-from datetime import datetime
-from dateutil.parser import parse
-from flask import Blueprint, request, jsonify, current_app
+from flask import Blueprint, Response, request, jsonify, current_app, stream_with_context
 from flask_restx import Api, Resource, fields
 
-from src.api.mqtt_publisher import mqtt_publish
+from src.api.conflation import Command
+from src.core.battery import battery_topic, validate_battery_id
 from src.core.config import Config
-from src.services.influx_service import read_battery_data, influx_write_charge, influx_write_discharge
+from src.core.log import get_logger
+from src.core.metrics import CONTENT_TYPE, REGISTRY
+from src.core.read_formats import FORMATS, negotiate_encoding, negotiate_format, serialize
+from src.core.tracing import get_trace, mark, start_trace
+from src.core.validation import (BATTERY_RECORD_SCHEMA, CHARGE_SCHEMA, DISCHARGE_SCHEMA, ValidRecord, now_ns,
+                                 ns_to_datetime, parse_line_protocol)
+from src.services.influx_service import (
+    read_battery_data, stream_battery_data, resolve_read_range, read_battery_stats, read_slowest_traces,
+    influx_write_charge, influx_write_discharge, record_point, write_point, write_traces
+)
+from src.services.hot_store import read_recent
+from src.services.influx_writer import WriteBufferFull
+
+log = get_logger(__name__)
 
 api_blueprint = Blueprint("api", __name__)
 api = Api(api_blueprint, title="Battery API", version="1.0", description="API for battery data management")
 
-# Global variable to store the latest value
-latest_charge = {"charge": None, "discharge": None, "unit": "kW", "timestamp": None}
-
 # Swagger Models
 charge_model = api.model("Charging", {
     "charge": fields.Integer(required=True, description="charge value"),
     "unit": fields.String(required=False, description="charge unit"),
     "timestamp": fields.String(required=False, description="Timestamp"),
+    "battery_id": fields.String(required=False, description="Battery id, defaults to the default battery"),
 })
 
 discharge_model = api.model("Discharging", {
     "discharge": fields.Integer(required=True, description="discharge value"),
     "unit": fields.String(required=False, description="discharge unit"),
     "timestamp": fields.String(required=False, description="Timestamp"),
+    "battery_id": fields.String(required=False, description="Battery id, defaults to the default battery"),
 })
 
 
+def durable_ack():
+    """Whether the caller wants the response only after InfluxDB accepted the write (``?ack=durable``)."""
+    ack = request.args.get("ack") or Config.INFLUXDB_WRITE_ACK
+    if ack not in ("enqueue", "durable"):
+        raise ValueError(f"Invalid ack mode '{ack}', expected 'enqueue' or 'durable'")
+    return ack == "durable"
+
+
+def update_live_state(field, value, moment, unit=None, battery_id=Config.DEFAULT_BATTERY_ID):
+    """Store a new live value and push it to the battery's /livedata/stream subscribers."""
+    current_app.live_state.update(field, value, moment, unit=unit, battery_id=battery_id)
+    current_app.live_broadcaster.publish(battery_id)
+
+
+def start_command_trace():
+    """
+    Trace envelope for an outgoing MQTT command if it is sampled (or ``?trace=true``).
+    The conflator marks it "published" when the command is handed to the publisher.
+
+    Returns:
+        The envelope, or None if the command is not traced.
+    """
+    return start_trace(force=request.args.get("trace") == "true")
+
+
+def rate_limited(field, battery_id):
+    """
+    429 response with retry hints if the battery's command rate limit is exhausted.
+
+    Returns:
+        The response tuple, or None if the command may proceed.
+    """
+    wait = current_app.command_limiter.acquire(battery_id, field)
+    if wait <= 0:
+        return None
+    body = {"error": f"Too many {field} commands for battery '{battery_id}'", "retry_after_ms": math.ceil(wait * 1000)}
+    return body, 429, {"Retry-After": str(max(1, math.ceil(wait)))}
+
+
+def traced_response(body, trace):
+    """200 response for a published command, with the id to look its trace up by."""
+    if trace is not None:
+        body["trace_id"] = trace["id"]
+    return body, 200
+
+
+def finish_traces(traces):
+    """Mark traced records as visible in /livedata and store their stage timings."""
+    for trace, _, _ in traces:
+        mark(trace, "live")
+    write_traces(current_app.write_api, Config.INFLUXDB_BUCKET, Config.INFLUXDB_ORG, traces)
+
+
+def record_stored_writes(stored):
+    """
+    Tell the read cache and the hot store about written records (compression may have
+    released older held values).
+    """
+    first = min(r.time_ns for r in stored)
+    last = max(r.time_ns for r in stored)
+    current_app.read_cache.record_write(ns_to_datetime(first), ns_to_datetime(last),
+                                        battery_ids={r.battery_id for r in stored})
+    if current_app.hot_store is not None:
+        current_app.hot_store.add(stored)
+
+
+def conditional_response(body, etag, last_modified=None, mimetype="application/json", encoding=None):
+    """
+    Response carrying validators, or 304 Not Modified when the client's copy is current.
+    The body is only serialized for 200 responses; ``encoding`` is its content coding.
+    """
+    if etag in request.if_none_match or (
+            not request.if_none_match and last_modified and request.if_modified_since
+            and last_modified.replace(microsecond=0) <= request.if_modified_since):
+        response = Response(status=304)
+    else:
+        response = Response(body() if callable(body) else body, mimetype=mimetype)
+        if encoding:
+            response.content_encoding = encoding
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    return response
+
+
 @api.route("/charge", methods=["POST"])
 class SetCharge(Resource):
-    @api.doc(description="Send charge command via MQTT publishing")
+    @api.doc(description="Send charge command via MQTT publishing. Commands are conflated: each tick only the "
+                        "newest command per battery is published")
+    @api.response(429, "Command rate limit of the battery exceeded, retry after Retry-After seconds")
+    @api.response(503, "MQTT outbound queue full")
     @api.expect(api.model("chargeCommand", {
         "charge": fields.Float(required=True, description="charge value"),
-        "unit": fields.String(required=False, description="Unit, defaults to kW")
+        "unit": fields.String(required=False, description="Unit, defaults to kW"),
+        "battery_id": fields.String(required=False, description="Battery id, defaults to the default battery")
 
     }))
+    @api.param("trace", "'true' to trace this command through the pipeline regardless of sampling", required=False)
     def post(self):
         """Send charge value"""
-        data = request.json
-
-        # Validate request data
-        if "charge" not in data:
-            return {"error": "Missing 'charge' field"}, 400
+        try:
+            record = CHARGE_SCHEMA.validate(request.get_json(silent=True))
+        except ValueError as e:
+            return {"error": str(e)}, 400
 
-        charge = data["charge"]
+        charge = record.values[0][1]
+        unit = record.unit or "kW"
+        topic = battery_topic("charge", record.battery_id)
 
-        unit = "kW"
-        timestamp = datetime.utcnow().replace(microsecond=0).isoformat() + "Z"
-        if "unit" in data:
-            unit = data["unit"]
+        limited = rate_limited("charge", record.battery_id)
+        if limited is not None:
+            return limited
 
         try:
-            # Publish as a JSON object
-            mqtt_message = {
-                "charge": charge,
-                "unit": unit,
-                "timestamp": timestamp
-            }
-
-            mqtt_publish(
-               # mqtt_client=current_app.mqtt_client,
-                topic=Config.MQTT_TOPIC,
-                command=json.dumps(mqtt_message)
-            )
+            trace = start_command_trace()
+            published = current_app.command_conflator.submit(
+                topic, Command("charge", charge, now_ns(), unit=unit, battery_id=record.battery_id, trace=trace))
+            if not published:
+                return {"error": "MQTT outbound queue is full, charge command dropped"}, 503
 
-            print(f"Published charge: {mqtt_message} to {Config.MQTT_TOPIC}")
-            return {"message": f"charge set to: {charge} {unit}"}, 200
+            log.debug("Submitted charge", extra={"topic": topic, "charge": charge, "unit": unit})
+            return traced_response({"message": f"charge set to: {charge} {unit}"}, trace)
 
         except Exception as e:
             return {"error": str(e)}, 500
@@ -74,64 +170,211 @@ class SetCharge(Resource):
 
 @api.route("/discharge", methods=["POST"])
 class SetDischarge(Resource):
-    @api.doc(description="Send discharge command via MQTT publishing")
+    @api.doc(description="Send discharge command via MQTT publishing. Commands are conflated: each tick only the "
+                        "newest command per battery is published")
+    @api.response(429, "Command rate limit of the battery exceeded, retry after Retry-After seconds")
+    @api.response(503, "MQTT outbound queue full")
     @api.expect(api.model("dischargeCommand", {
         "discharge": fields.Float(required=True, description="discharge value"),
-        "unit": fields.String(required=False, description="Unit, defaults to kW")
+        "unit": fields.String(required=False, description="Unit, defaults to kW"),
+        "battery_id": fields.String(required=False, description="Battery id, defaults to the default battery")
     }))
+    @api.param("trace", "'true' to trace this command through the pipeline regardless of sampling", required=False)
     def post(self):
         """Send discharge value"""
-        data = request.json
-
-        # Validate request data
-        if "discharge" not in data:
-            return {"error": "Missing 'discharge' field"}, 400
+        try:
+            record = DISCHARGE_SCHEMA.validate(request.get_json(silent=True))
+        except ValueError as e:
+            return {"error": str(e)}, 400
 
-        discharge = data["discharge"]
+        discharge = record.values[0][1]
+        unit = record.unit or "kW"
+        topic = battery_topic("discharge", record.battery_id)
 
-        unit = "kW"
-        timestamp = datetime.utcnow().replace(microsecond=0).isoformat() + "Z"
-        if "unit" in data:
-            unit = data["unit"]
+        limited = rate_limited("discharge", record.battery_id)
+        if limited is not None:
+            return limited
 
         try:
-            # Publish as a JSON object
-            mqtt_message = {
-                "discharge": discharge,
-                "unit": unit,
-                "timestamp": timestamp
-            }
-
-            mqtt_publish(
-               # mqtt_client=current_app.mqtt_client,
-                topic=Config.MQTT_TOPIC_DISCHARGE,
-                command=json.dumps(mqtt_message)
-            )
+            trace = start_command_trace()
+            published = current_app.command_conflator.submit(
+                topic, Command("discharge", discharge, now_ns(), unit=unit, battery_id=record.battery_id, trace=trace))
+            if not published:
+                return {"error": "MQTT outbound queue is full, discharge command dropped"}, 503
 
-            print(f"Published discharge: {mqtt_message} to {Config.MQTT_TOPIC_DISCHARGE}")
-            return {"message": f"Discharge value set to: {discharge} {unit}"}, 200
+            log.debug("Submitted discharge", extra={"topic": topic, "discharge": discharge, "unit": unit})
+            return traced_response({"message": f"Discharge value set to: {discharge} {unit}"}, trace)
 
         except Exception as e:
             return {"error": str(e)}, 500
 
 
+def stream_rows(rows, ndjson):
+    """
+    Serialize rows as NDJSON or as one JSON array, in chunks of READ_STREAM_CHUNK_ROWS.
+
+    The status line is already sent when a query fails mid-stream, so the error is
+    reported as a final {"error": ...} row instead.
+    """
+    separator = "\n" if ndjson else ","
+    buffer = []
+    first = True
+    if not ndjson:
+        yield "["
+    try:
+        for row in rows:
+            buffer.append(json.dumps(row))
+            if len(buffer) >= Config.READ_STREAM_CHUNK_ROWS:
+                yield ("" if first else separator) + separator.join(buffer)
+                buffer = []
+                first = False
+    except RuntimeError as e:
+        buffer.append(json.dumps({"error": str(e)}))
+    if buffer:
+        yield ("" if first else separator) + separator.join(buffer)
+    yield "\n" if ndjson else "]"
+
+
 @api.route("/read")
 class ReadBatteryData(Resource):
-    @api.doc(description="Retrieve battery data from InfluxDB")
+    @api.doc(description="Retrieve battery data from InfluxDB, one row per timestamp or time bucket")
     @api.param("begin", "Start time for query (default: -1h)", required=False)
     @api.param("end", "End time for query (default: now())", required=False)
+    @api.param("every", "Downsampling window such as 5m, or 'auto' to derive it from max_points", required=False)
+    @api.param("resolution", "Alias for every", required=False)
+    @api.param("agg", "Aggregate per window: mean (default), min, max or last", required=False)
+    @api.param("max_points", "Maximum number of rows; picks the window automatically", required=False, type=int)
+    @api.param("battery_id", "Only return data of this battery (default: all batteries)", required=False)
+    @api.param("since", "Time of the last row already received (RFC 3339 or epoch ns); only newer rows are returned", required=False)
+    @api.param("points", "Downsample to about this many rows, keeping peaks (e.g. the chart width)",
+               required=False, type=int)
+    @api.param("downsample", "Downsampling method for points: lttb (default) or minmax", required=False)
+    @api.param("format", "json (default): array of rows; columns: one array per field with epoch-ms times; "
+                         "arrow: Apache Arrow IPC stream; ndjson: streamed newline-delimited rows. Also negotiated "
+                         "via Accept; responses are gzip/zstd compressed per Accept-Encoding", required=False)
+    @api.param("stream", "'true' to stream the JSON array as rows arrive from InfluxDB", required=False)
     def get(self):
         """Fetch battery data based on time range"""
         begin = request.args.get("begin") or "-1h"
         end = request.args.get("end") or "now()"
         try:
-            results = read_battery_data(
+            fmt = negotiate_format(request.args.get("format"), request.accept_mimetypes)
+        except ValueError as e:
+            return {"error": str(e)}, 400
+        ndjson = fmt == "ndjson"
+        streaming = ndjson or (fmt == "json" and request.args.get("stream") == "true")
+        try:
+            read_args = dict(
+                begin=begin,
+                end=end,
+                every=request.args.get("every") or request.args.get("resolution"),
+                agg=request.args.get("agg"),
+                max_points=request.args.get("max_points", type=int),
+                battery_id=request.args.get("battery_id") or None,
+                since=request.args.get("since") or None,
+                points=request.args.get("points", type=int),
+                downsample=request.args.get("downsample") or None
+            )
+            if not streaming:
+                return self.cached_read(read_args, fmt)
+
+            recent = read_recent(current_app.hot_store, resolve_read_range(**read_args))
+            results = iter(recent) if recent is not None else stream_battery_data(
+                query_api=current_app.query_api,
+                bucket=Config.INFLUXDB_BUCKET,
+                **read_args
+            )
+            # Pull the first row now so invalid parameters and failed queries still get a proper status
+            first = next(results, None)
+            rows = itertools.chain([first], results) if first is not None else iter(())
+            return Response(
+                stream_with_context(stream_rows(rows, ndjson)),
+                mimetype="application/x-ndjson" if ndjson else "application/json"
+            )
+        except ValueError as e:
+            return {"error": str(e)}, 400
+        except RuntimeError as e:
+            return {"error": str(e)}, 500
+
+    @staticmethod
+    def cached_read(read_args, fmt="json"):
+        """
+        Serve a non-streaming read from the write-invalidated cache. On a miss the rows come
+        from the hot store if it covers the range, otherwise from InfluxDB. Each format is
+        cached on its own; compressed bodies are cached with the entry.
+        """
+        cache = current_app.read_cache
+        params = resolve_read_range(**read_args)
+        key = (params["start"], params["stop"], params["every"], params["agg"], params["battery_id"],
+               params["points"], params["downsample"], fmt)
+
+        entry = cache.get(key)
+        if entry is None:
+            seen_version = cache.version
+            results = read_recent(current_app.hot_store, params)
+            if results is None:
+                results = read_battery_data(query_api=current_app.query_api, bucket=Config.INFLUXDB_BUCKET,
+                                            **read_args)
+            entry = cache.put(key, params, results, serialize(results, fmt, current_app.json.dumps), seen_version)
+
+        encoding = None
+        if len(entry.body) >= Config.READ_COMPRESS_MIN_BYTES:
+            encoding = negotiate_encoding(request.accept_encodings)
+        if encoding is None:
+            response = conditional_response(entry.body, entry.etag, mimetype=FORMATS[fmt])
+        else:
+            response = conditional_response(lambda: entry.encoded(encoding), f"{entry.etag}-{encoding}",
+                                            mimetype=FORMATS[fmt], encoding=encoding)
+        response.vary.update(("Accept", "Accept-Encoding"))
+        return response
+
+
+@api.route("/stats")
+class BatteryStats(Resource):
+    @api.doc(description="Max, min, mean and count of charge and discharge, answered from precomputed rollups")
+    @api.param("begin", "Start time for query (default: -1h)", required=False)
+    @api.param("end", "End time for query (default: now())", required=False)
+    @api.param("battery_id", "Only this battery (default: all batteries)", required=False)
+    def get(self):
+        """Get summary statistics for a time range"""
+        try:
+            stats = read_battery_stats(
                 query_api=current_app.query_api,
                 bucket=Config.INFLUXDB_BUCKET,
-                begin=begin,
-                end=end
+                tiers=current_app.rollup_tiers,
+                begin=request.args.get("begin"),
+                end=request.args.get("end"),
+                battery_id=request.args.get("battery_id") or None
             )
-            return jsonify(results)
+            return stats, 200
+        except ValueError as e:
+            return {"error": str(e)}, 400
+        except RuntimeError as e:
+            return {"error": str(e)}, 500
+
+
+@api.route("/traces/slowest")
+class SlowestTraces(Resource):
+    @api.doc(description="Traced charge/discharge commands that took longest from the API to /livedata, "
+                         "with the milliseconds spent reaching each stage")
+    @api.param("begin", "Start time for query (default: -1h)", required=False)
+    @api.param("end", "End time for query (default: now())", required=False)
+    @api.param("limit", "Number of messages (default: 20)", required=False, type=int)
+    @api.param("battery_id", "Only this battery (default: all batteries)", required=False)
+    def get(self):
+        """Get the slowest recent messages"""
+        try:
+            traces = read_slowest_traces(
+                query_api=current_app.query_api,
+                bucket=Config.INFLUXDB_BUCKET,
+                begin=request.args.get("begin"),
+                end=request.args.get("end"),
+                limit=request.args.get("limit", type=int),
+                battery_id=request.args.get("battery_id") or None
+            )
+            return traces, 200
+        except ValueError as e:
+            return {"error": str(e)}, 400
         except RuntimeError as e:
             return {"error": str(e)}, 500
 
@@ -139,39 +382,40 @@ class ReadBatteryData(Resource):
 @api.route("/writeCharge")
 class WriteChargeValue(Resource):
     @api.expect(charge_model)
+    @api.param("ack", "'enqueue' (default) or 'durable' to wait for InfluxDB (for the disk in spool mode)", required=False)
     @api.response(200, "Data written successfully")
     @api.response(400, "Invalid payload")
+    @api.response(503, "Write buffer full")
     def post(self):
         """Write battery charge data"""
-        data = request.json
-        if not data:
-            return {"error": "Invalid payload"}, 400
-
         try:
-            global latest_charge
-            latest_charge["charge"] = data["charge"]
-
-            # If no timestamp is provided, take the current time in UTC and set milliseconds to 00
-            if "timestamp" in data:
-                parsed_timestamp = parse(data["timestamp"]).isoformat()
-            else:
-                now = datetime.utcnow().replace(microsecond=0)
-                parsed_timestamp = now.isoformat() + "Z"  # Append "Z" for UTC indication
-
-            latest_charge["timestamp"] = parsed_timestamp
-
-            influx_write_charge(
+            data = request.get_json(silent=True)
+            trace = get_trace(data)
+            if trace is not None:
+                mark(trace, "write_received")
+            record, stored = influx_write_charge(
                 write_api=current_app.write_api,
                 bucket=Config.INFLUXDB_BUCKET,
                 org=Config.INFLUXDB_ORG,
-                data={**data, "timestamp": parsed_timestamp}
+                data=data,
+                durable=durable_ack(),
+                compressor=current_app.write_compressor,
+                keep=trace is not None
             )
+            if trace is not None:
+                mark(trace, "stored")
+            moment = record.moment
+            if stored:
+                record_stored_writes(stored)
+            update_live_state("charge", record.values[0][1], moment, unit=record.unit, battery_id=record.battery_id)
+            if trace is not None:
+                finish_traces([(trace, record.battery_id, "charge")])
 
             return {"message": "Data written successfully"}, 200
-        except KeyError as e:
-            return {"error": f"Missing key: {e}"}, 400
         except ValueError as e:
             return {"error": str(e)}, 400
+        except WriteBufferFull as e:
+            return {"error": str(e)}, 503
         except RuntimeError as e:
             return {"error": str(e)}, 500
 
@@ -179,46 +423,254 @@ class WriteChargeValue(Resource):
 @api.route("/writeDischarge")
 class WriteDischargeValue(Resource):
     @api.expect(discharge_model)
+    @api.param("ack", "'enqueue' (default) or 'durable' to wait for InfluxDB (for the disk in spool mode)", required=False)
     @api.response(200, "Data written successfully")
     @api.response(400, "Invalid payload")
+    @api.response(503, "Write buffer full")
     def post(self):
         """Write battery discharge data"""
-        data = request.json
-        if not data:
-            return {"error": "Invalid payload"}, 400
-
         try:
-            global latest_charge
-            latest_charge["discharge"] = data["discharge"]
-            # If no timestamp is provided, take the current time in UTC and set milliseconds to 00
-            if "timestamp" in data:
-                parsed_timestamp = parse(data["timestamp"]).isoformat()
-            else:
-                now = datetime.utcnow().replace(microsecond=0)
-                parsed_timestamp = now.isoformat() + "Z"  # Append "Z" for UTC indication
-
-
-            latest_charge["timestamp"] = parsed_timestamp
-
-            influx_write_discharge(
+            data = request.get_json(silent=True)
+            trace = get_trace(data)
+            if trace is not None:
+                mark(trace, "write_received")
+            record, stored = influx_write_discharge(
                 write_api=current_app.write_api,
                 bucket=Config.INFLUXDB_BUCKET,
                 org=Config.INFLUXDB_ORG,
-                data={**data, "timestamp": parsed_timestamp}
+                data=data,
+                durable=durable_ack(),
+                compressor=current_app.write_compressor,
+                keep=trace is not None
             )
+            if trace is not None:
+                mark(trace, "stored")
+            moment = record.moment
+            if stored:
+                record_stored_writes(stored)
+            update_live_state("discharge", record.values[0][1], moment, unit=record.unit, battery_id=record.battery_id)
+            if trace is not None:
+                finish_traces([(trace, record.battery_id, "discharge")])
 
             return {"message": "Data written successfully"}, 200
-        except KeyError as e:
-            return {"error": f"Missing key: {e}"}, 400
         except ValueError as e:
             return {"error": str(e)}, 400
+        except WriteBufferFull as e:
+            return {"error": str(e)}, 503
         except RuntimeError as e:
             return {"error": str(e)}, 500
 
 
+def iter_batch_records():
+    """
+    Yield (index, record) pairs from a bulk request body without buffering it first.
+
+    JSON arrays yield their elements, NDJSON yields one parsed object per line and
+    line protocol one ValidRecord per line; malformed lines yield their ValueError.
+    """
+    mimetype = request.mimetype
+    if mimetype == "application/json":
+        body = request.get_json(silent=True)
+        if not isinstance(body, list):
+            raise ValueError("Expected a JSON array of records")
+        yield from enumerate(body)
+    elif mimetype in ("application/x-ndjson", "application/jsonlines"):
+        index = 0
+        for line in request.stream:
+            if line.strip():
+                try:
+                    yield index, json.loads(line)
+                except ValueError as e:
+                    yield index, e
+                index += 1
+    elif mimetype == "text/plain":
+        index = 0
+        for line in request.stream:
+            line = line.strip().decode()
+            if line and not line.startswith("#"):
+                try:
+                    yield index, parse_line_protocol(line)
+                except ValueError as e:
+                    yield index, e
+                index += 1
+    else:
+        raise ValueError(f"Unsupported content type '{mimetype}', "
+                         "use application/json, application/x-ndjson or text/plain (line protocol)")
+
+
+@api.route("/writeBatch")
+class WriteBatch(Resource):
+    @api.doc(description="Bulk write charge/discharge records as a JSON array (application/json), "
+                         "newline-delimited JSON (application/x-ndjson) or InfluxDB line protocol (text/plain). "
+                         "With write compression 'stored' counts the points kept of the 'written' records; "
+                         "'unwritten' counts the valid records whose write failed")
+    @api.param("ack", "'enqueue' (default) or 'durable' to wait for InfluxDB (for the disk in spool mode)", required=False)
+    @api.response(200, "All records written")
+    @api.response(207, "Some records were rejected, see 'errors'")
+    @api.response(400, "Invalid payload")
+    def post(self):
+        """Write many battery records in one request"""
+        written = 0
+        stored = 0
+        failed = 0
+        unwritten = 0  # valid records of chunks whose write failed, included in failed
+        errors = []
+        chunk = []
+        chunk_records = 0  # records in the chunk, including those compression dropped entirely
+        chunk_start = 0
+        chunk_kept = []  # ValidRecords written by the chunk, for the hot store
+        # Live values and the range written, of the chunk and then of the chunks written successfully
+        chunk_latest = {}  # (battery id, field) -> (value, unit, time) of the newest value
+        chunk_first = chunk_last = None
+        chunk_battery_ids = set()
+        compressor = current_app.write_compressor
+        hot_store = current_app.hot_store
+        latest = {}
+        first_time = last_time = None
+        battery_ids = set()
+        chunk_traces = []  # (trace, battery id, field) of traced records in the chunk
+        traces = []
+
+        def reject(entry):
+            nonlocal failed
+            failed += entry.get("count", 1)
+            if len(errors) < Config.WRITE_BATCH_MAX_ERRORS:
+                errors.append(entry)
+
+        def flush():
+            nonlocal written, stored, unwritten, chunk, chunk_records, chunk_traces, chunk_kept
+            nonlocal chunk_latest, chunk_first, chunk_last, chunk_battery_ids, first_time, last_time, battery_ids
+            if not chunk_records:
+                return
+            try:
+                if chunk:
+                    write_point(current_app.write_api, Config.INFLUXDB_BUCKET, Config.INFLUXDB_ORG, chunk,
+                                durable=durable)
+                written += chunk_records
+                stored += len(chunk)
+                traces.extend((mark(trace, "stored"), battery_id, field) for trace, battery_id, field in chunk_traces)
+                if hot_store is not None:
+                    hot_store.add(chunk_kept)
+                for key, (value, unit, moment) in chunk_latest.items():
+                    if key not in latest or moment >= latest[key][2]:
+                        latest[key] = (value, unit, moment)
+                if chunk_first is not None:
+                    first_time = chunk_first if first_time is None else min(first_time, chunk_first)
+                    last_time = chunk_last if last_time is None else max(last_time, chunk_last)
+                    battery_ids |= chunk_battery_ids
+            except Exception as e:
+                unwritten += chunk_records
+                reject({"index": chunk_start, "count": chunk_records, "error": str(e)})
+            chunk = []
+            chunk_records = 0
+            chunk_traces = []
+            chunk_kept = []
+            chunk_latest = {}
+            chunk_first = chunk_last = None
+            chunk_battery_ids = set()
+
+        try:
+            durable = durable_ack()
+            for index, record in iter_batch_records():
+                try:
+                    if isinstance(record, Exception):
+                        raise record
+                    if isinstance(record, ValidRecord):  # parsed line protocol
+                        valid, trace = record, None
+                    else:
+                        valid = BATTERY_RECORD_SCHEMA.validate(record)
+                        trace = get_trace(record)
+                    kept = [valid] if compressor is None else compressor.compress(valid, keep=trace is not None)
+                    points = [record_point(r) for r in kept]
+                    moments = [r.moment for r in kept]
+                    chunk_kept.extend(kept)
+                    if kept:
+                        chunk_battery_ids.add(valid.battery_id)
+                    moment = valid.moment
+                    for field, value in valid.values:
+                        key = (valid.battery_id, field)
+                        if key not in chunk_latest or moment >= chunk_latest[key][2]:
+                            chunk_latest[key] = (value, valid.unit, moment)
+                    if trace is not None:
+                        chunk_traces.append((mark(trace, "write_received"), valid.battery_id, valid.values[0][0]))
+                except ValueError as e:
+                    reject({"index": index, "error": str(e)})
+                    continue
+
+                if moments:
+                    chunk_first = min(moments) if chunk_first is None else min(chunk_first, *moments)
+                    chunk_last = max(moments) if chunk_last is None else max(chunk_last, *moments)
+
+                if not chunk_records:
+                    chunk_start = index
+                chunk.extend(points)
+                chunk_records += 1
+                if chunk_records >= Config.WRITE_BATCH_CHUNK_SIZE:
+                    flush()
+            flush()
+        except ValueError as e:
+            return {"error": str(e)}, 400
+
+        if stored:
+            current_app.read_cache.record_write(first_time, last_time, battery_ids=battery_ids)
+        for (battery_id, field), (value, unit, moment) in latest.items():
+            update_live_state(field, value, moment, unit=unit, battery_id=battery_id)
+        if traces:
+            finish_traces(traces)
+
+        summary = {"written": written, "stored": stored, "failed": failed, "unwritten": unwritten, "errors": errors}
+        return summary, 207 if failed else 200
+
+
 @api.route("/livedata")
 class GetCurrentSOC(Resource):
-    @api.doc(description="Retrieve the latest charging value")
+    @api.doc(description="Retrieve the latest charging value (supports If-None-Match / If-Modified-Since)")
+    @api.param("battery_id", "Battery to return (default: the default battery)", required=False)
     def get(self):
         """Get the latest value"""
-        return jsonify(latest_charge)
+        try:
+            battery_id = validate_battery_id(request.args.get("battery_id"))
+        except ValueError as e:
+            return {"error": str(e)}, 400
+        live_state = current_app.live_state
+        return conditional_response(lambda: current_app.json.dumps(live_state.get(battery_id)),
+                                    f"l{live_state.version(battery_id)}", live_state.last_modified(battery_id))
+
+
+@api.route("/livedata/stream")
+class StreamLiveData(Resource):
+    @api.doc(description="Server-Sent Events stream pushing the latest charge/discharge values on every change")
+    @api.param("battery_id", "Battery to follow (default: the default battery)", required=False)
+    @api.response(503, "Too many stream clients")
+    def get(self):
+        """Stream live values"""
+        broadcaster = current_app.live_broadcaster
+        try:
+            subscriber = broadcaster.subscribe(validate_battery_id(request.args.get("battery_id")))
+        except ValueError as e:
+            return {"error": str(e)}, 400
+        except RuntimeError as e:
+            return {"error": str(e)}, 503
+
+        def events():
+            try:
+                while True:
+                    items = subscriber.wait(Config.LIVE_STREAM_HEARTBEAT)
+                    if not items:
+                        yield ": keep-alive\n\n"
+                    for version, snapshot in items:
+                        yield f"id: {version}\nevent: live\ndata: {json.dumps(snapshot)}\n\n"
+            finally:
+                broadcaster.unsubscribe(subscriber)
+
+        return Response(events(), mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@api.route("/metrics")
+class Metrics(Resource):
+    @api.doc(description="Prometheus metrics: request, MQTT and InfluxDB latency histograms, message counters "
+                         "and queue depths, summed over all server workers")
+    def get(self):
+        """Prometheus metrics"""
+        return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
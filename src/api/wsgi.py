@@ -0,0 +1,11 @@
+"""
+WSGI entry point for the production server:
+
+    gunicorn -c src/api/gunicorn_conf.py src.api.wsgi:app
+
+The app is created without clients; gunicorn_conf.py starts them in every worker
+after fork and shuts them down when the worker exits.
+"""
+from src.api import create_app
+
+app = create_app(start_clients=False)
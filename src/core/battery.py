@@ -0,0 +1,61 @@
+import re
+
+from src.core.config import Config
+
+FIELDS = ("charge", "discharge")
+
+# Battery ids end up in MQTT topics, InfluxDB tags and Flux string literals
+_BATTERY_ID = re.compile(r"^[A-Za-z0-9_.:-]{1,64}$")
+
+
+def validate_battery_id(value):
+    """
+    Validate a battery id, falling back to the default battery when it is missing.
+
+    Raises:
+        ValueError: If the id is not 1-64 letters, digits or ``_.:-``.
+    """
+    if value is None or value == "":
+        return Config.DEFAULT_BATTERY_ID
+    if not isinstance(value, str) or not _BATTERY_ID.match(value):
+        raise ValueError(f"Invalid battery_id {value!r}: use 1-64 letters, digits or _.:-")
+    return value
+
+
+def battery_topic(field, battery_id=None):
+    """
+    MQTT topic for a battery's charge or discharge messages.
+    The default battery keeps the legacy single-battery topics.
+    """
+    if battery_id in (None, Config.DEFAULT_BATTERY_ID):
+        return Config.MQTT_TOPIC if field == "charge" else Config.MQTT_TOPIC_DISCHARGE
+    return f"{Config.MQTT_TOPIC_PREFIX}/{battery_id}/{field}"
+
+
+def parse_battery_topic(topic):
+    """
+    Split a telemetry topic into its battery id and field.
+
+    Returns:
+        (battery_id, field), or None if the topic is not a battery topic.
+    """
+    if topic == Config.MQTT_TOPIC:
+        return Config.DEFAULT_BATTERY_ID, "charge"
+    if topic == Config.MQTT_TOPIC_DISCHARGE:
+        return Config.DEFAULT_BATTERY_ID, "discharge"
+
+    parts = topic.split("/")
+    if len(parts) == 3 and parts[0] == Config.MQTT_TOPIC_PREFIX and parts[2] in FIELDS \
+            and _BATTERY_ID.match(parts[1]):
+        return parts[1], parts[2]
+    return None
+
+
+def subscription_topics():
+    """Topic filters covering the legacy topics and every battery (``battery/+/charge``)."""
+    return [
+        Config.MQTT_TOPIC,
+        Config.MQTT_TOPIC_DISCHARGE,
+        f"{Config.MQTT_TOPIC_PREFIX}/+/charge",
+        f"{Config.MQTT_TOPIC_PREFIX}/+/discharge",
+    ]
@@ -0,0 +1,136 @@
+"""
+MQTT payload encodings of a charge/discharge record.
+
+"json" is the original text form. "binary" is a fixed-layout little-endian record
+with an integer epoch timestamp, 19 bytes without a unit or trace:
+
+    magic 0xBA, version, flags, value (int64 or float64), timestamp (int64 epoch ns)
+    [unit: length byte + UTF-8]                                  if flags & UNIT
+    [trace: 16-byte id, stage count, count x (stage index, int64 epoch ns)]  if flags & TRACE
+
+The field (charge or discharge) and the battery id are given by the topic. Binary
+payloads start with the magic byte, which JSON never does, so consumers can tell the
+encodings apart even without the MQTT v5 content type the publisher sets.
+"""
+import json
+import struct
+import time
+
+from src.core.tracing import STAGES, TRACE_FIELD
+
+FORMATS = ("json", "binary")
+JSON_CONTENT_TYPE = "application/json"
+BINARY_CONTENT_TYPE = "application/vnd.battery.record.v1"
+CONTENT_TYPES = {"json": JSON_CONTENT_TYPE, "binary": BINARY_CONTENT_TYPE}
+
+_MAGIC = 0xBA
+_VERSION = 1
+_INT_VALUE = 0x01
+_UNIT = 0x02
+_TRACE = 0x04
+_INT_RECORD = struct.Struct("<BBBqq")  # magic, version, flags, value, timestamp
+_FLOAT_RECORD = struct.Struct("<BBBdq")
+_STAGE = struct.Struct("<Bq")
+_INT64 = (-(1 << 63), (1 << 63) - 1)
+
+
+def encode_message(fmt, field, value, time_ns, unit=None, battery_id=None, trace=None):
+    """
+    Encode a record for publishing.
+
+    Args:
+        fmt: "json" or "binary".
+        field: "charge" or "discharge".
+        value: The int or float value.
+        time_ns: Timestamp in epoch nanoseconds.
+        unit: Optional unit.
+        battery_id: Only included in JSON (binary consumers take it from the topic).
+        trace: Optional trace envelope (see ``src.core.tracing``).
+
+    Returns:
+        The payload (str for JSON, bytes for binary).
+    """
+    if fmt == "binary":
+        return encode_record(value, time_ns, unit, trace)
+    if fmt != "json":
+        raise ValueError(f"Unknown payload format '{fmt}', expected one of {', '.join(FORMATS)}")
+    message = {field: value}
+    if unit is not None:
+        message["unit"] = unit
+    message["timestamp"] = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(time_ns // 1_000_000_000))
+    if battery_id is not None:
+        message["battery_id"] = battery_id
+    if trace is not None:
+        message[TRACE_FIELD] = trace
+    return json.dumps(message)
+
+
+def encode_record(value, time_ns, unit=None, trace=None):
+    """Binary payload of one value; see the module docstring for the layout."""
+    flags = 0
+    if type(value) is int and _INT64[0] <= value <= _INT64[1]:
+        flags |= _INT_VALUE
+        layout = _INT_RECORD
+    else:
+        value = float(value)
+        layout = _FLOAT_RECORD
+    tail = b""
+    if unit:
+        encoded = unit.encode()
+        if len(encoded) > 255:
+            raise ValueError("unit is longer than 255 bytes")
+        flags |= _UNIT
+        tail += bytes((len(encoded),)) + encoded
+    if trace is not None:
+        flags |= _TRACE
+        stages = [(STAGES.index(stage), at) for stage, at in trace["stages"].items() if stage in STAGES]
+        tail += bytes.fromhex(trace["id"]) + bytes((len(stages),))
+        tail += b"".join(_STAGE.pack(index, at) for index, at in stages)
+    return layout.pack(_MAGIC, _VERSION, flags, value, time_ns) + tail
+
+
+def is_binary(payload):
+    """Whether a payload is a binary record (rather than JSON)."""
+    return len(payload) > 0 and payload[0] == _MAGIC
+
+
+def decode_record(payload, field):
+    """
+    Decode a binary payload into the record dict the JSON path produces, with the
+    timestamp as integer epoch nanoseconds.
+
+    Raises:
+        ValueError: If the payload is truncated, of an unknown version or malformed.
+    """
+    if len(payload) < _INT_RECORD.size or payload[0] != _MAGIC:
+        raise ValueError("Not a binary record")
+    if payload[1] != _VERSION:
+        raise ValueError(f"Unsupported binary record version {payload[1]}")
+    flags = payload[2]
+    layout = _INT_RECORD if flags & _INT_VALUE else _FLOAT_RECORD
+    _, _, _, value, time_ns = layout.unpack_from(payload)
+    record = {field: value, "timestamp": time_ns}
+
+    offset = layout.size
+    try:
+        if flags & _UNIT:
+            length = payload[offset]
+            record["unit"] = bytes(payload[offset + 1:offset + 1 + length]).decode()
+            offset += 1 + length
+        if flags & _TRACE:
+            trace_id = bytes(payload[offset:offset + 16]).hex()
+            if len(trace_id) != 32:
+                raise IndexError(offset)
+            count = payload[offset + 16]
+            offset += 17
+            stages = {}
+            for _ in range(count):
+                index, at = _STAGE.unpack_from(payload, offset)
+                stages[STAGES[index]] = at
+                offset += _STAGE.size
+            record[TRACE_FIELD] = {"id": trace_id, "stages": stages}
+    except (IndexError, struct.error, UnicodeDecodeError):
+        raise ValueError("Truncated or malformed binary record")
+    if offset != len(payload):
+        raise ValueError("Truncated or malformed binary record")
+    return record
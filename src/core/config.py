@@ -1,4 +1,6 @@
 import os
+import socket
+import tempfile
 from flask.cli import load_dotenv
 
 # Load environment variables from .env file (for secrets)
@@ -13,6 +15,25 @@ class Config:
     MQTT_PORT = int(os.getenv("MQTT_BROKER_PORT", 1883))
     MQTT_TOPIC = os.getenv("MQTT_TOPIC", "battery/charge")
     MQTT_TOPIC_DISCHARGE = os.getenv("MQTT_TOPIC", "battery/discharge")
+    MQTT_TOPIC_PREFIX = os.getenv("MQTT_TOPIC_PREFIX", "battery")  # per-battery topics: battery/<id>/charge
+    MQTT_KEEPALIVE = int(os.getenv("MQTT_KEEPALIVE", 60))
+
+    # 🔷 Batteries
+    DEFAULT_BATTERY_ID = os.getenv("DEFAULT_BATTERY_ID", "default")
+
+    # 🔷 MQTT Publisher (Flask API -> broker)
+    MQTT_PUBLISH_QOS = int(os.getenv("MQTT_PUBLISH_QOS", 0))
+    MQTT_PUBLISHER_POOL_SIZE = int(os.getenv("MQTT_PUBLISHER_POOL_SIZE", 1))
+    MQTT_OUTBOUND_QUEUE_SIZE = int(os.getenv("MQTT_OUTBOUND_QUEUE_SIZE", 10000))
+    MQTT_RECONNECT_MIN_DELAY = int(os.getenv("MQTT_RECONNECT_MIN_DELAY", 1))
+    MQTT_RECONNECT_MAX_DELAY = int(os.getenv("MQTT_RECONNECT_MAX_DELAY", 30))
+
+    # 🔷 Commands (/charge, /discharge)
+    # Pending commands are published once per tick, only the newest per topic (0 publishes each right away)
+    COMMAND_CONFLATION_INTERVAL_MS = int(os.getenv("COMMAND_CONFLATION_INTERVAL_MS", 100))
+    COMMAND_MAX_PENDING = int(os.getenv("COMMAND_MAX_PENDING", 10000))  # topics waiting for a tick; more get 503
+    COMMAND_RATE_LIMIT = float(os.getenv("COMMAND_RATE_LIMIT", 20))  # per battery and second and worker; 0 disables
+    COMMAND_RATE_BURST = float(os.getenv("COMMAND_RATE_BURST", 40))
 
     # 🔷 InfluxDB Configuration
     INFLUXDB_URL = os.getenv("INFLUXDB_URL", "http://influxdb:8086")
@@ -20,14 +41,131 @@ class Config:
     INFLUXDB_ORG = os.getenv("INFLUXDB_ORG", "ENI")
     INFLUXDB_BUCKET = os.getenv("INFLUXDB_BUCKET", "battery1")
 
+    # 🔷 InfluxDB Write Pipeline
+    INFLUXDB_WRITE_MODE = os.getenv("INFLUXDB_WRITE_MODE", "batch")  # "batch", "spool" or "sync"
+    INFLUXDB_WRITE_ACK = os.getenv("INFLUXDB_WRITE_ACK", "enqueue")  # "enqueue" or "durable"
+    INFLUXDB_BATCH_SIZE = int(os.getenv("INFLUXDB_BATCH_SIZE", 5000))
+    INFLUXDB_FLUSH_INTERVAL_MS = int(os.getenv("INFLUXDB_FLUSH_INTERVAL_MS", 1000))
+    INFLUXDB_BUFFER_SIZE = int(os.getenv("INFLUXDB_BUFFER_SIZE", 50000))
+    INFLUXDB_ENQUEUE_TIMEOUT_MS = int(os.getenv("INFLUXDB_ENQUEUE_TIMEOUT_MS", 100))
+    INFLUXDB_MAX_RETRIES = int(os.getenv("INFLUXDB_MAX_RETRIES", 5))
+    INFLUXDB_RETRY_INTERVAL_MS = int(os.getenv("INFLUXDB_RETRY_INTERVAL_MS", 500))
+    INFLUXDB_MAX_RETRY_DELAY_MS = int(os.getenv("INFLUXDB_MAX_RETRY_DELAY_MS", 30000))
+    INFLUXDB_RETRY_JITTER_MS = int(os.getenv("INFLUXDB_RETRY_JITTER_MS", 200))
+    INFLUXDB_DURABLE_TIMEOUT_MS = int(os.getenv("INFLUXDB_DURABLE_TIMEOUT_MS", 30000))
+
+    # 🔷 InfluxDB Write Spool ("spool" write mode): local write-ahead log replayed to InfluxDB
+    INFLUXDB_SPOOL_DIR = os.getenv("INFLUXDB_SPOOL_DIR", "/var/lib/battery/spool")  # one slot per process
+    INFLUXDB_SPOOL_SEGMENT_BYTES = int(os.getenv("INFLUXDB_SPOOL_SEGMENT_BYTES", 8 * 1024 * 1024))
+    INFLUXDB_SPOOL_MAX_BYTES = int(os.getenv("INFLUXDB_SPOOL_MAX_BYTES", 1024 * 1024 * 1024))  # per slot
+    INFLUXDB_SPOOL_SYNC_INTERVAL_MS = int(os.getenv("INFLUXDB_SPOOL_SYNC_INTERVAL_MS", 1000))
+
+    # 🔷 Write Compression (/writeCharge, /writeDischarge, /writeBatch and the bridge's influx sink)
+    # Per field "deadband" or "swinging_door" with an absolute or relative deviation, e.g.
+    # "charge=deadband:0.5,discharge=swinging_door:2%"; empty stores every value
+    WRITE_COMPRESSION = os.getenv("WRITE_COMPRESSION", "")
+    WRITE_COMPRESSION_MAX_INTERVAL = int(os.getenv("WRITE_COMPRESSION_MAX_INTERVAL", 300))  # max seconds between stored values
+
+    # 🔷 Reads (/read)
+    READ_MAX_POINTS = int(os.getenv("READ_MAX_POINTS", 2000))
+    READ_DEFAULT_AGG = os.getenv("READ_DEFAULT_AGG", "mean")
+    READ_DOWNSAMPLE = os.getenv("READ_DOWNSAMPLE", "lttb")  # method for /read?points=: lttb or minmax
+    READ_STREAM_CHUNK_ROWS = int(os.getenv("READ_STREAM_CHUNK_ROWS", 500))
+    READ_CACHE_MAX_ENTRIES = int(os.getenv("READ_CACHE_MAX_ENTRIES", 256))
+    READ_CACHE_MAX_ROWS = int(os.getenv("READ_CACHE_MAX_ROWS", 20000))
+    READ_CACHE_TTL = int(os.getenv("READ_CACHE_TTL", 30))  # seconds, for ranges relative to now()
+    READ_COMPRESS_MIN_BYTES = int(os.getenv("READ_COMPRESS_MIN_BYTES", 1024))  # smaller bodies are sent as they are
+
+    # 🔷 Rollups (/stats), maintained by InfluxDB tasks created at startup
+    ROLLUPS_ENABLED = os.getenv("ROLLUPS_ENABLED", "true").lower() == "true"
+
+    # 🔷 Live State (/livedata), shared by all worker processes with the "shm" backend
+    LIVE_STATE_BACKEND = os.getenv("LIVE_STATE_BACKEND", "shm")  # "shm" or "memory"
+    LIVE_STATE_SHM_NAME = os.getenv("LIVE_STATE_SHM_NAME", "battery_live_state")
+    LIVE_STATE_SLOTS = int(os.getenv("LIVE_STATE_SLOTS", 1024))
+    LIVE_STATE_LOCK_FILE = os.getenv("LIVE_STATE_LOCK_FILE")
+
+    # 🔷 Hot Store: recent raw points answering /read from memory, shared by all worker
+    # processes with the "shm" live state backend (memory: batteries x 2 x points x 17 bytes)
+    # Off by default: only enable when every write goes through the API (see README)
+    HOT_STORE_RETENTION = int(os.getenv("HOT_STORE_RETENTION", 0))  # seconds warmed from InfluxDB; 0 disables
+    HOT_STORE_POINTS = int(os.getenv("HOT_STORE_POINTS", HOT_STORE_RETENTION or 3600))  # points kept per battery and field
+    HOT_STORE_BATTERIES = int(os.getenv("HOT_STORE_BATTERIES", 256))
+    HOT_STORE_SHM_NAME = os.getenv("HOT_STORE_SHM_NAME", "battery_hot_store")
+    HOT_STORE_LOCK_FILE = os.getenv("HOT_STORE_LOCK_FILE")
+
+    # 🔷 Live Stream (/livedata/stream, Server-Sent Events)
+    LIVE_STREAM_QUEUE_SIZE = int(os.getenv("LIVE_STREAM_QUEUE_SIZE", 8))
+    LIVE_STREAM_POLL_INTERVAL_MS = int(os.getenv("LIVE_STREAM_POLL_INTERVAL_MS", 100))
+    LIVE_STREAM_HEARTBEAT = int(os.getenv("LIVE_STREAM_HEARTBEAT", 15))
+    LIVE_STREAM_MAX_CLIENTS = int(os.getenv("LIVE_STREAM_MAX_CLIENTS", 100))  # per worker, capped at API_THREADS - 1
+
+    # 🔷 Bulk Ingest (/writeBatch)
+    WRITE_BATCH_CHUNK_SIZE = int(os.getenv("WRITE_BATCH_CHUNK_SIZE", 5000))
+    WRITE_BATCH_MAX_ERRORS = int(os.getenv("WRITE_BATCH_MAX_ERRORS", 100))
+
+    # 🔷 Logging and Metrics
+    LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")  # DEBUG logs every published and received message
+    LOG_FORMAT = os.getenv("LOG_FORMAT", "text")  # "text" or "json"
+    # prometheus_client multiprocess directory of the API workers, so /metrics on any worker reports totals
+    METRICS_DIR = os.getenv("METRICS_DIR", os.path.join(tempfile.gettempdir(), "battery-api-metrics"))
+    MQTT_BRIDGE_METRICS_PORT = int(os.getenv("MQTT_BRIDGE_METRICS_PORT", 9101))  # 0 disables
+
+    # 🔷 MQTT Payloads
+    # Encoding of the commands /charge and /discharge publish: "json" or "binary" (compact
+    # fixed-layout records, see src/core/codec.py). The bridge accepts both.
+    MQTT_PAYLOAD_FORMAT = os.getenv("MQTT_PAYLOAD_FORMAT", "json")
+    # "5" tags every message with its content type; "3.1.1" for brokers without MQTT v5
+    MQTT_PUBLISHER_PROTOCOL = os.getenv("MQTT_PUBLISHER_PROTOCOL", "5")
+
+    # 🔷 Message Tracing
+    # Fraction of /charge and /discharge commands that carry a trace envelope through
+    # MQTT, the bridge and the write path (0 disables; ?trace=true forces one)
+    TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", 0.01))
+    TRACE_MAX_RESULTS = int(os.getenv("TRACE_MAX_RESULTS", 100))  # upper bound for /traces/slowest
+
+    # 🔷 API Server (gunicorn, see src/api/gunicorn_conf.py)
+    API_BIND = os.getenv("API_BIND", "0.0.0.0:5003")
+    API_WORKERS = int(os.getenv("API_WORKERS", os.cpu_count() or 1))  # processes
+    API_THREADS = int(os.getenv("API_THREADS", 8))  # request threads per process; an open SSE stream holds one
+    API_TIMEOUT = int(os.getenv("API_TIMEOUT", 60))  # seconds before a stuck worker is restarted
+    API_GRACEFUL_TIMEOUT = int(os.getenv("API_GRACEFUL_TIMEOUT", 30))  # seconds to finish requests on SIGTERM
+
     # 🔷 Flask API Configuration
     FLASK_API_HOST = os.getenv("FLASK_API_HOST", "flask-app")
     FLASK_API_PORT = os.getenv("FLASK_API_PORT", "5003")
     WRITE_CHARGE_ENDPOINT = f"http://{FLASK_API_HOST}:{FLASK_API_PORT}/writeCharge"
     WRITE_DISCHARGE_ENDPOINT = f"http://{FLASK_API_HOST}:{FLASK_API_PORT}/writeDischarge"
+    WRITE_BATCH_ENDPOINT = f"http://{FLASK_API_HOST}:{FLASK_API_PORT}/writeBatch"
+
+    # 🔷 MQTT Bridge (mqtt_service)
+    # "http" posts to /writeBatch so the API keeps seeing every write (/livedata);
+    # "influx" writes directly to InfluxDB and skips the API altogether
+    MQTT_BRIDGE_SINK = os.getenv("MQTT_BRIDGE_SINK", "http")
+    MQTT_BRIDGE_WORKERS = int(os.getenv("MQTT_BRIDGE_WORKERS", 4))
+    MQTT_BRIDGE_QUEUE_SIZE = int(os.getenv("MQTT_BRIDGE_QUEUE_SIZE", 10000))
+    MQTT_BRIDGE_BATCH_SIZE = int(os.getenv("MQTT_BRIDGE_BATCH_SIZE", 500))
+    MQTT_BRIDGE_ENQUEUE_TIMEOUT_MS = int(os.getenv("MQTT_BRIDGE_ENQUEUE_TIMEOUT_MS", 50))
+    MQTT_BRIDGE_HTTP_TIMEOUT = float(os.getenv("MQTT_BRIDGE_HTTP_TIMEOUT", 10))
+    MQTT_BRIDGE_STATS_INTERVAL = int(os.getenv("MQTT_BRIDGE_STATS_INTERVAL", 30))
+    # 1: messages are acknowledged only once written, and redelivered after a crash; 0: at most once
+    MQTT_BRIDGE_QOS = int(os.getenv("MQTT_BRIDGE_QOS", 1))
+    # Bridge instances in the same group share the subscription ($share/<group>/...) and the broker
+    # load-balances messages across them; "" gives every instance all messages
+    MQTT_BRIDGE_SHARE_GROUP = os.getenv("MQTT_BRIDGE_SHARE_GROUP", "battery-bridge")
+    # Stable per instance, so a restarted instance resumes its session and gets its unacknowledged messages
+    MQTT_BRIDGE_CLIENT_ID = os.getenv("MQTT_BRIDGE_CLIENT_ID", f"battery-bridge-{socket.gethostname()}")
+    # "5", or "3.1.1" for brokers without MQTT v5 (no receive maximum; shared subscriptions if the broker has them)
+    MQTT_BRIDGE_PROTOCOL = os.getenv("MQTT_BRIDGE_PROTOCOL", "5")
+    MQTT_BRIDGE_SESSION_EXPIRY = int(os.getenv("MQTT_BRIDGE_SESSION_EXPIRY", 3600))  # seconds; 0: clean sessions
+    # Unacknowledged messages the broker may send an instance at once (capped by MQTT_BRIDGE_QUEUE_SIZE)
+    MQTT_BRIDGE_RECEIVE_MAXIMUM = int(os.getenv("MQTT_BRIDGE_RECEIVE_MAXIMUM", 5000))
+    MQTT_BRIDGE_RETRY_INTERVAL_MS = int(os.getenv("MQTT_BRIDGE_RETRY_INTERVAL_MS", 500))
+    MQTT_BRIDGE_MAX_RETRY_DELAY_MS = int(os.getenv("MQTT_BRIDGE_MAX_RETRY_DELAY_MS", 30000))
 
     API_URL_READ = "http://flask-app:5003/read"
     API_URL_LIVE = "http://flask-app:5003/livedata"
+    API_URL_LIVE_STREAM = "http://flask-app:5003/livedata/stream"
     WRITE_ENDPOINT_CHARGE = "http://localhost:5003/charge"
 
     @staticmethod
@@ -0,0 +1,140 @@
+from datetime import datetime
+
+import numpy as np
+
+METHODS = ("lttb", "minmax")
+
+
+def lttb(x, y, n):
+    """
+    Largest-Triangle-Three-Buckets: pick ``n`` points that keep the visual shape of a series.
+
+    The first and last points are always kept. The rest is split into ``n - 2`` buckets
+    and from each bucket the point forming the largest triangle with the point kept
+    from the previous bucket and the average of the next bucket is chosen. Bucket
+    averages are computed for all buckets at once; only the per-bucket argmax walks the
+    buckets, because each choice depends on the previous one.
+
+    Args:
+        x: Sorted positions (e.g. epoch nanoseconds) as a 1-D array.
+        y: Values as a 1-D array without NaNs.
+        n: Number of points to keep.
+
+    Returns:
+        Sorted integer indices into ``x``/``y``.
+    """
+    size = len(x)
+    if n >= size or n < 3:
+        return np.arange(size)
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+
+    # Bucket i covers [edges[i], edges[i + 1]) of the points between the first and the last
+    edges = np.floor(np.linspace(1, size - 1, n - 1)).astype(np.int64)
+    counts = np.diff(edges)
+    avg_x = np.add.reduceat(x[:-1], edges[:-1]) / counts
+    avg_y = np.add.reduceat(y[:-1], edges[:-1]) / counts
+    # The point after the last bucket is the final point itself
+    next_x = np.append(avg_x[1:], x[-1])
+    next_y = np.append(avg_y[1:], y[-1])
+
+    selected = np.empty(n, dtype=np.int64)
+    selected[0], selected[-1] = 0, size - 1
+    anchor = 0
+    for i in range(n - 2):
+        lo, hi = edges[i], edges[i + 1]
+        ax, ay = x[anchor], y[anchor]
+        area = np.abs((ax - next_x[i]) * (y[lo:hi] - ay) - (ax - x[lo:hi]) * (next_y[i] - ay))
+        anchor = lo + int(np.argmax(area))
+        selected[i + 1] = anchor
+    return selected
+
+
+def min_max(y, n):
+    """
+    Min/max envelope: keep the lowest and highest point of ``n // 2`` equal-count buckets.
+
+    Cheaper than LTTB and guarantees that every peak and trough survives.
+
+    Args:
+        y: Values as a 1-D array without NaNs.
+        n: Number of points to keep.
+
+    Returns:
+        Sorted integer indices into ``y``.
+    """
+    size = len(y)
+    buckets = n // 2
+    if n >= size or buckets < 1:
+        return np.arange(size)
+    width = -(-size // buckets)
+    padded = np.full(buckets * width, np.nan)
+    padded[:size] = y
+    grid = padded.reshape(buckets, width)
+    rows = [row for row in range(buckets) if row * width < size]
+    offsets = np.arange(buckets)[rows] * width
+    lows = offsets + np.nanargmin(grid[rows], axis=1)
+    highs = offsets + np.nanargmax(grid[rows], axis=1)
+    return np.unique(np.concatenate([lows, highs]))
+
+
+def select(x, columns, n, method="lttb"):
+    """
+    Indices of the rows to keep so that every column stays recognizable with ``n`` points.
+
+    Each column is downsampled over its own non-missing values with an equal share of
+    ``n``; the union of the chosen rows is returned.
+
+    Args:
+        x: Sorted positions of the rows.
+        columns: Iterable of value arrays, NaN where a row has no value.
+        n: Point budget.
+        method: "lttb" or "minmax".
+
+    Returns:
+        Sorted integer row indices.
+
+    Raises:
+        ValueError: If the method is unknown.
+    """
+    if method not in METHODS:
+        raise ValueError(f"Invalid downsampling method '{method}', expected one of {', '.join(METHODS)}")
+    x = np.asarray(x, dtype=float)
+    columns = [np.asarray(values, dtype=float) for values in columns]
+    present = [np.flatnonzero(~np.isnan(values)) for values in columns]
+    present = [rows for rows in present if rows.size]
+    if not present:
+        return np.arange(len(x))
+
+    share = max(n // len(present), 3)
+    kept = []
+    for values, rows in zip(columns, present):
+        if method == "lttb":
+            chosen = lttb(x[rows], values[rows], share)
+        else:
+            chosen = min_max(values[rows], share)
+        kept.append(rows[chosen])
+    return np.unique(np.concatenate(kept))
+
+
+def downsample_rows(rows, n, method="lttb", fields=("charge", "discharge")):
+    """
+    Downsample /read rows (dicts with an ISO "time" and value fields) to about ``n`` rows.
+    Rows of different batteries are downsampled separately, sharing the budget.
+
+    Returns:
+        The kept rows, in their original order.
+    """
+    if len(rows) <= n:
+        return rows
+    groups = {}
+    for index, row in enumerate(rows):
+        groups.setdefault(row.get("battery_id"), []).append(index)
+
+    share = max(n // len(groups), 3)
+    kept = []
+    for indices in groups.values():
+        x = np.array([datetime.fromisoformat(rows[i]["time"]).timestamp() for i in indices])
+        columns = [[np.nan if rows[i].get(field) is None else rows[i][field] for i in indices] for field in fields]
+        kept.extend(indices[i] for i in select(x, columns, share, method))
+    return [rows[i] for i in sorted(kept)]
@@ -1,33 +1,133 @@
-import paho.mqtt.client as mqtt
-from flask import Flask
-from influxdb_client import WriteApi, QueryApi
-import threading
+import time
+
+from flask import Flask, g, request
+from influxdb_client import InfluxDBClient, WriteApi, QueryApi
 from src.core.config import Config
+from src.core.log import get_logger
+from src.core.metrics import REGISTRY
+from src.services.hot_store import create_hot_store
+from src.services.live_broadcast import LiveBroadcaster
+from src.services.live_state import create_live_state
+from src.services.read_cache import ReadCache
+
+log = get_logger(__name__)
+
+_REQUEST_SECONDS = REGISTRY.histogram(
+    "api_request_duration_seconds", "Time to produce an API response (until streaming starts)", ("method", "route"))
+_REQUESTS = REGISTRY.counter("api_requests_total", "API responses, by route and status", ("method", "route", "status"))
 
 
 class FlaskWrapper(Flask):
+    influx_client: InfluxDBClient
     write_api: WriteApi
     query_api: QueryApi
-    mqtt_client: mqtt.Client  # Add MQTT client as an attribute
+    mqtt_publisher: "MqttPublisher"  # Persistent MQTT publisher shared by all requests
+    command_conflator: "CommandConflator"  # Publishes the newest /charge and /discharge command per topic
+    command_limiter: "CommandRateLimiter"  # Per-battery token buckets for /charge and /discharge
+    read_cache: ReadCache  # Write-versioned /read response cache
+    live_state: "MemoryLiveState | SharedMemoryLiveState"  # Latest values per battery
+    live_broadcaster: LiveBroadcaster  # Pushes live-state changes to /livedata/stream clients
+    rollup_tiers: list  # RollupTiers usable by /stats
+    write_compressor: "RecordCompressor | None"  # Deadband/swinging-door filter of written values
+    hot_store: "HotStore | None"  # Recent raw points answering /read without InfluxDB
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        self.clients_started = False
+        self.before_request(self._start_request_timer)
+        self.after_request(self._observe_request)
+
+    def start_clients(self, create_rollups=True):
+        """
+        Create the InfluxDB and MQTT clients and the live-state and hot-store handles, and
+        start warming the hot store unless another worker already did.
+
+        Sockets, background threads and the live-state lock file must not be shared
+        across fork(), so under a pre-forking server this runs in every worker after
+        it has been forked, not when the app is imported.
+
+        Args:
+            create_rollups: Create or update the rollup tasks, rather than only look
+                them up (the server master already did).
+        """
+        # Imported here to avoid a circular import through src.api
+        from src.services.compression import create_compressor
+        from src.services.influx_service import setup_influxdb
+
+        if self.clients_started:
+            return
+        self.live_state = create_live_state()
+        self.live_broadcaster = LiveBroadcaster(self.live_state)
+        self.read_cache = ReadCache(write_versions=self.live_state)
+        self.write_compressor = create_compressor()
+        self.hot_store = create_hot_store()
+        setup_influxdb(self, create_rollups=create_rollups)
+        if self.hot_store is not None:
+            if hasattr(self.write_api, "on_drop"):
+                self.write_api.on_drop = self.hot_store.add_dropped
+            self.hot_store.start_warming(self.query_api, Config.INFLUXDB_BUCKET)
         self.setup_mqtt()
+        self.clients_started = True
 
     def setup_mqtt(self):
         """
-        Initialize MQTT client for publishing messages.
+        Initialize the persistent MQTT publisher pool and the command conflation in front of it.
+        Connecting happens in paho's background thread, so startup does not block on the broker.
         """
+        # Imported here to avoid a circular import through src.api
+        from src.api.conflation import CommandConflator, CommandRateLimiter
+        from src.api.mqtt_publisher import MqttPublisher
+
+        self.mqtt_publisher = MqttPublisher()
+        self.mqtt_publisher.start()
+        self.command_conflator = CommandConflator(self.mqtt_publisher)
+        self.command_conflator.start()
+        self.command_limiter = CommandRateLimiter()
+
+    def shutdown(self):
+        """
+        Flush buffered writes and disconnect the clients; safe to call more than once.
+        Runs when a server worker exits (including on SIGTERM) and at interpreter exit.
+        """
+        if not self.clients_started:
+            return
+        self.clients_started = False
+        log.info("🛑 Shutting down: flushing pending writes")
+        if self.write_compressor is not None:
+            self._write_held_values()
+        if hasattr(self.write_api, "close"):
+            self.write_api.close()
+        if getattr(self, "command_conflator", None) is not None:
+            self.command_conflator.stop()
+        if getattr(self, "mqtt_publisher", None) is not None:
+            self.mqtt_publisher.stop()
+        self.influx_client.close()
+        self.live_state.close()
+        if self.hot_store is not None:
+            self.hot_store.close()
+
+    def _write_held_values(self):
+        """Store the values write compression still holds back."""
+        from src.services.influx_service import record_point, write_point
 
-        self.mqtt_client = mqtt.Client()
+        held = self.write_compressor.flush()
+        if not held:
+            return
+        try:
+            write_point(self.write_api, Config.INFLUXDB_BUCKET, Config.INFLUXDB_ORG, [record_point(r) for r in held])
+        except Exception as e:
+            log.error(f"❌ Could not write {len(held)} held values: {e}")
 
-        def connect_mqtt():
-            try:
-                print(f"✅ Connecting Flask to MQTT broker at {Config.MQTT_BROKER}:{Config.MQTT_PORT}...")
-                self.mqtt_client.connect(Config.MQTT_BROKER, Config.MQTT_PORT)
-                self.mqtt_client.loop_start()  # Start non-blocking loop
-            except Exception as e:
-                print(f"❌ MQTT Connection failed: {e}")
+    @staticmethod
+    def _start_request_timer():
+        g.request_started = time.perf_counter()
 
-        # Run MQTT connection in a separate thread
-        threading.Thread(target=connect_mqtt, daemon=True).start()
+    @staticmethod
+    def _observe_request(response):
+        started = g.pop("request_started", None)
+        if started is not None:
+            # The URL rule, not the path, so /metrics has one series per endpoint
+            route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+            _REQUEST_SECONDS.labels(request.method, route).observe(time.perf_counter() - started)
+            _REQUESTS.labels(request.method, route, response.status_code).inc()
+        return response
@@ -0,0 +1,88 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+
+from src.core.config import Config
+
+# LogRecord attributes that are not structured fields passed with ``extra=``
+_STANDARD = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+_queue_handler = None
+_listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, message and the ``extra=`` fields."""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S") + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update((key, value) for key, value in vars(record).items() if key not in _STANDARD)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class TextFormatter(logging.Formatter):
+    """``time level logger: message key=value ...`` for reading logs in a terminal."""
+
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    def format(self, record):
+        line = super().format(record)
+        fields = [f"{key}={value}" for key, value in vars(record).items() if key not in _STANDARD]
+        return f"{line} {' '.join(fields)}" if fields else line
+
+
+def configure_logging(level=None, fmt=None):
+    """
+    Route all ``src`` loggers to stdout through a queue.
+
+    Callers only put the record on an in-memory queue; a background listener thread
+    formats and writes it, so request and message handlers never wait on stdout.
+    ``LOG_LEVEL`` selects the level (DEBUG logs every message) and ``LOG_FORMAT``
+    "text" or "json".
+    """
+    global _queue_handler
+    if _queue_handler is not None:
+        return
+
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(JsonFormatter() if (fmt or Config.LOG_FORMAT) == "json" else TextFormatter())
+    _queue_handler = logging.handlers.QueueHandler(queue.Queue(-1))
+    _start_listener(handler)
+    # The listener thread does not survive fork(); forked server workers start their own
+    os.register_at_fork(after_in_child=lambda: _start_listener(handler))
+    atexit.register(_stop_listener)
+
+    logger = logging.getLogger("src")
+    logger.setLevel((level or Config.LOG_LEVEL).upper())
+    logger.addHandler(_queue_handler)
+    logger.propagate = False
+
+
+def _start_listener(handler):
+    global _listener
+    _queue_handler.queue = queue.Queue(-1)
+    _listener = logging.handlers.QueueListener(_queue_handler.queue, handler)
+    _listener.start()
+
+
+def _stop_listener():
+    """Write out the records still queued."""
+    if _listener is not None and _listener._thread is not None:
+        _listener.stop()
+
+
+def get_logger(name):
+    """Logger for a module (pass ``__name__``); logging is configured on first use."""
+    configure_logging()
+    return logging.getLogger(name)
@@ -0,0 +1,177 @@
+"""
+Prometheus metrics of the API and the MQTT bridge, on top of ``prometheus_client``.
+
+Modules register their metrics with ``REGISTRY`` at import time. Under gunicorn the
+API runs in ``prometheus_client``'s multiprocess mode: ``gunicorn_conf`` points
+``PROMETHEUS_MULTIPROC_DIR`` at ``METRICS_DIR`` before anything imports the library,
+every worker records into its own files there and ``render`` adds them up, so a scrape
+of any worker returns the totals. Counters and histograms of workers that exited are
+kept, so totals never go backwards; their gauges are dropped.
+"""
+import os
+import threading
+import time
+
+import prometheus_client
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, generate_latest, multiprocess
+
+from src.core.log import get_logger
+
+log = get_logger(__name__)
+
+# Seconds; spans an in-memory enqueue (sub-millisecond) up to a slow InfluxDB request
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CONTENT_TYPE = CONTENT_TYPE_LATEST
+MULTIPROCESS_ENV = "PROMETHEUS_MULTIPROC_DIR"
+
+# How the gauges of several processes combine in multiprocess mode
+_MULTIPROCESS_MODES = {"sum": "livesum", "max": "livemax"}
+
+# The *_created series add nothing to the dashboards and do not exist in multiprocess mode
+prometheus_client.disable_created_metrics()
+
+
+class Gauge(prometheus_client.Gauge):
+    """
+    Gauge whose ``set_function`` callback is sampled by ``Registry.refresh`` and stored
+    like a ``set``. Unlike ``prometheus_client``'s own callback gauges this also works in
+    multiprocess mode, where values are read from the workers' files.
+    """
+
+    _function = None
+
+    def set_function(self, function):
+        """Read the value from ``function()`` when metrics are collected; None stops it (value 0)."""
+        self._function = function
+        if function is None:
+            self.set(0)
+
+    def refresh(self):
+        if self._function is None:
+            return
+        try:
+            value = float(self._function())
+        except Exception:
+            value = float("nan")
+        self.set(value)
+
+
+class Registry:
+    """The metrics of a process and their exposition, see the module docstring."""
+
+    def __init__(self):
+        self.collectors = CollectorRegistry(auto_describe=True)
+        self.metrics = {}
+        self._gauges = []
+        self._lock = threading.Lock()
+        self._refresher = None
+        self._pid = None
+        # Registered first, so callback gauges are current when the others are collected
+        self.collectors.register(_Refresh(self))
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._get(prometheus_client.Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=(), merge="sum"):
+        """
+        A gauge; ``merge="max"`` reports the largest value of all processes instead of their
+        sum, for values every process observes of the same shared resource.
+        """
+        gauge = self._get(Gauge, name, documentation, labelnames,
+                          multiprocess_mode=_MULTIPROCESS_MODES[merge])
+        with self._lock:
+            if gauge not in self._gauges:
+                self._gauges.append(gauge)
+        return gauge
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._get(prometheus_client.Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def refresh(self):
+        """Sample the callbacks of this process's gauges."""
+        with self._lock:
+            gauges = list(self._gauges)
+        for gauge in gauges:
+            gauge.refresh()
+
+    def start_refreshing(self, interval=1.0):
+        """
+        Sample the callback gauges every ``interval`` seconds from a background thread, so
+        scrapes served by other workers see this one's values. Call it in every process
+        after fork; the thread does not survive a fork.
+        """
+        if self._refresher is None or self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._refresher = threading.Thread(target=self._refresh_loop, args=(interval,),
+                                               name="metrics-refresher", daemon=True)
+            self._refresher.start()
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format, of all processes in multiprocess mode."""
+        if not os.environ.get(MULTIPROCESS_ENV):
+            return generate_latest(self.collectors)
+        self.refresh()
+        merged = CollectorRegistry()
+        multiprocess.MultiProcessCollector(merged)
+        return generate_latest(merged)
+
+    def _get(self, kind, name, documentation, labelnames, **options):
+        with self._lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = kind(name, documentation, tuple(labelnames), registry=self.collectors,
+                                                   **options)
+            elif type(metric) is not kind or metric._labelnames != tuple(labelnames):
+                raise ValueError(f"Metric {name} is already registered with a different type or labels")
+            return metric
+
+    def _refresh_loop(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.refresh()
+            except Exception as e:
+                log.error(f"❌ Could not refresh metrics: {e}")
+
+
+class _Refresh:
+    """Collector without metrics of its own that refreshes the callback gauges."""
+
+    def __init__(self, registry):
+        self.registry = registry
+
+    def collect(self):
+        self.registry.refresh()
+        return []
+
+
+def start_metrics_server(port, host="0.0.0.0", registry=None):
+    """
+    Serve ``/metrics`` on its own port from a background thread, for processes
+    without an HTTP API such as the MQTT bridge.
+
+    Returns:
+        The running server (``shutdown()`` stops it).
+    """
+    server, _thread = prometheus_client.start_http_server(port, addr=host,
+                                                          registry=(registry or REGISTRY).collectors)
+    log.info(f"✅ Serving metrics on {host}:{port}/metrics")
+    return server
+
+
+def clear_directory(directory):
+    """Remove the metric files of a previous run, so counters start from zero with the server."""
+    os.makedirs(directory, exist_ok=True)
+    for name in os.listdir(directory):
+        if name.endswith(".db"):
+            os.remove(os.path.join(directory, name))
+
+
+def mark_process_dead(pid):
+    """Drop the live gauges of an exited worker (multiprocess mode only)."""
+    if os.environ.get(MULTIPROCESS_ENV):
+        multiprocess.mark_process_dead(pid)
+
+
+# The process-wide registry every module registers its metrics with
+REGISTRY = Registry()
@@ -0,0 +1,136 @@
+"""
+Wire formats of /read results.
+
+"json" is the original array of row objects. "columns" is one JSON array per field,
+with times as epoch milliseconds. "arrow" is an Apache Arrow IPC stream with times as
+timestamp[ns, UTC] and values as float64 with NaN for missing values, so a client maps
+the columns onto numpy arrays without copying. Any of them can be compressed with gzip
+or, if the ``zstandard`` package is installed, zstd.
+"""
+import gzip
+from datetime import datetime, timezone
+
+import pyarrow as pa
+
+try:
+    import zstandard
+except ImportError:  # optional: without it only gzip is offered
+    zstandard = None
+
+FORMATS = {
+    "json": "application/json",
+    "ndjson": "application/x-ndjson",
+    "columns": "application/vnd.battery.columns+json",
+    "arrow": "application/vnd.apache.arrow.stream",
+}
+VALUE_COLUMNS = ("charge", "discharge")
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_GZIP_LEVEL = 5
+_ZSTD_LEVEL = 3
+
+
+def negotiate_format(requested, accept):
+    """
+    Pick the representation of a /read response.
+
+    Args:
+        requested: The ``format`` query parameter, which takes precedence, or None.
+        accept: The request's ``Accept`` header (werkzeug MIMEAccept).
+
+    Returns:
+        One of the FORMATS keys.
+
+    Raises:
+        ValueError: If ``requested`` is not a known format.
+    """
+    if requested:
+        if requested not in FORMATS:
+            raise ValueError(f"Invalid format '{requested}', expected one of {', '.join(FORMATS)}")
+        return requested
+    # application/json first, so */* and missing Accept headers keep getting rows
+    best = accept.best_match(list(FORMATS.values()), default=FORMATS["json"])
+    return next(fmt for fmt, mimetype in FORMATS.items() if mimetype == best)
+
+
+def negotiate_encoding(accept_encoding):
+    """
+    Content coding for a response: "zstd" or "gzip", by the client's preference
+    (zstd on ties), or None to send it uncompressed.
+
+    Args:
+        accept_encoding: The request's ``Accept-Encoding`` header (werkzeug Accept).
+    """
+    offered = [encoding for encoding in ("zstd", "gzip") if encoding != "zstd" or zstandard is not None]
+    best = max(offered, key=lambda encoding: accept_encoding[encoding])
+    return best if accept_encoding[best] > 0 else None
+
+
+def compress(body, encoding):
+    """Compress a response body (str or bytes) with "gzip" or "zstd"."""
+    if isinstance(body, str):
+        body = body.encode()
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=_ZSTD_LEVEL).compress(body)
+    return gzip.compress(body, compresslevel=_GZIP_LEVEL, mtime=0)
+
+
+def serialize(rows, fmt, dumps):
+    """
+    Serialize /read rows in a non-streaming format.
+
+    Args:
+        rows: List of dicts with an ISO "time", "charge", "discharge" and, when reading
+            all batteries, "battery_id".
+        fmt: "json", "columns" or "arrow".
+        dumps: JSON serializer for the JSON formats.
+
+    Returns:
+        The body, str for the JSON formats and bytes for Arrow.
+    """
+    if fmt == "json":
+        return dumps(rows)
+    if fmt == "columns":
+        return dumps(to_columns(rows))
+    if fmt == "arrow":
+        return to_arrow(rows)
+    raise ValueError(f"Format '{fmt}' cannot be served as one body")
+
+
+def to_columns(rows):
+    """
+    Rows as {"time": [epoch ms], "charge": [...], "discharge": [...]} (plus
+    "battery_id" when the rows carry it); missing values are null.
+    """
+    columns = {"time": [_epoch_us(row["time"]) // 1000 for row in rows]}
+    for column in VALUE_COLUMNS:
+        columns[column] = [row.get(column) for row in rows]
+    if rows and "battery_id" in rows[0]:
+        columns["battery_id"] = [row.get("battery_id") for row in rows]
+    return columns
+
+
+def to_arrow(rows):
+    """Rows as an Arrow IPC stream (a single record batch)."""
+    arrays = {"time": pa.array([_epoch_us(row["time"]) * 1000 for row in rows], pa.timestamp("ns", tz="UTC"))}
+    for column in VALUE_COLUMNS:
+        arrays[column] = pa.array([_nan_if_none(row.get(column)) for row in rows], pa.float64())
+    if rows and "battery_id" in rows[0]:
+        arrays["battery_id"] = pa.array([row.get("battery_id") for row in rows], pa.string()).dictionary_encode()
+    batch = pa.RecordBatch.from_pydict(arrays)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, batch.schema) as writer:
+        writer.write_batch(batch)
+    return sink.getvalue().to_pybytes()
+
+
+def _epoch_us(iso):
+    moment = datetime.fromisoformat(iso)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    delta = moment - _EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1_000_000 + delta.microseconds
+
+
+def _nan_if_none(value):
+    return float("nan") if value is None else value
@@ -0,0 +1,67 @@
+import random
+import time
+import uuid
+
+from src.core.config import Config
+
+TRACE_FIELD = "trace"
+TRACE_MEASUREMENT = "message_trace"
+
+# Pipeline order of the stage timestamps a trace can carry:
+#   api_received     /charge or /discharge accepted the command
+#   published        handed to the MQTT publisher
+#   bridge_received  the bridge's network loop received the message
+#   bridge_sent      the bridge handed the decoded record to its sink
+#   write_received   the write endpoint parsed the record
+#   stored           the write pipeline accepted the point (buffered or spooled, see INFLUXDB_WRITE_MODE)
+#   live             the value is visible in /livedata
+STAGES = ("api_received", "published", "bridge_received", "bridge_sent", "write_received", "stored", "live")
+
+
+def start_trace(force=False):
+    """
+    Start a trace envelope for a new message, if it is sampled.
+
+    ``TRACE_SAMPLE_RATE`` is the fraction of messages traced; ``force`` traces the
+    message regardless.
+
+    Returns:
+        ``{"id": ..., "stages": {"api_received": <epoch ns>}}``, or None if the message is not traced.
+    """
+    if not force and (Config.TRACE_SAMPLE_RATE <= 0 or random.random() >= Config.TRACE_SAMPLE_RATE):
+        return None
+    return {"id": uuid.uuid4().hex, "stages": {"api_received": time.time_ns()}}
+
+
+def mark(trace, stage, at=None):
+    """Record that the message reached ``stage`` now (or at epoch nanoseconds ``at``)."""
+    trace["stages"][stage] = time.time_ns() if at is None else at
+    return trace
+
+
+def get_trace(record):
+    """
+    The trace envelope carried by a decoded message.
+
+    Returns:
+        The envelope, or None if the record is untraced or its envelope is malformed.
+    """
+    trace = record.get(TRACE_FIELD) if isinstance(record, dict) else None
+    if isinstance(trace, dict) and isinstance(trace.get("id"), str) and isinstance(trace.get("stages"), dict):
+        return trace
+    return None
+
+
+def stage_durations(trace):
+    """
+    Milliseconds spent reaching each recorded stage from the previous recorded one.
+
+    Timestamps come from different processes (and possibly hosts), so hops between
+    hosts include their clock offset.
+
+    Returns:
+        List of (stage, milliseconds) in pipeline order; the first stage is omitted.
+    """
+    stages = trace["stages"]
+    recorded = [(stage, stages[stage]) for stage in STAGES if isinstance(stages.get(stage), int)]
+    return [(stage, (at - previous) / 1e6) for (_, previous), (stage, at) in zip(recorded, recorded[1:])]
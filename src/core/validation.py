@@ -0,0 +1,228 @@
+import math
+import re
+import time
+from datetime import datetime, timezone
+
+from dateutil.parser import isoparse
+
+from src.core.battery import validate_battery_id
+
+# YYYY-MM-DDTHH:MM:SS[.fraction](Z|±HH:MM), the form every client of this API sends
+_RFC3339 = re.compile(
+    r"(\d{4})-(\d{2})-(\d{2})[Tt ](\d{2}):(\d{2}):(\d{2})(?:\.(\d{1,9}))?"
+    r"(?:([Zz])|([+-])([01]\d|2[0-3]):([0-5]\d))?"
+)
+_DAYS_IN_MONTH = (31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+_NS = 1_000_000_000
+_EPOCH_DAYS = 719468  # days from 0000-03-01 to 1970-01-01 in the proleptic Gregorian calendar
+# Integer timestamps are epoch nanoseconds (binary MQTT payloads); smaller integers would be
+# seconds, milliseconds or microseconds, larger ones overflow InfluxDB's int64 times
+_MIN_INT_TIMESTAMP = 10 ** 17  # 1973-03-03
+_MAX_INT_TIMESTAMP = 2 ** 63 - 1
+# Line-protocol field values the battery_data fields accept: floats and integers (5i or 5u)
+_LP_FLOAT = re.compile(r"-?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?")
+_LP_INTEGER = re.compile(r"-?\d+[iu]")
+MAX_UNIT_LENGTH = 12  # the shared-memory live state stores units in 12 bytes
+
+
+def parse_timestamp_ns(value):
+    """
+    Parse a timestamp into integer nanoseconds since the epoch (UTC).
+
+    RFC 3339 timestamps are handled by a strict precompiled pattern and integer
+    arithmetic; any other ISO 8601 form falls back to dateutil's ``isoparse``.
+    Timestamps without an offset are taken as UTC.
+
+    Raises:
+        ValueError: If the value is not a valid timestamp.
+    """
+    if not isinstance(value, str):
+        raise ValueError(f"Invalid timestamp: {value!r}")
+    match = _RFC3339.fullmatch(value)
+    if match is None:
+        return _parse_fallback(value)
+
+    year, month, day, hour, minute, second, fraction, zulu, sign, off_hour, off_minute = match.groups()
+    year, month, day = int(year), int(month), int(day)
+    hour, minute, second = int(hour), int(minute), int(second)
+    if not (1 <= month <= 12 and 1 <= day <= _DAYS_IN_MONTH[month - 1] and hour <= 23 and minute <= 59
+            and second <= 59) or (month == 2 and day == 29 and not _is_leap(year)):
+        raise ValueError(f"Invalid timestamp: {value!r}")
+
+    seconds = _days_from_civil(year, month, day) * 86400 + hour * 3600 + minute * 60 + second
+    if sign:
+        offset = int(off_hour) * 3600 + int(off_minute) * 60
+        seconds -= offset if sign == "+" else -offset
+    nanos = int(fraction.ljust(9, "0")) if fraction else 0
+    return seconds * _NS + nanos
+
+
+def now_ns():
+    """Current time in nanoseconds, truncated to whole seconds like timestamps the API assigns."""
+    return time.time_ns() // _NS * _NS
+
+
+def ns_to_datetime(ns):
+    """Timezone-aware UTC datetime of epoch nanoseconds (microsecond precision)."""
+    return datetime.fromtimestamp(ns // _NS, timezone.utc).replace(microsecond=ns % _NS // 1000)
+
+
+class ValidRecord:
+    """A validated charge/discharge record, ready to be turned into a point."""
+
+    __slots__ = ("values", "unit", "time_ns", "battery_id")
+
+    def __init__(self, values, unit, time_ns, battery_id):
+        self.values = values  # tuple of (field, value) pairs that are present
+        self.unit = unit
+        self.time_ns = time_ns
+        self.battery_id = battery_id
+
+    @property
+    def moment(self):
+        return ns_to_datetime(self.time_ns)
+
+
+class RecordSchema:
+    """
+    Precompiled checks for one JSON payload shape.
+
+    Args:
+        fields: Numeric value fields the payload may carry.
+        required: Field that must be present, or None to require at least one of ``fields``.
+    """
+
+    def __init__(self, fields, required=None):
+        self.fields = tuple(fields)
+        self.required = required
+        if required is not None:
+            self._missing = f"Missing '{required}' field"
+        else:
+            self._missing = f"Record needs a {' or '.join(repr(f) for f in self.fields)} value"
+
+    def validate(self, data):
+        """
+        Check a decoded JSON payload.
+
+        Returns:
+            ValidRecord with the values, unit, timestamp (an RFC 3339 string or integer
+            epoch nanoseconds in the payload, now when omitted) and battery id.
+
+        Raises:
+            ValueError: If the payload is not an object, misses values, has values of the
+                wrong type or not finite, or an integer timestamp that is not in epoch
+                nanoseconds.
+        """
+        if not isinstance(data, dict):
+            raise ValueError("Invalid payload: expected a JSON object")
+        if self.required is not None and data.get(self.required) is None:
+            raise ValueError(self._missing)
+
+        values = []
+        for field in self.fields:
+            value = data.get(field)
+            if value is None:
+                continue
+            if type(value) is not int and type(value) is not float:
+                raise ValueError(f"'{field}' must be a number")
+            if type(value) is float and not math.isfinite(value):
+                raise ValueError(f"'{field}' must be a finite number")
+            values.append((field, value))
+        if not values:
+            raise ValueError(self._missing)
+
+        unit = data.get("unit")
+        if unit is not None and not isinstance(unit, str):
+            raise ValueError("'unit' must be a string")
+        if unit is not None and (len(unit) > MAX_UNIT_LENGTH or not unit.isascii()):
+            raise ValueError(f"'unit' must be at most {MAX_UNIT_LENGTH} ASCII characters")
+        timestamp = data.get("timestamp")
+        if timestamp is None:
+            time_ns = now_ns()
+        elif type(timestamp) is int:
+            # Epoch nanoseconds, as decoded from binary MQTT payloads and forwarded by the bridge
+            if not _MIN_INT_TIMESTAMP <= timestamp <= _MAX_INT_TIMESTAMP:
+                raise ValueError(f"Integer timestamp {timestamp} is not in epoch nanoseconds; "
+                                 "send an RFC 3339 string instead")
+            time_ns = timestamp
+        else:
+            time_ns = parse_timestamp_ns(timestamp)
+        return ValidRecord(tuple(values), unit, time_ns, validate_battery_id(data.get("battery_id")))
+
+
+CHARGE_SCHEMA = RecordSchema(("charge",), required="charge")
+DISCHARGE_SCHEMA = RecordSchema(("discharge",), required="discharge")
+BATTERY_RECORD_SCHEMA = RecordSchema(("charge", "discharge"))
+
+
+def parse_line_protocol(line):
+    """
+    Parse and validate one line-protocol record of the battery_data measurement.
+
+    The only tag is ``battery_id`` (the default battery when omitted), the fields are
+    numeric ``charge`` and/or ``discharge``, and the optional timestamp is in epoch
+    nanoseconds. Escapes and quoted strings never occur in valid records and are rejected.
+
+    Returns:
+        ValidRecord, as ``BATTERY_RECORD_SCHEMA`` returns it for the same JSON record.
+
+    Raises:
+        ValueError: If the line is not such a record.
+    """
+    if "\\" in line or '"' in line:
+        raise ValueError("Line protocol record has escapes or string values, which battery_data does not use")
+    parts = line.split(" ")
+    if len(parts) not in (2, 3) or not all(parts):
+        raise ValueError("Line protocol record needs '<measurement>[,tags] <fields> [timestamp]'")
+    series, field_set = parts[0], parts[1]
+    measurement, *tags = series.split(",")
+    if measurement != "battery_data":
+        raise ValueError(f"Unexpected measurement '{measurement}', expected 'battery_data'")
+
+    data = {}
+    for tag in tags:
+        key, _, value = tag.partition("=")
+        if key != "battery_id" or "battery_id" in data:
+            raise ValueError(f"Unexpected tag '{key}', battery_data only has 'battery_id'")
+        data["battery_id"] = value
+    for field in field_set.split(","):
+        key, _, value = field.partition("=")
+        if key not in ("charge", "discharge") or key in data:
+            raise ValueError(f"Unexpected field '{key}', expected 'charge' and/or 'discharge'")
+        if _LP_INTEGER.fullmatch(value):
+            data[key] = int(value[:-1])
+        elif _LP_FLOAT.fullmatch(value):
+            data[key] = float(value)
+        else:
+            raise ValueError(f"'{key}' must be a number, got {value!r}")
+    if len(parts) == 3:
+        if not _LP_INTEGER.fullmatch(parts[2] + "i") \
+                or not _MIN_INT_TIMESTAMP <= int(parts[2]) <= _MAX_INT_TIMESTAMP:
+            raise ValueError(f"Invalid line protocol timestamp {parts[2]!r}: expected epoch nanoseconds")
+        data["timestamp"] = int(parts[2])
+    return BATTERY_RECORD_SCHEMA.validate(data)
+
+
+def _parse_fallback(value):
+    try:
+        moment = isoparse(value)
+    except (OverflowError, ValueError):
+        raise ValueError(f"Invalid timestamp: {value!r}")
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    delta = moment - datetime(1970, 1, 1, tzinfo=timezone.utc)
+    return (delta.days * 86400 + delta.seconds) * _NS + delta.microseconds * 1000
+
+
+def _is_leap(year):
+    return year % 4 == 0 and (year % 100 != 0 or year % 400 == 0)
+
+
+def _days_from_civil(year, month, day):
+    """Days since 1970-01-01 of a Gregorian date (Howard Hinnant's algorithm)."""
+    year -= month <= 2
+    era = year // 400
+    year_of_era = year - era * 400
+    day_of_year = (153 * (month + (-3 if month > 2 else 9)) + 2) // 5 + day - 1
+    day_of_era = year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year
+    return era * 146097 + day_of_era - _EPOCH_DAYS
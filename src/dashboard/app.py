@@ -1,33 +1,119 @@
+import json
+import os
 import time
 import streamlit as st
+import numpy as np
 import pandas as pd
 import plotly.graph_objects as go
+import pyarrow as pa
 import requests
+from src.core.downsample import select
+from src.dashboard.ring_buffer import COLUMNS, RingBuffer
 
 API_URL_READ = "http://flask-app:5003/read"
 API_URL_LIVE = "http://flask-app:5003/livedata"
+API_URL_STATS = "http://flask-app:5003/stats"
+API_URL_LIVE_STREAM = "http://flask-app:5003/livedata/stream"
+ARROW_STREAM = "application/vnd.apache.arrow.stream"
+# Same variable as the API's Config; read directly, the dashboard image has no Flask
+DEFAULT_BATTERY_ID = os.getenv("DEFAULT_BATTERY_ID", "default")
 
+# Time window shown on the chart and the most rows kept for it
+WINDOW = pd.Timedelta(hours=1)
+BUFFER_CAPACITY = 20000
+# Points per trace sent to the browser, roughly the chart's width in pixels
+CHART_POINTS = 1500
+DOWNSAMPLING = {"LTTB": "lttb", "Min/Max envelope": "minmax", "Off": None}
+# Ranges for the summary statistics; longer ones come from the API's rollups
+STATS_RANGES = {"Chart window (1h)": None, "Last 24h": "-24h", "Last 7 days": "-7d", "Last 30 days": "-30d"}
 
-# Function to fetch time series data from Flask API
-@st.cache_data(ttl=30)  # Cache results for 30 seconds
-def fetch_time_series():
-    response = requests.get(API_URL_READ)
+
+def conditional_get(url, params=None, headers=None, parse=None):
+    """
+    GET an endpoint with If-None-Match, reusing the copy kept in the session on 304.
+    The API answers unchanged polls without touching InfluxDB. Only the latest
+    parameters of each URL are remembered. ``parse`` decodes a 200 response (default: JSON).
+    """
+    cache = st.session_state.setdefault("http_cache", {})
+    key = tuple(sorted((params or {}).items()))
+    cached = cache.get(url)
+    headers = dict(headers or {})
+    if cached and cached[0] == key:
+        headers["If-None-Match"] = cached[1]
+    response = requests.get(url, params=params, headers=headers)
+    if response.status_code == 304:
+        return response, cached[2]
     if response.status_code == 200:
-        return response.json()
-    else:
+        data = parse(response) if parse else response.json()
+        if response.headers.get("ETag"):
+            cache[url] = (key, response.headers["ETag"], data)
+        return response, data
+    return response, None
+
+
+def read_arrow(response):
+    """
+    Decode an Arrow /read response into int64 epoch-ns times and a float64 array per
+    column (NaN for missing). The arrays are views of the Arrow buffers, so no per-row
+    objects are built.
+    """
+    table = pa.ipc.open_stream(response.content).read_all().combine_chunks()
+    if not table.num_rows:
+        return np.empty(0, dtype=np.int64), {column: np.empty(0) for column in COLUMNS}
+    times = table.column("time").chunk(0).view(pa.int64()).to_numpy()
+    return times, {column: table.column(column).chunk(0).to_numpy() for column in COLUMNS}
+
+
+# Function to fetch time series data from Flask API
+def fetch_time_series(battery_id):
+    """
+    Bring the battery's ring buffer up to date and return it.
+
+    Only rows newer than the last buffered one are requested (``/read?since=``), so a
+    refresh transfers and parses the delta instead of the whole window. The rows come as
+    a compressed Arrow stream and go into the buffer column by column.
+    """
+    buffers = st.session_state.setdefault("ring_buffers", {})
+    buffer = buffers.get(battery_id)
+    if buffer is None:
+        buffer = buffers[battery_id] = RingBuffer(BUFFER_CAPACITY)
+
+    params = {"battery_id": battery_id, "begin": "-1h"}
+    if buffer.cursor:
+        params["since"] = buffer.cursor
+    response, data = conditional_get(API_URL_READ, params, headers={"Accept": ARROW_STREAM}, parse=read_arrow)
+    if data is None:
         st.error(f"Failed to fetch data: {response.text}")
-        return []
+    elif response.status_code == 200:
+        buffer.append_columns(*data)
+    buffer.drop_before(pd.Timestamp.now(tz="UTC") - WINDOW)
+    return buffer
+
 
+def fetch_stats(battery_id, begin):
+    """
+    Fetch max/min/mean charge and discharge from /stats, which answers long ranges from
+    precomputed rollups instead of raw rows.
+    """
+    response = requests.get(API_URL_STATS, params={"battery_id": battery_id, "begin": begin})
+    if response.status_code == 200:
+        stats = response.json()
+        # Ranges without data have no min/max/mean; show them like an empty chart window
+        for field in ("charge", "discharge"):
+            stats[field] = {k: float("nan") if v is None else v for k, v in stats[field].items()}
+        return stats
+    st.error(f"Failed to fetch statistics: {response.text}")
+    return None
 
-@st.cache_data(ttl=30)  # Cache for 5 seconds
-def fetch_live_data():
+
+def fetch_live_data(battery_id):
     """
-    Fetch the latest live charge and discharge values from the API.
+    Fetch the latest live charge and discharge values of a battery from the API.
     """
     try:
-        response = requests.get(API_URL_LIVE)
-        if response.status_code == 200:
-            return response.json()
+        response, data = conditional_get(API_URL_LIVE, {"battery_id": battery_id})
+        if data is not None:
+            return data
         else:
             st.error(f"Failed to fetch data: {response.text}")
             return {"charge": None, "discharge": None, "unit": "kW", "timestamp": None}
@@ -36,9 +122,25 @@ def fetch_live_data():
         return {"charge": None, "discharge": None, "unit": "kW", "timestamp": None}
 
 
+def iter_live_events(battery_id):
+    """
+    Yield live charge/discharge snapshots pushed by the API's Server-Sent Events stream.
+    The API sends a keep-alive comment every few seconds, so a dead connection times out.
+    """
+    with requests.get(API_URL_LIVE_STREAM, params={"battery_id": battery_id},
+                      stream=True, timeout=(5, 60)) as response:
+        response.raise_for_status()
+        for line in response.iter_lines(decode_unicode=True):
+            if line and line.startswith("data:"):
+                yield json.loads(line[len("data:"):])
+
+
 # Function to create a Plotly time series chart
-def plot_time_series(data, chart_type):
+def plot_time_series(data, chart_type, method="lttb"):
     df = pd.DataFrame(data)
+    if method and len(df) > CHART_POINTS:
+        x = df["time"].values.astype("datetime64[ns]").astype("int64")
+        df = df.iloc[select(x, [df["charge"].values, df["discharge"].values], CHART_POINTS, method)]
 
     fig = go.Figure()
 
@@ -75,17 +177,18 @@ def plot_time_series(data, chart_type):
 # Streamlit UI
 st.title("📈 Battery Charging Monitoring Dashboard")
 
+# Battery selector
+battery_id = st.sidebar.text_input("🔋 Battery ID", value=DEFAULT_BATTERY_ID).strip() or DEFAULT_BATTERY_ID
+
 # Create placeholders for live data
 charge_metric = st.sidebar.empty()
 discharge_metric = st.sidebar.empty()
 
 # Fetch & Display Data
-data = fetch_time_series()
-livedata = fetch_live_data()
+buffer = fetch_time_series(battery_id)
 
-if data:
-    df = pd.DataFrame(data)
-    df["time"] = pd.to_datetime(df["time"])  # Convert to datetime
+if buffer.size:
+    df = buffer.to_frame()
 
     # Sidebar Filters
     st.sidebar.header("⚙️ Filters")
@@ -93,23 +196,33 @@ if data:
     # Chart Type Selector
     chart_type = st.sidebar.radio("📊 Select Chart Type", ["Line Chart", "Bar Chart"])
 
-    fig = plot_time_series(df, chart_type)
+    # Downsampling keeps the peaks while capping the points Plotly has to render
+    downsampling = st.sidebar.selectbox("📉 Downsampling", list(DOWNSAMPLING))
+
+    fig = plot_time_series(df, chart_type, DOWNSAMPLING[downsampling])
     st.plotly_chart(fig, use_container_width=True)
 
     # Summary Statistics
     st.sidebar.subheader("📊 Summary Statistics")
+    stats_range = st.sidebar.selectbox("🗓️ Statistics range", list(STATS_RANGES))
 
-    st.sidebar.metric("🔼 Max charge", f"{df['charge'].max()} kW")
-    st.sidebar.metric("🔽 Min charge", f"{df['charge'].min()} kW")
-    st.sidebar.metric("⚡ Average charge", f"{df['charge'].mean():.2f} kW")
+    charge_stats, discharge_stats = buffer.stats("charge"), buffer.stats("discharge")
+    if STATS_RANGES[stats_range]:
+        stats = fetch_stats(battery_id, STATS_RANGES[stats_range])
+        if stats:
+            charge_stats, discharge_stats = stats["charge"], stats["discharge"]
 
-    st.sidebar.metric("🔼 Max discharge", f"{df['discharge'].max()} kW")
-    st.sidebar.metric("🔽 Min discharge", f"{df['discharge'].min()} kW")
-    st.sidebar.metric("⚡ Average discharge", f"{df['discharge'].mean():.2f} kW")
+    st.sidebar.metric("🔼 Max charge", f"{charge_stats['max']} kW")
+    st.sidebar.metric("🔽 Min charge", f"{charge_stats['min']} kW")
+    st.sidebar.metric("⚡ Average charge", f"{charge_stats['mean']:.2f} kW")
+
+    st.sidebar.metric("🔼 Max discharge", f"{discharge_stats['max']} kW")
+    st.sidebar.metric("🔽 Min discharge", f"{discharge_stats['min']} kW")
+    st.sidebar.metric("⚡ Average discharge", f"{discharge_stats['mean']:.2f} kW")
 
     # Show raw data in an expandable table
     with st.expander("📊 View Raw Data"):
-        st.dataframe(pd.DataFrame(data))
+        st.dataframe(df)
 
 # Auto-refresh historic data every 30 seconds (optional)
 auto_refresh = st.sidebar.checkbox("⏳ Auto-Refresh Every 10s")
@@ -117,10 +230,7 @@ if auto_refresh:
     time.sleep(10)
     st.rerun()
 
-# Live data loop (refreshes every 5 seconds)
-while True:
-    data = fetch_live_data()
-
+def show_live_data(data):
     # Extract values safely (avoid NoneType errors)
     charge_value = data.get("charge", 0)
     discharge_value = data.get("discharge", 0)
@@ -130,7 +240,22 @@ while True:
     charge_metric.metric("Last charge value", f"⚡ {charge_value} {unit}")
     discharge_metric.metric("Last discharge value", f"⚡ {discharge_value} {unit}")
 
-    # Wait before fetching new data
-    time.sleep(30)  # Adjust update interval as needed
 
+live_mode = st.sidebar.radio("🔴 Live updates", ["Push (stream)", "Poll every 30s"])
+live_status = st.sidebar.empty()
+
+# Live data loop: either follow the push stream or poll
+while True:
+    if live_mode == "Push (stream)":
+        try:
+            for data in iter_live_events(battery_id):
+                live_status.empty()
+                show_live_data(data)
+        except Exception as e:
+            live_status.warning(f"Live stream interrupted, reconnecting: {e}")
+            time.sleep(5)
+    else:
+        show_live_data(fetch_live_data(battery_id))
 
+        # Wait before fetching new data
+        time.sleep(30)  # Adjust update interval as needed
@@ -0,0 +1,144 @@
+import numpy as np
+import pandas as pd
+
+COLUMNS = ("charge", "discharge")
+
+
+class RingBuffer:
+    """
+    Fixed-size columnar buffer of the rows shown on the dashboard.
+
+    Times are stored as int64 epoch nanoseconds and values as float64 (NaN for missing),
+    in preallocated numpy arrays used as a ring. New rows are appended in place and rows
+    older than the display window are dropped from the tail, so a refresh costs time
+    proportional to the number of new rows rather than to the window size.
+
+    Sum and count of every column are maintained incrementally. Minimum and maximum are
+    updated on append and only recomputed over the buffer when an evicted row held the
+    current extreme.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.times = np.zeros(capacity, dtype=np.int64)
+        self.values = {column: np.full(capacity, np.nan) for column in COLUMNS}
+        self.start = 0
+        self.size = 0
+        self._sum = dict.fromkeys(COLUMNS, 0.0)
+        self._count = dict.fromkeys(COLUMNS, 0)
+        self._min = dict.fromkeys(COLUMNS, np.nan)
+        self._max = dict.fromkeys(COLUMNS, np.nan)
+
+    @property
+    def cursor(self):
+        """Epoch-nanosecond time of the newest row, for /read?since=, or None if empty."""
+        if not self.size:
+            return None
+        return str(int(self.times[(self.start + self.size - 1) % self.capacity]))
+
+    def append(self, rows):
+        """
+        Append rows from /read (dicts with "time", "charge", "discharge") in time order.
+        When the buffer is full the oldest rows are overwritten.
+        """
+        if not rows:
+            return
+        times = pd.to_datetime([row["time"] for row in rows], utc=True, format="ISO8601")
+        times = times.tz_convert(None).values.astype("datetime64[ns]").view(np.int64)
+        columns = {
+            column: np.array([np.nan if row.get(column) is None else row[column] for row in rows], dtype=float)
+            for column in COLUMNS
+        }
+        self.append_columns(times, columns)
+
+    def append_columns(self, times, columns):
+        """
+        Append columnar rows in time order: int64 epoch-nanosecond ``times`` and a float64
+        array per column (NaN for missing), e.g. decoded from an Arrow /read response.
+        Rows not newer than the newest buffered one are already here and skipped. When
+        the buffer is full the oldest rows are overwritten.
+        """
+        if self.size:
+            newest = self.times[(self.start + self.size - 1) % self.capacity]
+            seen = int(np.searchsorted(times, newest, side="right"))
+            if seen:
+                times = times[seen:]
+                columns = {column: values[seen:] for column, values in columns.items()}
+        if not len(times):
+            return
+        if len(times) > self.capacity:
+            times = times[-self.capacity:]
+            columns = {column: values[-self.capacity:] for column, values in columns.items()}
+
+        overflow = self.size + len(times) - self.capacity
+        if overflow > 0:
+            self._evict(overflow)
+
+        slots = (self.start + self.size + np.arange(len(times))) % self.capacity
+        self.times[slots] = times
+        for column, values in columns.items():
+            self.values[column][slots] = values
+            present = values[~np.isnan(values)]
+            if present.size:
+                self._sum[column] += float(present.sum())
+                self._count[column] += int(present.size)
+                self._min[column] = np.fmin(self._min[column], present.min())
+                self._max[column] = np.fmax(self._max[column], present.max())
+        self.size += len(times)
+
+    def drop_before(self, moment):
+        """Drop rows older than ``moment`` (a timezone-aware timestamp)."""
+        cutoff = pd.Timestamp(moment).value
+        # The buffered rows are at most two sorted runs of the array; search both in place
+        head = self.times[self.start:min(self.start + self.size, self.capacity)]
+        expired = int(np.searchsorted(head, cutoff, side="left"))
+        if expired == len(head) and self.size > len(head):
+            expired += int(np.searchsorted(self.times[:self.size - len(head)], cutoff, side="left"))
+        if expired:
+            self._evict(expired)
+
+    def stats(self, column):
+        """Max, min and mean of a column over the buffered rows (NaN when empty)."""
+        count = self._count[column]
+        return {
+            "max": self._max[column],
+            "min": self._min[column],
+            "mean": self._sum[column] / count if count else np.nan,
+        }
+
+    def to_frame(self):
+        """The buffered rows as a DataFrame, oldest first."""
+        order = self._order()
+        frame = {"time": pd.to_datetime(self.times[order], utc=True)}
+        for column in COLUMNS:
+            frame[column] = self.values[column][order]
+        return pd.DataFrame(frame)
+
+    def _order(self):
+        return (self.start + np.arange(self.size)) % self.capacity
+
+    def _evict(self, n):
+        n = min(n, self.size)
+        slots = (self.start + np.arange(n)) % self.capacity
+        stale = []
+        for column in COLUMNS:
+            values = self.values[column][slots]
+            present = values[~np.isnan(values)]
+            if present.size:
+                self._sum[column] -= float(present.sum())
+                self._count[column] -= int(present.size)
+                if not self._count[column]:
+                    self._sum[column] = 0.0
+                if present.min() <= self._min[column] or present.max() >= self._max[column]:
+                    stale.append(column)
+            self.values[column][slots] = np.nan
+        self.start = (self.start + n) % self.capacity
+        self.size -= n
+
+        for column in stale:
+            values = self.values[column][self._order()]
+            if np.isnan(values).all():
+                self._min[column] = self._max[column] = np.nan
+            else:
+                self._min[column] = np.nanmin(values)
+                self._max[column] = np.nanmax(values)
@@ -0,0 +1,220 @@
+"""
+Lossy compression of charge/discharge series before they are written to InfluxDB.
+
+Each (battery, field) series is filtered on its own:
+
+- ``deadband``: a value is stored only if it differs from the last stored value by more
+  than the deviation.
+- ``swinging_door``: swinging-door trending. A value is stored only when the values
+  since the last stored one can no longer all be reconstructed within the deviation by
+  a straight line from it. The decision for a value is made when the next one arrives,
+  so the last value of a series is held back until then (or until ``flush``).
+
+The deviation is absolute ("0.5") or relative to the last stored value ("2%"). A value
+is always stored when ``max_interval`` has passed since the previous stored one, so
+gaps stay visible, and values older than the last one seen (backfills) are stored as
+they are.
+"""
+import threading
+
+from src.core.config import Config
+from src.core.metrics import REGISTRY
+from src.core.validation import ValidRecord
+
+_NS = 1_000_000_000
+_VALUES = REGISTRY.counter(
+    "write_compression_values_total", "Values offered to write compression and values it stored (result)",
+    ("field", "result"))
+
+METHODS = ("deadband", "swinging_door")
+
+
+class FieldPolicy:
+    """Compression method and deviation of one field."""
+
+    __slots__ = ("method", "deviation", "relative")
+
+    def __init__(self, method, deviation, relative=False):
+        if method not in METHODS:
+            raise ValueError(f"Unknown compression method '{method}', expected one of {', '.join(METHODS)}")
+        if deviation < 0:
+            raise ValueError("Compression deviation must not be negative")
+        self.method = method
+        self.deviation = deviation
+        self.relative = relative
+
+    def tolerance(self, reference):
+        """Allowed deviation around ``reference``, the last stored value."""
+        return abs(reference) * self.deviation / 100.0 if self.relative else self.deviation
+
+
+def parse_policies(spec):
+    """
+    Parse a compression spec such as ``"charge=deadband:0.5,discharge=swinging_door:2%"``.
+
+    Returns:
+        Dictionary of field -> FieldPolicy.
+
+    Raises:
+        ValueError: If the spec is malformed.
+    """
+    policies = {}
+    for entry in filter(None, (part.strip() for part in (spec or "").split(","))):
+        try:
+            field, rule = entry.split("=", 1)
+            method, deviation = rule.split(":", 1)
+            relative = deviation.endswith("%")
+            policies[field.strip()] = FieldPolicy(method.strip(), float(deviation.rstrip("%")), relative)
+        except ValueError as e:
+            raise ValueError(f"Invalid compression rule '{entry}': {e}")
+    return policies
+
+
+class _Series:
+    """
+    Filter state of one series: the last stored point and, for swinging door, the held
+    value and the slopes (per ns) of the doors from the stored point.
+    """
+
+    __slots__ = ("stored_ns", "stored", "last_ns", "held_ns", "held", "upper", "lower")
+
+    def __init__(self, time_ns, value):
+        self.restart(time_ns, value)
+
+    def restart(self, time_ns, value):
+        self.stored_ns = self.last_ns = time_ns
+        self.stored = value
+        self.held_ns = self.held = None
+        self.upper = float("inf")
+        self.lower = float("-inf")
+
+
+class RecordCompressor:
+    """
+    Applies the per-field policies to validated records.
+
+    The state is per process: with several API workers (or bridge instances) each
+    compresses the part of a series it receives.
+    """
+
+    def __init__(self, policies, max_interval=None):
+        self.policies = policies
+        max_interval = Config.WRITE_COMPRESSION_MAX_INTERVAL if max_interval is None else max_interval
+        self.max_interval_ns = int(max_interval * _NS)
+        self._series = {}  # (battery id, field) -> _Series
+        self._lock = threading.Lock()
+        self._counts = {"offered": 0, "stored": 0}
+        self._offered = {field: _VALUES.labels(field, "offered") for field in policies}
+        self._stored = {field: _VALUES.labels(field, "stored") for field in policies}
+
+    def compress(self, record, keep=False):
+        """
+        Filter a record.
+
+        Args:
+            record: ValidRecord to write.
+            keep: Store the record's values regardless (e.g. for traced records).
+
+        Returns:
+            List of ValidRecords to write: the record with only its stored values (left
+            out if none is stored), preceded by held values the record released.
+        """
+        released = []
+        values = []
+        with self._lock:
+            for field, value in record.values:
+                policy = self.policies.get(field)
+                if policy is None:
+                    values.append((field, value))
+                    continue
+                points = self._offer(policy, (record.battery_id, field), record.time_ns, value, keep)
+                self._count(field, 1, len(points))
+                for time_ns, stored in points:
+                    if time_ns == record.time_ns:
+                        values.append((field, stored))
+                    else:
+                        released.append(ValidRecord(((field, stored),), None, time_ns, record.battery_id))
+        if values:
+            released.append(record if len(values) == len(record.values) else
+                            ValidRecord(tuple(values), record.unit, record.time_ns, record.battery_id))
+        return released
+
+    def flush(self):
+        """
+        Release all held values, e.g. before the process exits.
+
+        Returns:
+            List of ValidRecords to write.
+        """
+        records = []
+        with self._lock:
+            for (battery_id, field), series in self._series.items():
+                if series.held_ns is not None:
+                    records.append(ValidRecord(((field, series.held),), None, series.held_ns, battery_id))
+                    self._count(field, 0, 1)
+                    series.restart(series.held_ns, series.held)
+        return records
+
+    def stats(self):
+        """Values offered and stored, and their ratio (offered per stored value)."""
+        with self._lock:
+            stats = dict(self._counts)
+        stats["ratio"] = round(stats["offered"] / stats["stored"], 2) if stats["stored"] else None
+        return stats
+
+    def _count(self, field, offered, stored):
+        """Caller holds the lock."""
+        self._counts["offered"] += offered
+        self._counts["stored"] += stored
+        if offered:
+            self._offered[field].inc(offered)
+        if stored:
+            self._stored[field].inc(stored)
+
+    def _offer(self, policy, key, time_ns, value, keep):
+        """(time, value) points to store after ``value`` arrived. Caller holds the lock."""
+        series = self._series.get(key)
+        if series is None:
+            self._series[key] = _Series(time_ns, value)
+            return [(time_ns, value)]
+        if time_ns <= series.last_ns:
+            return [(time_ns, value)]  # out of order: store as is, leave the series alone
+        series.last_ns = time_ns
+
+        if keep or time_ns - series.stored_ns >= self.max_interval_ns:
+            points = [] if series.held_ns is None else [(series.held_ns, series.held)]
+            series.restart(time_ns, value)
+            return points + [(time_ns, value)]
+
+        tolerance = policy.tolerance(series.stored)
+        if policy.method == "deadband":
+            if abs(value - series.stored) > tolerance:
+                series.restart(time_ns, value)
+                return [(time_ns, value)]
+            return []
+
+        # Swinging door: the line from the stored point to this value has to pass within the
+        # tolerance of every value since, i.e. its slope has to lie between the doors
+        points = []
+        if not series.lower <= (value - series.stored) / (time_ns - series.stored_ns) <= series.upper:
+            # The doors closed: store the held value and swing new doors from it
+            points.append((series.held_ns, series.held))
+            series.restart(series.held_ns, series.held)
+            series.last_ns = time_ns
+            tolerance = policy.tolerance(series.stored)
+        elapsed = time_ns - series.stored_ns
+        series.upper = min(series.upper, (value + tolerance - series.stored) / elapsed)
+        series.lower = max(series.lower, (value - tolerance - series.stored) / elapsed)
+        series.held_ns, series.held = time_ns, value
+        return points
+
+
+def create_compressor(spec=None, max_interval=None):
+    """
+    Create the write compressor configured by ``WRITE_COMPRESSION``.
+
+    Returns:
+        A RecordCompressor, or None if no field is compressed.
+    """
+    policies = parse_policies(Config.WRITE_COMPRESSION if spec is None else spec)
+    return RecordCompressor(policies, max_interval) if policies else None
@@ -0,0 +1,187 @@
+import re
+from datetime import datetime, timedelta, timezone
+
+from dateutil.parser import isoparse
+
+from src.core.config import Config
+
+AGGREGATES = ("mean", "min", "max", "last")
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+_DURATION_UNITS = {
+    "ns": 1e-9, "us": 1e-6, "µs": 1e-6, "ms": 1e-3, "s": 1, "m": 60, "h": 3600,
+    "d": 86400, "w": 604800, "mo": 2592000, "y": 31536000,
+}
+_DURATION_PART = re.compile(r"(\d+)(ns|us|µs|ms|mo|s|m|h|d|w|y)")
+_DURATION = re.compile(r"^(?:\d+(?:ns|us|µs|ms|mo|s|m|h|d|w|y))+$")
+
+# Window sizes the automatic resolution picks from, in seconds
+_NICE_WINDOWS = [
+    (1, "1s"), (2, "2s"), (5, "5s"), (10, "10s"), (15, "15s"), (30, "30s"),
+    (60, "1m"), (120, "2m"), (300, "5m"), (600, "10m"), (900, "15m"), (1800, "30m"),
+    (3600, "1h"), (7200, "2h"), (10800, "3h"), (21600, "6h"), (43200, "12h"),
+    (86400, "1d"), (604800, "7d"),
+]
+
+
+def parse_duration(value):
+    """
+    Validate a Flux duration literal such as "5m" or "1h30m".
+
+    Returns:
+        The duration in seconds.
+
+    Raises:
+        ValueError: If the value is not a valid duration.
+    """
+    if not value or not _DURATION.match(value):
+        raise ValueError(f"Invalid duration: {value!r}")
+    return sum(int(n) * _DURATION_UNITS[unit] for n, unit in _DURATION_PART.findall(value))
+
+
+def parse_time_bound(value, now=None):
+    """
+    Parse a range bound as accepted by /read: "now()", a relative duration like "-1h",
+    or an RFC 3339 timestamp.
+
+    Returns:
+        Tuple of (Flux literal, timezone-aware UTC datetime).
+
+    Raises:
+        ValueError: If the value is none of the accepted forms.
+    """
+    now = now or datetime.now(timezone.utc)
+    if value == "now()":
+        return value, now
+    if value.startswith("-") and _DURATION.match(value[1:]):
+        return value, now - timedelta(seconds=parse_duration(value[1:]))
+
+    try:
+        moment = isoparse(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid time bound: {value!r}")
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    moment = moment.astimezone(timezone.utc)
+    return moment.strftime("%Y-%m-%dT%H:%M:%S.%fZ"), moment
+
+
+def parse_cursor(value):
+    """
+    Parse a /read ``since`` cursor, the time of the last row a client has: RFC 3339, or
+    integer epoch nanoseconds.
+
+    Row times are only precise to the microsecond (InfluxDB's client parses them into
+    datetimes), so a point stored at 12:00:00.000001500 is sent as 12:00:00.000001. The
+    range therefore starts at the next whole microsecond after the cursor, not one
+    nanosecond after it, or the row the client already has would be sent again.
+
+    Returns:
+        Tuple of (Flux literal, timezone-aware UTC datetime) of the first microsecond
+        after the cursor.
+
+    Raises:
+        ValueError: If the value is not a timestamp.
+    """
+    try:
+        if value.isdigit():
+            moment = _EPOCH + timedelta(microseconds=int(value) // 1000)
+        else:
+            moment = isoparse(value)
+    except (AttributeError, OverflowError, OSError, TypeError, ValueError):
+        raise ValueError(f"Invalid since cursor: {value!r}")
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    moment = moment.astimezone(timezone.utc) + timedelta(microseconds=1)
+    return moment.strftime("%Y-%m-%dT%H:%M:%S.%fZ"), moment
+
+
+def choose_every(start, stop, max_points):
+    """
+    Pick the smallest standard window that keeps a range at or below ``max_points`` buckets.
+
+    Returns:
+        A Flux duration literal, or None if the raw data already fits.
+    """
+    span = (stop - start).total_seconds()
+    if max_points <= 0 or span <= 0:
+        return None
+    needed = span / max_points
+    if needed <= 1:
+        return None
+    for seconds, literal in _NICE_WINDOWS:
+        if seconds >= needed:
+            return literal
+    return f"{int(-(-needed // 86400))}d"
+
+
+def battery_filter(battery_id=None, measurement="battery_data"):
+    """
+    Flux predicate selecting the measurement's points, optionally of a single battery.
+
+    The battery_id tag comparison sits in the same filter as the measurement so InfluxDB
+    can push it down to the series index instead of scanning every battery's points.
+    Points written before batteries were tagged have no battery_id and belong to the
+    default battery. The id must already be validated.
+    """
+    predicate = f'r._measurement == "{measurement}"'
+    if battery_id == Config.DEFAULT_BATTERY_ID:
+        predicate += f' and (r.battery_id == "{battery_id}" or not exists r.battery_id)'
+    elif battery_id:
+        predicate += f' and r.battery_id == "{battery_id}"'
+    return predicate
+
+
+def build_slowest_traces_query(bucket, start, stop, limit, battery_id=None, measurement="message_trace"):
+    """
+    Build the Flux query behind /traces/slowest: the ``limit`` traced messages with the
+    highest total_ms in the range, one row per message with its stage timings as columns.
+    """
+    return (
+        f'from(bucket: "{bucket}")\n'
+        f'  |> range(start: {start}, stop: {stop})\n'
+        f'  |> filter(fn: (r) => {battery_filter(battery_id, measurement)})\n'
+        '  |> pivot(rowKey: ["_time"], columnKey: ["_field"], valueColumn: "_value")\n'
+        '  |> group()\n'
+        f'  |> top(n: {int(limit)}, columns: ["total_ms"])'
+    )
+
+
+def build_recent_query(bucket, start):
+    """
+    Build the Flux query warming the hot store: the raw charge and discharge points of
+    every battery since ``start``, unpivoted.
+    """
+    return (
+        f'from(bucket: "{bucket}")\n'
+        f'  |> range(start: {start})\n'
+        f'  |> filter(fn: (r) => {battery_filter()} and (r._field == "charge" or r._field == "discharge"))\n'
+        '  |> keep(columns: ["_time", "_field", "_value", "battery_id"])'
+    )
+
+
+def build_read_query(bucket, start, stop, every=None, agg="mean", battery_id=None):
+    """
+    Build the Flux query behind /read.
+
+    The fields are pivoted into one row per timestamp with charge and discharge side by
+    side. With ``every`` the data is first downsampled in InfluxDB with aggregateWindow.
+    Without ``battery_id`` rows of all batteries are returned, each carrying its battery_id.
+    InfluxDB returns one table per series, so when several series match (all batteries,
+    or the default battery's tagged and untagged points) they are merged and sorted by
+    time; a single battery's table is already in time order.
+    """
+    query = (
+        f'from(bucket: "{bucket}")\n'
+        f'  |> range(start: {start}, stop: {stop})\n'
+        f'  |> filter(fn: (r) => {battery_filter(battery_id)} and (r._field == "charge" or r._field == "discharge"))\n'
+    )
+    if every:
+        query += f'  |> aggregateWindow(every: {every}, fn: {agg}, createEmpty: false)\n'
+    query += (
+        '  |> pivot(rowKey: ["_time"], columnKey: ["_field"], valueColumn: "_value")\n'
+        '  |> keep(columns: ["_time", "battery_id", "charge", "discharge"])'
+    )
+    if battery_id is None or battery_id == Config.DEFAULT_BATTERY_ID:
+        query += '\n  |> group()\n  |> sort(columns: ["_time"])'
+    return query
@@ -0,0 +1,467 @@
+"""
+Recent raw points per battery and field, kept in memory so /read can answer the recent
+window without InfluxDB.
+
+Every (battery, field) series is a circular buffer of its newest ``HOT_STORE_POINTS``
+points in numpy arrays (epoch-ns times, float64 values and an is-integer flag). The
+store is filled from the API's write path with the points actually written (after write
+compression) and warmed with the last ``HOT_STORE_RETENTION`` seconds from InfluxDB. A
+range is answered from memory only if the store holds every point of it, i.e. it starts
+at or after the series' coverage, the latest of:
+
+- the start of the warmed window,
+- the newest point the buffer has overwritten,
+- the newest point added to the store but then dropped by the write buffer.
+
+Everything else falls back to InfluxDB. Writes that bypass the API entirely (the MQTT
+bridge's ``influx`` sink) are not seen, which is why the store is off unless
+``HOT_STORE_RETENTION`` is set.
+"""
+import heapq
+import os
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from src.core.config import Config
+from src.core.downsample import downsample_rows
+from src.core.log import get_logger
+from src.core.metrics import REGISTRY
+from src.services.flux_query import build_recent_query
+from src.services.live_state import FileLock, ReadBackoff, format_timestamp, pid_alive, to_ns
+
+log = get_logger(__name__)
+
+_NS = 1_000_000_000
+_WARM_RETRY_SECONDS = 30
+
+_READS = REGISTRY.counter("hot_store_reads_total", "Raw /read queries, by whether the hot store answered them",
+                          ("result",))
+_HIT = _READS.labels("hit")
+_MISS = _READS.labels("miss")
+# Every worker maps the same segment, so the workers' values are not added up
+_BYTES = REGISTRY.gauge("hot_store_bytes", "Memory of the hot store's buffers", merge="max")
+_POINTS = REGISTRY.gauge("hot_store_points", "Points held by the hot store", merge="max")
+
+FIELDS = ("charge", "discharge")
+
+# Segment layout: a 64-byte header, then per slot the battery id, the seqlock sequence and
+# (head, count, overwritten_ns) per field, then the times, values and is-int flags of all series
+_HEADER = struct.Struct("<4sIII")  # magic, layout version, slots, points per series
+_MAGIC = b"BHS1"
+_LAYOUT_VERSION = 1
+_HEADER_SIZE = 64
+# Header int64s after the struct: warmed-from ns, untracked-until ns, warming pid, full flag
+_WARM_START, _UNTRACKED, _WARMING, _FULL = range(4)
+_HEAD, _COUNT, _OVERWRITTEN = range(3)
+
+
+class HotStore:
+    """
+    Circular buffers of the recent points of up to ``slots`` batteries, in a shared-memory
+    segment (``shared``) so every worker process on the host reads and fills the same
+    buffers, or in process memory.
+
+    Like the live state, each battery slot is guarded by a seqlock: readers copy a slot's
+    arrays without locking and retry if a writer changed it meanwhile; writers serialize
+    on an flock'ed lock file.
+    """
+
+    def __init__(self, retention=None, points=None, slots=None, shared=True, name=None, lock_path=None):
+        self.retention = Config.HOT_STORE_RETENTION if retention is None else retention
+        self.capacity = points or Config.HOT_STORE_POINTS
+        self.slots = slots or Config.HOT_STORE_BATTERIES
+        self.name = name or Config.HOT_STORE_SHM_NAME
+        self._thread_lock = threading.Lock()
+        self._lock_file = None
+        self._shm = None
+        self._slot_index = {}
+        self._stopped = threading.Event()
+
+        series = self.slots * len(FIELDS)
+        sizes = [_HEADER_SIZE, self.slots * 64, self.slots * 8, series * 3 * 8,
+                 series * self.capacity * 8, series * self.capacity * 8, series * self.capacity]
+        self.nbytes = sum(sizes)
+
+        if shared:
+            lock_path = lock_path or Config.HOT_STORE_LOCK_FILE or os.path.join(
+                tempfile.gettempdir(), f"{self.name}.lock")
+            self._lock_file = open(lock_path, "a+b")
+            with self._write_lock():
+                try:
+                    self._shm = shared_memory.SharedMemory(name=self.name, create=True, size=self.nbytes)
+                    self._shm.buf[:self.nbytes] = bytes(self.nbytes)
+                    _HEADER.pack_into(self._shm.buf, 0, _MAGIC, _LAYOUT_VERSION, self.slots, self.capacity)
+                except FileExistsError:
+                    self._shm = shared_memory.SharedMemory(name=self.name)
+                    if _HEADER.unpack_from(self._shm.buf, 0) != (_MAGIC, _LAYOUT_VERSION, self.slots, self.capacity):
+                        self._shm.close()
+                        raise RuntimeError(f"Shared memory segment '{self.name}' has an incompatible layout")
+            # The segment must survive this process; don't let the resource tracker unlink it
+            resource_tracker.unregister(self._shm._name, "shared_memory")
+            buf = self._shm.buf
+        else:
+            buf = bytearray(self.nbytes)
+
+        offsets = np.cumsum([0] + sizes)
+        self._header = np.frombuffer(buf, np.int64, 4, offset=_HEADER.size)
+        self._ids = np.frombuffer(buf, "S64", self.slots, offset=offsets[1])
+        self._seq = np.frombuffer(buf, np.uint64, self.slots, offset=offsets[2])
+        self._meta = np.frombuffer(buf, np.int64, series * 3, offset=offsets[3]).reshape(self.slots, len(FIELDS), 3)
+        shape = (self.slots, len(FIELDS), self.capacity)
+        self._times = np.frombuffer(buf, np.int64, series * self.capacity, offset=offsets[4]).reshape(shape)
+        self._values = np.frombuffer(buf, np.float64, series * self.capacity, offset=offsets[5]).reshape(shape)
+        self._ints = np.frombuffer(buf, np.bool_, series * self.capacity, offset=offsets[6]).reshape(shape)
+
+        _BYTES.set(self.nbytes)
+        _POINTS.set_function(lambda: int(self._meta[:, :, _COUNT].sum()))
+
+    @property
+    def warm(self):
+        """Whether the store has been warmed from InfluxDB and answers reads."""
+        return bool(self._header[_WARM_START])
+
+    def add(self, records):
+        """
+        Store written records.
+
+        Args:
+            records: Iterable of ValidRecords, as they were written to InfluxDB.
+        """
+        with self._write_lock():
+            for record in records:
+                slot = self._find_slot(record.battery_id, claim=True)
+                if slot is None:
+                    continue
+                self._recover_slot(slot)
+                self._seq[slot] += 1
+                for field, value in record.values:
+                    self._insert(slot, FIELDS.index(field), record.time_ns, value)
+                self._seq[slot] += 1
+
+    def add_dropped(self, lines):
+        """
+        ``on_drop`` hook of the API's writer: points already added were never stored, so
+        ranges up to the newest of them go back to InfluxDB.
+
+        Args:
+            lines: Dropped line-protocol lines, or None if unknown (then up to now).
+        """
+        newest = 0
+        for line in lines or ():
+            try:
+                newest = max(newest, int(line.rsplit(" ", 1)[1]))
+            except (IndexError, ValueError):
+                newest = 0
+                break
+        if newest < _NS * _NS // 10:  # unknown, or not in nanoseconds
+            newest = time.time_ns()
+        with self._write_lock():
+            self._header[_UNTRACKED] = max(self._header[_UNTRACKED], newest + 1_000_000)
+
+    def read(self, start_ns, stop_ns, battery_id=None):
+        """
+        Raw rows in [start_ns, stop_ns), shaped like InfluxDB's /read rows.
+
+        Args:
+            start_ns: Inclusive start, epoch ns.
+            stop_ns: Exclusive stop, epoch ns.
+            battery_id: One battery, or None for all batteries (rows then carry "battery_id").
+
+        Returns:
+            List of row dicts, or None if the store does not hold the whole range.
+        """
+        floor = max(self._header[_WARM_START], self._header[_UNTRACKED])
+        if not self._header[_WARM_START] or start_ns < floor:
+            return None
+        if battery_id is not None:
+            slot = self._find_slot(battery_id)
+            if slot is None:
+                # Never written since warming, unless the store had no slot left for it
+                return None if self._header[_FULL] else []
+            return self._read_slot(slot, start_ns, stop_ns)
+
+        if self._header[_FULL]:
+            return None
+        per_battery = []
+        for raw_id in sorted(raw_id for raw_id in self._ids.tolist() if raw_id):
+            battery_rows = self._read_slot(self._find_slot(raw_id.decode()), start_ns, stop_ns)
+            if battery_rows is None:
+                return None
+            battery_id = raw_id.decode()
+            for row in battery_rows:
+                row["battery_id"] = battery_id
+            per_battery.append(battery_rows)
+        # Each battery's rows are in time order; merge them into one time-ordered list like InfluxDB's
+        return list(heapq.merge(*per_battery, key=lambda row: row["time"]))
+
+    def stats(self):
+        """Batteries and points held, and the memory of the buffers in bytes."""
+        return {"batteries": int(np.count_nonzero(self._ids)), "points": int(self._meta[:, :, _COUNT].sum()),
+                "bytes": self.nbytes}
+
+    def start_warming(self, query_api, bucket):
+        """
+        Warm the store from InfluxDB in a background thread, unless it is warm or another
+        process is warming it. Failed attempts are retried until the store is closed.
+        """
+        threading.Thread(target=self._warm_loop, args=(query_api, bucket), name="hot-store-warmer",
+                         daemon=True).start()
+
+    def warm_from(self, query_api, bucket):
+        """
+        Load the last ``retention`` seconds of every battery from InfluxDB and start
+        answering reads from there. Points written meanwhile are kept.
+        """
+        start_ns = (time.time_ns() // _NS - self.retention) * _NS
+        series = {}  # (battery id, field) -> ([times], [values])
+        for record in query_api.query_stream(build_recent_query(bucket, format_timestamp(start_ns))):
+            battery_id = record.values.get("battery_id") or Config.DEFAULT_BATTERY_ID  # untagged: legacy points
+            times, values = series.setdefault((battery_id, record.get_field()), ([], []))
+            times.append(to_ns(record.get_time()))
+            values.append(record.get_value())
+
+        with self._write_lock():
+            for (battery_id, field), (times, values) in series.items():
+                slot = self._find_slot(battery_id, claim=True) if battery_id and field in FIELDS else None
+                if slot is None:
+                    continue
+                self._recover_slot(slot)
+                self._seq[slot] += 1
+                self._merge(slot, FIELDS.index(field), np.array(times, np.int64),
+                            np.array(values, np.float64), np.array([isinstance(v, int) for v in values]),
+                            replace=False)
+                self._seq[slot] += 1
+            self._header[_WARM_START] = start_ns
+        stats = self.stats()
+        log.info(f"🔥 Hot store warmed: {stats['points']} points of {stats['batteries']} batteries "
+                 f"({self.nbytes / 2**20:.1f} MiB for {self.slots} batteries x {self.capacity} points)")
+
+    def close(self):
+        self._stopped.set()
+        _POINTS.set_function(None)
+        if self._shm is not None:
+            self._header = self._ids = self._seq = self._meta = self._times = self._values = self._ints = None
+            self._shm.close()
+            self._lock_file.close()
+
+    def _warm_loop(self, query_api, bucket):
+        while not self._stopped.is_set():
+            if not self._claim_warming():
+                return
+            try:
+                self.warm_from(query_api, bucket)
+                return
+            except Exception as e:
+                log.error(f"❌ Could not warm the hot store, reading from InfluxDB: {e}")
+            finally:
+                with self._write_lock():
+                    self._header[_WARMING] = 0
+            self._stopped.wait(_WARM_RETRY_SECONDS)
+
+    def _claim_warming(self):
+        """Become the process warming the store; False if it is warm or being warmed."""
+        with self._write_lock():
+            if self._header[_WARM_START] or (self._header[_WARMING] and pid_alive(int(self._header[_WARMING]))):
+                return False
+            self._header[_WARMING] = os.getpid()
+            return True
+
+    def _read_slot(self, slot, start_ns, stop_ns):
+        """Rows of one slot, or None if a field's buffer no longer reaches back to ``start_ns``."""
+        backoff = ReadBackoff()
+        while True:
+            before = self._seq[slot]
+            if not before & 1:  # odd: a writer is in the middle of an update
+                meta, columns = self._copy_slot(slot, start_ns, stop_ns)
+                if self._seq[slot] == before:
+                    break
+            if not backoff.wait():
+                with self._write_lock():
+                    self._recover_slot(slot)
+                    meta, columns = self._copy_slot(slot, start_ns, stop_ns)
+                break
+
+        if start_ns < meta[:, _OVERWRITTEN].max():
+            return None
+        times = np.union1d(columns[0][0], columns[1][0])
+        row_values = []
+        for field_times, values, ints in columns:
+            present = np.zeros(len(times), np.bool_)
+            present[np.searchsorted(times, field_times)] = True
+            cells = [None] * len(times)
+            for index, value, is_int in zip(np.flatnonzero(present).tolist(), values.tolist(), ints.tolist()):
+                cells[index] = int(value) if is_int else value
+            row_values.append(cells)
+        return [{"time": time_text, "charge": charge, "discharge": discharge}
+                for time_text, charge, discharge in zip(_isoformat(times), *row_values)]
+
+    def _copy_slot(self, slot, start_ns, stop_ns):
+        """The slot's meta and each field's (times, values, ints) in [start_ns, stop_ns)."""
+        meta = self._meta[slot].copy()
+        columns = []
+        for f in range(len(FIELDS)):
+            order = (meta[f, _HEAD] + np.arange(meta[f, _COUNT])) % self.capacity
+            times = self._times[slot, f, order]
+            window = slice(np.searchsorted(times, start_ns), np.searchsorted(times, stop_ns))
+            columns.append((times[window], self._values[slot, f, order][window],
+                            self._ints[slot, f, order][window]))
+        return meta, columns
+
+    def _recover_slot(self, slot):
+        """
+        Release a slot whose sequence a dead writer left odd. Caller holds the write lock,
+        so no writer is active. The half-written series are cleared and marked as
+        overwritten up to now, so their range is read from InfluxDB again.
+        """
+        if not self._seq[slot] & 1:
+            return
+        log.warning(f"⚠️ Hot store slot {slot} was left mid-update by a dead writer; clearing it")
+        now = time.time_ns()
+        for f in range(len(FIELDS)):
+            meta = self._meta[slot, f]
+            meta[_HEAD] = meta[_COUNT] = 0
+            meta[_OVERWRITTEN] = max(meta[_OVERWRITTEN], now)
+        self._seq[slot] += 1
+
+    def _insert(self, slot, f, time_ns, value):
+        """Add one point to a series. Caller holds the write lock and the slot's seqlock."""
+        meta = self._meta[slot, f]
+        head, count = meta[_HEAD], meta[_COUNT]
+        last = (head + count - 1) % self.capacity
+        if count and time_ns < self._times[slot, f, last]:
+            # Out of order: merge it in (a rewrite of the whole series, but rare)
+            self._merge(slot, f, np.array([time_ns]), np.array([value], np.float64),
+                        np.array([isinstance(value, int)]), replace=True)
+            return
+        if not count or time_ns > self._times[slot, f, last]:
+            if count == self.capacity:
+                meta[_OVERWRITTEN] = self._times[slot, f, head] + 1
+                meta[_HEAD] = head = (head + 1) % self.capacity
+            else:
+                meta[_COUNT] = count = count + 1
+            last = (head + count - 1) % self.capacity
+        self._times[slot, f, last] = time_ns
+        self._values[slot, f, last] = value
+        self._ints[slot, f, last] = isinstance(value, int)
+
+    def _merge(self, slot, f, times, values, ints, replace):
+        """
+        Merge points into a series, keeping its newest ``capacity`` points. On equal times
+        the new point wins with ``replace``, otherwise the held one. Caller holds the write
+        lock and the slot's seqlock.
+        """
+        meta = self._meta[slot, f]
+        order = (meta[_HEAD] + np.arange(meta[_COUNT])) % self.capacity
+        held = (self._times[slot, f, order], self._values[slot, f, order], self._ints[slot, f, order])
+        new = (times, values, ints)
+        # The winner of equal times goes last, and a stable sort keeps it there
+        first, second = (held, new) if replace else (new, held)
+        times, values, ints = (np.concatenate((a, b)) for a, b in zip(first, second))
+        order = np.argsort(times, kind="stable")
+        times, values, ints = times[order], values[order], ints[order]
+        keep = np.append(times[1:] != times[:-1], True)
+        times, values, ints = times[keep], values[keep], ints[keep]
+        if len(times) > self.capacity:
+            meta[_OVERWRITTEN] = max(meta[_OVERWRITTEN], times[-self.capacity - 1] + 1)
+            times, values, ints = times[-self.capacity:], values[-self.capacity:], ints[-self.capacity:]
+        count = len(times)
+        self._times[slot, f, :count] = times
+        self._values[slot, f, :count] = values
+        self._ints[slot, f, :count] = ints
+        meta[_HEAD] = 0
+        meta[_COUNT] = count
+
+    def _find_slot(self, battery_id, claim=False):
+        """
+        Index of the battery's slot, found by linear probing from a hash of its id.
+        Claiming a free slot requires the write lock to be held; if none is left the
+        store marks itself full and returns None.
+        """
+        slot = self._slot_index.get(battery_id)
+        if slot is not None:
+            return slot
+
+        raw_id = battery_id.encode()[:64]
+        start = zlib.crc32(raw_id.ljust(64, b"\0")) % self.slots
+        for i in range(self.slots):
+            slot = (start + i) % self.slots
+            stored = self._ids[slot]
+            if stored == raw_id:
+                self._slot_index[battery_id] = slot
+                return slot
+            if not stored:
+                if not claim:
+                    return None
+                self._ids[slot] = raw_id
+                self._slot_index[battery_id] = slot
+                return slot
+        if claim and not self._header[_FULL]:
+            self._header[_FULL] = 1
+            log.warning(f"⚠️ Hot store is full ({self.slots} batteries), new batteries are read from InfluxDB")
+        return None
+
+    def _write_lock(self):
+        if self._lock_file is None:
+            return self._thread_lock
+        return FileLock(self._thread_lock, self._lock_file)
+
+
+def _isoformat(times):
+    """Epoch-ns times as the strings ``datetime.isoformat`` gives InfluxDB's row times."""
+    seconds = np.datetime_as_string((times // _NS).astype("datetime64[s]")).tolist()
+    micros = (times % _NS // 1000).tolist()
+    return [f"{text}.{micro:06d}+00:00" if micro else f"{text}+00:00" for text, micro in zip(seconds, micros)]
+
+
+def read_recent(store, params):
+    """
+    Answer a /read from the hot store if it can: raw rows (no ``every``) of a range the
+    store fully covers. Downsampling with ``points`` is applied like for InfluxDB rows.
+
+    Args:
+        store: The HotStore, or None.
+        params: Resolved read parameters, see ``resolve_read_range``.
+
+    Returns:
+        List of rows, or None to read from InfluxDB.
+    """
+    if store is None or params["every"]:
+        return None
+    start_ns, stop_ns = params["start_ns"], to_ns(params["stop_time"])
+    rows = [] if start_ns >= stop_ns else store.read(start_ns, stop_ns, params["battery_id"])
+    if rows is None:
+        _MISS.inc()
+        return None
+    _HIT.inc()
+    return downsample_rows(rows, params["points"], params["downsample"]) if params["points"] else rows
+
+
+def discard_hot_store(name=None):
+    """Remove the shared segment of a previous run, so the server starts with a cold store."""
+    try:
+        segment = shared_memory.SharedMemory(name=name or Config.HOT_STORE_SHM_NAME)
+    except FileNotFoundError:
+        return
+    segment.close()
+    segment.unlink()
+
+
+def create_hot_store(backend=None):
+    """
+    Create the hot store, in shared memory when the live state is (``LIVE_STATE_BACKEND``).
+
+    Returns:
+        A HotStore, or None if ``HOT_STORE_RETENTION`` is 0.
+    """
+    if Config.HOT_STORE_RETENTION <= 0:
+        return None
+    backend = backend or Config.LIVE_STATE_BACKEND
+    if backend not in ("shm", "memory"):
+        raise ValueError(f"Unknown hot store backend: {backend}")
+    return HotStore(shared=backend == "shm")
@@ -1,26 +1,167 @@
-from influxdb_client import InfluxDBClient, Point
+import atexit
+from influxdb_client import InfluxDBClient, Point, WritePrecision
 from influxdb_client.client.write_api import SYNCHRONOUS
+from src.core.battery import validate_battery_id
 from src.core.config import Config
-from datetime import datetime
+from src.core.downsample import METHODS, downsample_rows
+from src.core.log import get_logger
+from src.core.metrics import REGISTRY
+from src.core.tracing import STAGES, TRACE_MEASUREMENT, stage_durations
+from src.core.validation import BATTERY_RECORD_SCHEMA, CHARGE_SCHEMA, DISCHARGE_SCHEMA
+from src.services.flux_query import (
+    AGGREGATES, build_read_query, build_slowest_traces_query, choose_every, parse_cursor, parse_duration,
+    parse_time_bound
+)
+from src.services.influx_writer import WRITE_SECONDS, BatchingWriter, WriteBufferFull
+from src.services.live_state import to_ns
+from src.services.rollups import ensure_rollup_tasks, read_stats
+from src.services.spool import SpoolWriter
 
+log = get_logger(__name__)
 
-def setup_influxdb(app):
+QUERY_SECONDS = REGISTRY.histogram(
+    "influx_query_duration_seconds", "Duration of Flux queries until the last row was read", ("query",))
+
+
+def setup_influxdb(app, create_rollups=True):
     """
     Initialize InfluxDB client with token and URL.
-    Attach write_api and query_api to the Flask app.
+    Attach write_api and query_api to the Flask app, and make sure the rollup
+    tasks behind /stats exist (or, with ``create_rollups`` off, look them up).
     """
-    print(f"Connecting to InfluxDB at {Config.INFLUXDB_URL} with token length {len(Config.INFLUXDB_TOKEN)}")
+    log.info(f"Connecting to InfluxDB at {Config.INFLUXDB_URL} with token length {len(Config.INFLUXDB_TOKEN)}")
 
     app.influx_client = InfluxDBClient(
         url=Config.INFLUXDB_URL,
         token=Config.INFLUXDB_TOKEN,
         org=Config.INFLUXDB_ORG
     )
-    app.write_api = app.influx_client.write_api(write_options=SYNCHRONOUS)
+    app.write_api = create_write_api(app.influx_client)
     app.query_api = app.influx_client.query_api()
 
+    app.rollup_tiers = []
+    if Config.ROLLUPS_ENABLED:
+        try:
+            app.rollup_tiers = ensure_rollup_tasks(app.influx_client, create=create_rollups)
+        except Exception as e:
+            # /stats still works, it just aggregates raw points
+            log.error(f"❌ Could not set up rollup tasks: {e}")
+
+
+def prepare_rollups():
+    """
+    Create or update the rollup tasks once, with a short-lived client.
+    Used by the server master so its workers only need to look the tasks up.
+    """
+    if not Config.ROLLUPS_ENABLED:
+        return
+    client = InfluxDBClient(url=Config.INFLUXDB_URL, token=Config.INFLUXDB_TOKEN, org=Config.INFLUXDB_ORG)
+    try:
+        ensure_rollup_tasks(client)
+    except Exception as e:
+        log.error(f"❌ Could not set up rollup tasks: {e}")
+    finally:
+        client.close()
+
+
+def create_write_api(influx_client, mode=None):
+    """
+    Create the write API for the configured write mode.
+
+    In "batch" mode points are buffered and written in large requests by a
+    BatchingWriter, which is flushed when the process exits. In "spool" mode they
+    are appended to a local write-ahead spool that a SpoolWriter replays to
+    InfluxDB, so an InfluxDB outage neither fails writes nor loses them. In "sync"
+    mode every write is a blocking HTTP request.
+    """
+    mode = mode or Config.INFLUXDB_WRITE_MODE
+    sync_write_api = influx_client.write_api(write_options=SYNCHRONOUS)
+    if mode == "sync":
+        return sync_write_api
+    if mode == "spool":
+        writer = SpoolWriter(sync_write_api)
+    elif mode == "batch":
+        writer = BatchingWriter(sync_write_api)
+    else:
+        raise ValueError(f"Unknown InfluxDB write mode: {mode}")
+    atexit.register(writer.close)
+    return writer
 
-def read_battery_data(query_api, bucket, begin=None, end=None):
+
+def write_point(write_api, bucket, org, record, durable=False):
+    """
+    Write a Point (or list of points / line-protocol strings) with the given write API.
+
+    With a BatchingWriter the call returns once the record is buffered, unless
+    ``durable`` is set, in which case it waits for InfluxDB to accept the batch.
+    With a SpoolWriter it returns once the record is in the spool (on disk, with
+    ``durable``).
+    """
+    if isinstance(write_api, (BatchingWriter, SpoolWriter)):
+        write_api.write(bucket, org, record, durable=durable)
+    else:
+        with WRITE_SECONDS.time():
+            write_api.write(bucket=bucket, org=org, record=record)
+
+
+def resolve_read_range(begin=None, end=None, every=None, agg=None, max_points=None, battery_id=None,
+                       since=None, points=None, downsample=None):
+    """
+    Validate /read parameters and resolve the automatic resolution.
+
+    Args:
+        begin: Start time (default: -1h).
+        end: End time (default: now()).
+        every: Window duration, "auto" to derive it from ``max_points``, or None for raw data.
+        agg: Aggregate applied per window (mean, min, max or last).
+        max_points: Upper bound on returned rows used by "auto".
+        battery_id: Restrict the read to one battery, or None for all batteries.
+        since: Time of the last row the caller already has; only later rows are read.
+        points: Downsample the result to about this many rows, keeping its visual shape.
+        downsample: Method used for ``points``: "lttb" (default) or "minmax".
+
+    Returns:
+        Dictionary with the Flux "start"/"stop" literals, their datetimes
+        ("start_time"/"stop_time"), "every", "agg", "battery_id", "points" and "downsample".
+        "start_ns" is the inclusive start in epoch ns; after a ``since`` cursor it is the
+        first microsecond after the cursor, like the Flux literal.
+
+    Raises:
+        ValueError: If a parameter is invalid.
+    """
+    start, start_time = parse_time_bound(begin or "-1h")
+    stop, stop_time = parse_time_bound(end or "now()")
+    start_ns = to_ns(start_time)
+    if since:
+        cursor, cursor_time = parse_cursor(since)
+        if cursor_time >= start_time:
+            start, start_time = cursor, cursor_time
+            start_ns = to_ns(cursor_time)
+    agg = agg or Config.READ_DEFAULT_AGG
+    if agg not in AGGREGATES:
+        raise ValueError(f"Invalid aggregate '{agg}', expected one of {', '.join(AGGREGATES)}")
+
+    if every == "auto" or (not every and max_points):
+        every = choose_every(start_time, stop_time, max_points or Config.READ_MAX_POINTS)
+    elif every:
+        parse_duration(every)
+
+    if battery_id is not None:
+        battery_id = validate_battery_id(battery_id)
+
+    downsample = downsample or Config.READ_DOWNSAMPLE
+    if points is not None and points < 3:
+        raise ValueError("points must be at least 3")
+    if downsample not in METHODS:
+        raise ValueError(f"Invalid downsampling method '{downsample}', expected one of {', '.join(METHODS)}")
+
+    return {"start": start, "stop": stop, "start_time": start_time, "stop_time": stop_time, "start_ns": start_ns,
+            "every": every, "agg": agg, "battery_id": battery_id, "points": points,
+            "downsample": downsample if points else None}
+
+
+def read_battery_data(query_api, bucket, begin=None, end=None, every=None, agg=None, max_points=None,
+                      battery_id=None, since=None, points=None, downsample=None):
     """
     Retrieve battery data from InfluxDB.
 
@@ -29,80 +170,296 @@ def read_battery_data(query_api, bucket, begin=None, end=None):
         bucket: Name of the InfluxDB bucket.
         begin: Start time (optional).
         end: End time (optional).
+        every: Downsampling window, "auto", or None for raw points (optional).
+        agg: Aggregate used per window (optional, default mean).
+        max_points: Row limit used to pick the window for "auto" (optional).
+        battery_id: Only read this battery (optional, default all batteries).
+        since: Only read rows after this timestamp, the last one the caller has (optional).
+        points: Downsample to about this many rows with ``downsample`` (optional).
+        downsample: "lttb" or "minmax" (optional, default READ_DOWNSAMPLE).
 
     Returns:
-        List of dictionaries representing the queried data.
+        List of dictionaries with "time", "charge" and "discharge", one per timestamp or window,
+        plus "battery_id" when reading all batteries.
+    """
+    return list(stream_battery_data(query_api, bucket, begin, end, every, agg, max_points, battery_id, since,
+                                    points, downsample))
+
+
+def stream_battery_data(query_api, bucket, begin=None, end=None, every=None, agg=None, max_points=None,
+                        battery_id=None, since=None, points=None, downsample=None):
     """
-    if begin and end:
-        query = f'from(bucket: "{bucket}") |> range(start: {begin}, stop: {end}) |> filter(fn: (r) => r._measurement == "battery_data")'
+    Iterate over battery data as InfluxDB streams it, without materializing the result.
+
+    Takes the same arguments as ``read_battery_data``. Parameters are validated and the
+    query is sent when the first row is requested, so callers that need to report errors
+    before responding should pull the first row eagerly. Downsampling with ``points``
+    needs the whole result, so rows are then only yielded once it has been read.
+
+    Yields:
+        Dictionaries with "time", "charge" and "discharge" (and "battery_id" for all batteries).
+    """
+    params = resolve_read_range(begin, end, every, agg, max_points, battery_id, since, points, downsample)
+    if params["points"]:
+        rows = list(_query_rows(query_api, bucket, params))
+        yield from downsample_rows(rows, params["points"], params["downsample"])
     else:
-        query = f'from(bucket: "{bucket}") |> range(start: -1h) |> filter(fn: (r) => r._measurement == "battery_data")'
+        yield from _query_rows(query_api, bucket, params)
+
+
+def _query_rows(query_api, bucket, params):
+    query = build_read_query(bucket, params["start"], params["stop"], params["every"], params["agg"],
+                             params["battery_id"])
+    all_batteries = params["battery_id"] is None
+    if params["start_time"] >= params["stop_time"]:
+        return  # a since cursor at or past the end of the range; InfluxDB rejects empty ranges
 
     try:
-        tables = query_api.query(query)
-        results = []
-        for table in tables:
-            for record in table.records:
-                results.append({
+        with QUERY_SECONDS.labels("read").time():
+            for record in query_api.query_stream(query):
+                row = {
                     "time": record.get_time().isoformat(),
-                    "charge": record.get_value() if record.get_field() == "charge" else None,
-                    "discharge": record.get_value() if record.get_field() == "discharge" else None,
-                })
-        return results
+                    "charge": record.values.get("charge"),
+                    "discharge": record.values.get("discharge"),
+                }
+                if all_batteries:
+                    row["battery_id"] = record.values.get("battery_id") or Config.DEFAULT_BATTERY_ID
+                yield row
     except Exception as e:
         raise RuntimeError(f"Error reading data from InfluxDB: {str(e)}")
 
 
-def influx_write_charge(write_api, bucket, org, data):
+def read_battery_stats(query_api, bucket, tiers, begin=None, end=None, battery_id=None):
+    """
+    Max, min, mean and count of charge and discharge over a time range.
+
+    Whole days, hours and minutes are answered from the rollup tiers and only the
+    partial minutes at the edges from raw points, so a month costs a few dozen rows.
+
+    Args:
+        query_api: InfluxDB Query API instance.
+        bucket: Name of the InfluxDB bucket.
+        tiers: Rollup tiers set up by ``setup_influxdb`` (empty to aggregate raw points).
+        begin: Start time (default: -1h).
+        end: End time (default: now()).
+        battery_id: Only this battery (optional, default all batteries).
+
+    Returns:
+        Dictionary with "charge" and "discharge" statistics and the "segments" queried.
+
+    Raises:
+        ValueError: If a parameter is invalid.
+        RuntimeError: If the query fails.
+    """
+    _, start_time = parse_time_bound(begin or "-1h")
+    _, stop_time = parse_time_bound(end or "now()")
+    if battery_id is not None:
+        battery_id = validate_battery_id(battery_id)
+    with QUERY_SECONDS.labels("stats").time():
+        return read_stats(query_api, bucket, start_time, stop_time, tiers, battery_id)
+
+
+def read_slowest_traces(query_api, bucket, begin=None, end=None, limit=None, battery_id=None):
+    """
+    The traced messages that took longest from the API to storage.
+
+    Args:
+        query_api: InfluxDB Query API instance.
+        bucket: Name of the InfluxDB bucket.
+        begin: Start time (default: -1h).
+        end: End time (default: now()).
+        limit: Number of messages (default 20, at most TRACE_MAX_RESULTS).
+        battery_id: Only this battery (optional, default all batteries).
+
+    Returns:
+        List of dictionaries with "id", "time", "battery_id", "field", "total_ms" and
+        "stages" (milliseconds per stage), slowest first.
+
+    Raises:
+        ValueError: If a parameter is invalid.
+        RuntimeError: If the query fails.
+    """
+    start, _ = parse_time_bound(begin or "-1h")
+    stop, _ = parse_time_bound(end or "now()")
+    limit = 20 if limit is None else limit
+    if not 1 <= limit <= Config.TRACE_MAX_RESULTS:
+        raise ValueError(f"limit must be between 1 and {Config.TRACE_MAX_RESULTS}")
+    if battery_id is not None:
+        battery_id = validate_battery_id(battery_id)
+
+    query = build_slowest_traces_query(bucket, start, stop, limit, battery_id, TRACE_MEASUREMENT)
+    try:
+        with QUERY_SECONDS.labels("traces").time():
+            records = [record for table in query_api.query(query) for record in table.records]
+    except Exception as e:
+        raise RuntimeError(f"Error reading traces from InfluxDB: {str(e)}")
+
+    traces = []
+    for record in records:
+        values = record.values
+        traces.append({
+            "id": values.get("trace_id"),
+            "time": record.get_time().isoformat(),
+            "battery_id": values.get("battery_id"),
+            "field": values.get("field"),
+            "total_ms": values.get("total_ms"),
+            "stages": {stage: values[f"{stage}_ms"] for stage in STAGES if values.get(f"{stage}_ms") is not None},
+        })
+    return traces
+
+
+def trace_point(trace, battery_id, field):
+    """
+    Point with the stage timings of a traced message, timestamped with its first stage.
+
+    Args:
+        trace: Trace envelope (see ``src.core.tracing``).
+        battery_id: Battery the message was about.
+        field: "charge" or "discharge".
+
+    Returns:
+        Point for the "message_trace" measurement, or None if fewer than two stages were recorded.
+    """
+    durations = stage_durations(trace)
+    if not durations:
+        return None
+    point = Point(TRACE_MEASUREMENT).tag("battery_id", battery_id).tag("field", field)
+    point.field("trace_id", trace["id"])
+    for stage, ms in durations:
+        point.field(f"{stage}_ms", ms)
+    point.field("total_ms", sum(ms for _, ms in durations))
+    first = min(at for at in trace["stages"].values() if isinstance(at, int))
+    return point.time(first, WritePrecision.NS)
+
+
+def write_traces(write_api, bucket, org, traces):
     """
-    Write battery data to InfluxDB.
+    Write the timings of traced messages; failures are logged, never raised, because
+    tracing must not fail the write it observes.
+
+    Args:
+        traces: List of (trace envelope, battery id, field) tuples.
+    """
+    points = [point for point in (trace_point(*entry) for entry in traces) if point is not None]
+    if not points:
+        return
+    try:
+        write_point(write_api, bucket, org, points)
+    except Exception as e:
+        log.warning(f"❌ Could not write {len(points)} message traces: {e}")
+
+
+def record_point(record):
+    """
+    Point for a validated record, timestamped with integer nanoseconds.
+
+    Args:
+        record: ValidRecord from one of the schemas in ``src.core.validation``.
+    """
+    point = Point("battery_data").tag("battery_id", record.battery_id)
+    for field, value in record.values:
+        point.field(field, value)
+    return point.time(record.time_ns, WritePrecision.NS)
+
+
+def build_battery_point(data):
+    """
+    Convert a charge and/or discharge record into a Point.
+
+    Args:
+        data: Dictionary with "charge" and/or "discharge" and an optional "timestamp".
+
+    Returns:
+        Point for the "battery_data" measurement.
+
+    Raises:
+        ValueError: If the record is not an object, has no value, or the timestamp is invalid.
+    """
+    return record_point(BATTERY_RECORD_SCHEMA.validate(data))
+
+
+def influx_write_record(write_api, bucket, org, record, durable=False, compressor=None, keep=False):
+    """
+    Write a validated record to InfluxDB.
 
     Args:
         write_api: InfluxDB Write API instance.
         bucket: Name of the InfluxDB bucket.
         org: InfluxDB organization name.
-        data: Dictionary containing the data to write.
-    """
-    if not data:
-        raise ValueError("Invalid payload: data cannot be empty")
+        record: ValidRecord to write.
+        durable: Wait for InfluxDB to accept the point when writes are batched
+            (for the spool to reach the disk when writes are spooled).
+        compressor: Optional RecordCompressor deciding which values are stored.
+        keep: Store the record even if the compressor would drop it.
+
+    Returns:
+        List of the ValidRecords written: the record, or with a compressor what it kept
+        of the record and the held values it released.
 
+    Raises:
+        WriteBufferFull: If the write buffer is full.
+        RuntimeError: If the write failed.
+    """
+    stored = [record] if compressor is None else compressor.compress(record, keep=keep)
+    if not stored:
+        return stored
     try:
-        point = (
-            Point("battery_data")
-            .field("charge", data["charge"])
-            .time(data.get("timestamp", datetime.utcnow().isoformat()))
-        )
-        write_api.write(bucket=bucket, org=org, record=point)
-
-    except KeyError as e:
-        raise KeyError(f"Missing key in payload: {e}")
+        points = [record_point(r) for r in stored]
+        write_point(write_api, bucket, org, points[0] if len(points) == 1 else points, durable=durable)
+    except WriteBufferFull:
+        raise
     except Exception as e:
         raise RuntimeError(f"Failed to write data: {str(e)}")
+    return stored
 
 
-def influx_write_discharge(write_api, bucket, org, data):
+def influx_write_charge(write_api, bucket, org, data, durable=False, compressor=None, keep=False):
     """
-    Write battery data to InfluxDB.
+    Validate a charge payload and write it to InfluxDB.
 
     Args:
         write_api: InfluxDB Write API instance.
         bucket: Name of the InfluxDB bucket.
         org: InfluxDB organization name.
         data: Dictionary containing the data to write.
+        durable: Wait for InfluxDB to accept the point when writes are batched
+            (for the spool to reach the disk when writes are spooled).
+        compressor: Optional RecordCompressor deciding which values are stored.
+        keep: Store the value even if the compressor would drop it.
+
+    Returns:
+        The validated ValidRecord and the list of ValidRecords written for it (see
+        ``influx_write_record``).
+
+    Raises:
+        ValueError: If the payload is invalid.
     """
-    if not data:
-        raise ValueError("Invalid payload: data cannot be empty")
+    record = CHARGE_SCHEMA.validate(data)
+    stored = influx_write_record(write_api, bucket, org, record, durable=durable, compressor=compressor, keep=keep)
+    return record, stored
 
-    try:
-        point = (
-            Point("battery_data")
-            .field("discharge", data["discharge"])
-            .time(data.get("timestamp", datetime.utcnow().isoformat()))
-        )
-        write_api.write(bucket=bucket, org=org, record=point)
-
-    except KeyError as e:
-        raise KeyError(f"Missing key in payload: {e}")
-    except Exception as e:
-        raise RuntimeError(f"Failed to write data: {str(e)}")
 
+def influx_write_discharge(write_api, bucket, org, data, durable=False, compressor=None, keep=False):
+    """
+    Validate a discharge payload and write it to InfluxDB.
+
+    Args:
+        write_api: InfluxDB Write API instance.
+        bucket: Name of the InfluxDB bucket.
+        org: InfluxDB organization name.
+        data: Dictionary containing the data to write.
+        durable: Wait for InfluxDB to accept the point when writes are batched
+            (for the spool to reach the disk when writes are spooled).
+        compressor: Optional RecordCompressor deciding which values are stored.
+        keep: Store the value even if the compressor would drop it.
+
+    Returns:
+        The validated ValidRecord and the list of ValidRecords written for it (see
+        ``influx_write_record``).
+
+    Raises:
+        ValueError: If the payload is invalid.
+    """
+    record = DISCHARGE_SCHEMA.validate(data)
+    stored = influx_write_record(write_api, bucket, org, record, durable=durable, compressor=compressor, keep=keep)
+    return record, stored
@@ -0,0 +1,215 @@
+import queue
+import random
+import threading
+import time
+
+from src.core.config import Config
+from src.core.log import get_logger
+from src.core.metrics import REGISTRY
+
+log = get_logger(__name__)
+
+WRITE_SECONDS = REGISTRY.histogram(
+    "influx_write_duration_seconds", "Duration of InfluxDB write requests, including failed attempts")
+WRITE_POINTS = REGISTRY.counter(
+    "influx_write_points_total", "Points handled by the InfluxDB writer, by result", ("result",))
+WRITE_RETRIES = REGISTRY.counter("influx_write_retries_total", "Retried InfluxDB write requests")
+_BUFFER_DEPTH = REGISTRY.gauge("influx_write_buffer_depth", "Points waiting in the InfluxDB batching buffer")
+
+
+class WriteBufferFull(RuntimeError):
+    """Raised when the write buffer has no room for a write within the enqueue timeout."""
+
+
+class _PendingWrite:
+    __slots__ = ("bucket", "org", "lines", "done", "error")
+
+    def __init__(self, bucket, org, lines, durable):
+        self.bucket = bucket
+        self.org = org
+        self.lines = lines
+        self.done = threading.Event() if durable else None
+        self.error = None
+
+
+_STOP = object()
+
+
+def notify_drop(on_drop, lines):
+    """Call a writer's ``on_drop`` hook with dropped lines (None if unknown), logging its errors."""
+    if on_drop is None:
+        return
+    try:
+        on_drop(lines)
+    except Exception as e:
+        log.error(f"❌ Could not report dropped points: {e}")
+
+
+class BatchingWriter:
+    """
+    Buffers points in memory and writes them to InfluxDB in large line-protocol requests.
+
+    Points are flushed when ``batch_size`` lines are buffered or ``flush_interval`` seconds
+    after the oldest buffered point arrived, whichever comes first. Failed requests are
+    retried with exponential backoff plus random jitter. The buffer is bounded to
+    ``buffer_size`` points, counted until their batch was written or dropped: when a write
+    does not fit, ``write`` blocks for up to ``enqueue_timeout`` seconds and then raises
+    ``WriteBufferFull`` so callers can shed load.
+
+    ``write`` has the same ``bucket``/``org``/``record`` arguments as the client's WriteApi,
+    so it can stand in for ``app.write_api``. ``on_drop``, if set, is called with the
+    line-protocol lines of every batch that is dropped after failed retries.
+    """
+
+    def __init__(self, write_api, batch_size=None, flush_interval=None, buffer_size=None, enqueue_timeout=None,
+                 max_retries=None, retry_interval=None, max_retry_delay=None, jitter=None, durable_timeout=None):
+        self.write_api = write_api
+        self.batch_size = batch_size or Config.INFLUXDB_BATCH_SIZE
+        self.flush_interval = flush_interval or Config.INFLUXDB_FLUSH_INTERVAL_MS / 1000.0
+        self.enqueue_timeout = Config.INFLUXDB_ENQUEUE_TIMEOUT_MS / 1000.0 if enqueue_timeout is None else enqueue_timeout
+        self.max_retries = Config.INFLUXDB_MAX_RETRIES if max_retries is None else max_retries
+        self.retry_interval = retry_interval or Config.INFLUXDB_RETRY_INTERVAL_MS / 1000.0
+        self.max_retry_delay = max_retry_delay or Config.INFLUXDB_MAX_RETRY_DELAY_MS / 1000.0
+        self.jitter = Config.INFLUXDB_RETRY_JITTER_MS / 1000.0 if jitter is None else jitter
+        self.durable_timeout = durable_timeout or Config.INFLUXDB_DURABLE_TIMEOUT_MS / 1000.0
+
+        self.buffer_size = buffer_size or Config.INFLUXDB_BUFFER_SIZE
+        self._queue = queue.Queue()
+        self._buffered = 0  # points accepted and not yet written or dropped
+        self._space = threading.Condition()
+        self._stats_lock = threading.Lock()
+        self._stats = {"enqueued": 0, "written": 0, "failed": 0, "rejected": 0, "retries": 0, "requests": 0}
+        self._closed = False
+        self.on_drop = None
+        _BUFFER_DEPTH.set_function(lambda: self._buffered)
+        self._thread = threading.Thread(target=self._run, name="influx-batch-writer", daemon=True)
+        self._thread.start()
+
+    def write(self, bucket, org, record, durable=False):
+        """
+        Add a Point, a line-protocol string, or a list of those to the buffer.
+
+        Args:
+            bucket: Name of the InfluxDB bucket.
+            org: InfluxDB organization name.
+            record: Point, line-protocol string, or list of them.
+            durable: If True, block until the batch containing the record was written.
+
+        Raises:
+            WriteBufferFull: If the points did not fit in the buffer within ``enqueue_timeout`` seconds.
+            RuntimeError: If a durable write failed or the writer is closed.
+        """
+        if self._closed:
+            raise RuntimeError("InfluxDB writer is closed")
+
+        records = record if isinstance(record, (list, tuple)) else [record]
+        lines = [r if isinstance(r, str) else r.to_line_protocol() for r in records]
+        item = _PendingWrite(bucket, org, lines, durable)
+
+        with self._space:
+            if len(lines) > self.buffer_size or not self._space.wait_for(
+                    lambda: self._buffered + len(lines) <= self.buffer_size, self.enqueue_timeout):
+                self._count("rejected", len(lines))
+                raise WriteBufferFull(f"InfluxDB write buffer is full ({self._buffered} of {self.buffer_size} "
+                                      f"points pending, {len(lines)} more requested)")
+            self._buffered += len(lines)
+        self._queue.put(item)
+        self._count("enqueued", len(lines))
+
+        if durable:
+            if not item.done.wait(self.durable_timeout):
+                raise RuntimeError("Timed out waiting for InfluxDB to acknowledge the write")
+            if item.error:
+                raise RuntimeError(item.error)
+
+    def close(self, timeout=10.0):
+        """Stop accepting writes, flush everything still buffered and stop the writer thread."""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["buffered"] = self._buffered
+        return stats
+
+    def _count(self, key, n=1):
+        with self._stats_lock:
+            self._stats[key] += n
+        if key in ("enqueued", "written", "failed", "rejected"):
+            WRITE_POINTS.labels(key).inc(n)
+
+    def _run(self):
+        batch = []
+        size = 0
+        deadline = None
+        while True:
+            timeout = None if not batch else max(0.0, deadline - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None  # flush interval elapsed
+
+            if item is _STOP:
+                if batch:
+                    self._flush(batch)
+                return
+
+            if item is not None:
+                if not batch:
+                    deadline = time.monotonic() + self.flush_interval
+                batch.append(item)
+                size += len(item.lines)
+                if size < self.batch_size:
+                    continue
+
+            self._flush(batch)
+            batch = []
+            size = 0
+
+    def _flush(self, batch):
+        groups = {}
+        for item in batch:
+            groups.setdefault((item.bucket, item.org), []).append(item)
+
+        for (bucket, org), items in groups.items():
+            lines = [line for item in items for line in item.lines]
+            error = self._write_with_retry(bucket, org, lines)
+            if error:
+                log.error(f"❌ Dropping {len(lines)} points after failed InfluxDB write: {error}")
+                self._count("failed", len(lines))
+                notify_drop(self.on_drop, lines)
+            else:
+                self._count("written", len(lines))
+            with self._space:
+                self._buffered -= len(lines)
+                self._space.notify_all()
+            for item in items:
+                if item.done is not None:
+                    item.error = error
+                    item.done.set()
+
+    def _write_with_retry(self, bucket, org, lines):
+        attempt = 0
+        while True:
+            try:
+                self._count("requests")
+                with WRITE_SECONDS.time():
+                    self.write_api.write(bucket=bucket, org=org, record=lines)
+                return None
+            except Exception as e:
+                status = getattr(e, "status", None)
+                retryable = status is None or status == 429 or status >= 500
+                if not retryable or attempt >= self.max_retries or (self._closed and attempt > 0):
+                    return f"Failed to write data: {str(e)}"
+
+                delay = min(self.retry_interval * (2 ** attempt), self.max_retry_delay)
+                delay += random.uniform(0, self.jitter)
+                attempt += 1
+                self._count("retries")
+                WRITE_RETRIES.inc()
+                log.warning(f"❌ InfluxDB write failed ({e}), retry {attempt}/{self.max_retries} in {delay:.2f}s")
+                time.sleep(delay)
@@ -0,0 +1,131 @@
+import threading
+import time
+from collections import deque
+
+from src.core.config import Config
+from src.core.metrics import REGISTRY
+from src.services.live_state import DEFAULT_BATTERY
+
+_CLIENTS = REGISTRY.gauge("live_stream_clients", "Open /livedata/stream connections")
+
+
+class LiveSubscriber:
+    """
+    One connected stream client: a small bounded queue of pending snapshots.
+
+    When the client falls behind, the oldest snapshots are discarded, so a slow
+    client always catches up straight to the latest value.
+    """
+
+    def __init__(self, battery_id, queue_size):
+        self.battery_id = battery_id
+        self.pending = deque(maxlen=queue_size)
+        self.wakeup = threading.Event()
+        self.lock = threading.Lock()
+        self.last_version = -1
+        self.dropped = 0
+
+    def push(self, snapshot):
+        """Queue a (version, values) pair; versions the client already has are ignored."""
+        with self.lock:
+            if snapshot[0] <= self.last_version:
+                return
+            self.last_version = snapshot[0]
+            if len(self.pending) == self.pending.maxlen:
+                self.dropped += 1
+            self.pending.append(snapshot)
+        self.wakeup.set()
+
+    def wait(self, timeout):
+        """
+        Wait for new snapshots.
+
+        Returns:
+            List of (version, snapshot) pairs, empty if ``timeout`` passed without updates.
+        """
+        self.wakeup.wait(timeout)
+        self.wakeup.clear()
+        with self.lock:
+            items = list(self.pending)
+            self.pending.clear()
+        return items
+
+
+class LiveBroadcaster:
+    """
+    Fans live-state changes out to all stream subscribers of a battery.
+
+    Writes handled by this process are pushed immediately. A watcher thread also polls
+    the live-state versions of subscribed batteries, which is a few shared-memory
+    reads, so updates written by other worker processes reach these subscribers too.
+
+    Each open stream holds one of the worker's ``API_THREADS`` request threads, so the
+    number of clients is capped below it: at least one thread stays free for other
+    requests, and streams beyond the cap are refused (503) instead of queueing.
+    """
+
+    def __init__(self, live_state, queue_size=None, poll_interval=None, max_clients=None):
+        self.live_state = live_state
+        self.queue_size = queue_size or Config.LIVE_STREAM_QUEUE_SIZE
+        self.poll_interval = poll_interval or Config.LIVE_STREAM_POLL_INTERVAL_MS / 1000.0
+        self.max_clients = max_clients or min(Config.LIVE_STREAM_MAX_CLIENTS, Config.API_THREADS - 1)
+        self._subscribers = {}  # battery id -> set of LiveSubscriber
+        self._published = {}  # battery id -> last version pushed
+        self._lock = threading.Lock()
+        self._watcher = None
+        _CLIENTS.set_function(self.client_count)
+
+    def subscribe(self, battery_id=DEFAULT_BATTERY):
+        """
+        Register a stream client. The current snapshot is queued right away.
+
+        Raises:
+            RuntimeError: If ``max_clients`` streams are already open.
+        """
+        subscriber = LiveSubscriber(battery_id, self.queue_size)
+        with self._lock:
+            if sum(len(s) for s in self._subscribers.values()) >= self.max_clients:
+                raise RuntimeError(f"Too many live stream clients ({self.max_clients})")
+            self._subscribers.setdefault(battery_id, set()).add(subscriber)
+            if self._watcher is None:
+                self._watcher = threading.Thread(target=self._watch, name="live-broadcast-watcher", daemon=True)
+                self._watcher.start()
+        version = self.live_state.version(battery_id)
+        subscriber.push((version, self.live_state.get(battery_id)))
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            subscribers = self._subscribers.get(subscriber.battery_id)
+            if subscribers is not None:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self._subscribers[subscriber.battery_id]
+
+    def publish(self, battery_id=DEFAULT_BATTERY):
+        """Push the battery's current snapshot to its subscribers if it changed since the last push."""
+        with self._lock:
+            subscribers = list(self._subscribers.get(battery_id, ()))
+        if not subscribers:
+            return
+
+        version = self.live_state.version(battery_id)
+        with self._lock:
+            if self._published.get(battery_id, -1) >= version:
+                return
+            self._published[battery_id] = version
+        snapshot = (version, self.live_state.get(battery_id))
+        for subscriber in subscribers:
+            subscriber.push(snapshot)
+
+    def client_count(self):
+        with self._lock:
+            return sum(len(s) for s in self._subscribers.values())
+
+    def _watch(self):
+        while True:
+            time.sleep(self.poll_interval)
+            with self._lock:
+                batteries = list(self._subscribers)
+            for battery_id in batteries:
+                self.publish(battery_id)
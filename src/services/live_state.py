@@ -0,0 +1,363 @@
+import fcntl
+import os
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from datetime import datetime, timezone
+from multiprocessing import resource_tracker, shared_memory
+
+from src.core.config import Config
+from src.core.log import get_logger
+
+log = get_logger(__name__)
+
+DEFAULT_BATTERY = Config.DEFAULT_BATTERY_ID
+
+# Seqlock readers spin this often, then sleep with exponential backoff up to a total wait,
+# after which they read under the write lock (see ReadBackoff)
+_READ_SPINS = 100
+_READ_BACKOFF_SECONDS = 0.00001
+_READ_BACKOFF_MAX_SECONDS = 0.001
+_READ_TIMEOUT_SECONDS = 0.05
+
+
+def empty_state():
+    return {"charge": None, "discharge": None, "unit": "kW", "timestamp": None}
+
+
+def format_timestamp(ns):
+    """Render epoch nanoseconds as an RFC 3339 UTC timestamp."""
+    moment = datetime.fromtimestamp(ns // 1_000_000_000, timezone.utc)
+    micros = (ns % 1_000_000_000) // 1000
+    text = moment.strftime("%Y-%m-%dT%H:%M:%S")
+    return f"{text}.{micros:06d}Z" if micros else f"{text}Z"
+
+
+def to_ns(moment):
+    """Epoch nanoseconds of a timezone-aware datetime."""
+    return int(moment.timestamp()) * 1_000_000_000 + moment.microsecond * 1000
+
+
+class MemoryLiveState:
+    """
+    Latest charge/discharge per battery for a single process.
+
+    Writers serialize on a lock and publish a fresh dict per update (copy-on-write), so
+    readers only do a dictionary lookup and never take the lock.
+    """
+
+    def __init__(self):
+        self._states = {}
+        self._lock = threading.Lock()
+        self._write_version = 0
+
+    def update(self, field, value, timestamp, unit=None, battery_id=DEFAULT_BATTERY):
+        """
+        Record a new value unless a newer one is already stored for that field.
+
+        Args:
+            field: "charge" or "discharge".
+            value: The measured value.
+            timestamp: Timezone-aware datetime of the measurement.
+            unit: Unit of the value (optional, keeps the previous unit).
+            battery_id: Battery the value belongs to.
+        """
+        ts = to_ns(timestamp)
+        with self._lock:
+            state = dict(self._states.get(battery_id) or {"version": 0, "unit": "kW"})
+            if ts < state.get(f"{field}_ts", ts):
+                return
+            state[field] = value
+            state[f"{field}_ts"] = ts
+            if unit:
+                state["unit"] = unit
+            state["updated"] = time.time_ns()
+            state["version"] += 1
+            self._states[battery_id] = state
+
+    def get(self, battery_id=DEFAULT_BATTERY):
+        """Latest values as {"charge", "discharge", "unit", "timestamp"}."""
+        state = self._states.get(battery_id)
+        if state is None:
+            return empty_state()
+        latest = max(state.get("charge_ts", 0), state.get("discharge_ts", 0))
+        return {
+            "charge": state.get("charge"),
+            "discharge": state.get("discharge"),
+            "unit": state["unit"],
+            "timestamp": format_timestamp(latest),
+        }
+
+    def version(self, battery_id=DEFAULT_BATTERY):
+        """Number of updates applied to a battery; changes whenever ``get`` would."""
+        state = self._states.get(battery_id)
+        return state["version"] if state else 0
+
+    def last_modified(self, battery_id=DEFAULT_BATTERY):
+        """Wall-clock datetime of the last update, or None."""
+        state = self._states.get(battery_id)
+        return datetime.fromtimestamp(state["updated"] / 1e9, timezone.utc) if state else None
+
+    def write_version(self):
+        """Counter of data writes, see ``bump_write_version``."""
+        return self._write_version
+
+    def bump_write_version(self):
+        """
+        Count a write to InfluxDB and return the new counter value.
+        Read caches compare the counter to notice writes handled elsewhere.
+        """
+        with self._lock:
+            self._write_version += 1
+            return self._write_version
+
+    def close(self):
+        pass
+
+
+# Segment layout: a 24-byte header followed by fixed-size slots, one per battery.
+_HEADER = struct.Struct("<4sIIIQ")  # magic, layout version, slot count, reserved, write version
+_WRITE_VERSION = struct.Struct("<Q")
+_WRITE_VERSION_OFFSET = _HEADER.size - _WRITE_VERSION.size
+_MAGIC = b"BLS1"
+_LAYOUT_VERSION = 2
+# seq, charge, discharge, charge_ts, discharge_ts, updated_ns, flags, unit, battery id
+_SLOT = struct.Struct("<QddqqqI12s64s")
+_SEQ = struct.Struct("<Q")
+_ID_OFFSET = _SLOT.size - 64
+
+_HAS_CHARGE, _HAS_DISCHARGE, _CHARGE_INT, _DISCHARGE_INT = 1, 2, 4, 8
+
+
+class SharedMemoryLiveState:
+    """
+    Latest charge/discharge per battery in a fixed-layout shared-memory segment, so every
+    worker process on the host sees the same live values.
+
+    Each battery owns a slot guarded by a seqlock: a writer makes the sequence number odd,
+    rewrites the slot and makes it even again; readers copy the slot and retry if the
+    sequence was odd or changed meanwhile. Readers therefore never block writers and only
+    take the lock if their retries run out (see ``ReadBackoff``), which also releases a
+    slot left odd by a writer that died. Writers from different processes serialize on an
+    flock'ed lock file.
+    The segment outlives individual workers and is reused on restart.
+    """
+
+    def __init__(self, name=None, slots=None, lock_path=None):
+        self.name = name or Config.LIVE_STATE_SHM_NAME
+        self.slots = slots or Config.LIVE_STATE_SLOTS
+        lock_path = lock_path or Config.LIVE_STATE_LOCK_FILE or os.path.join(
+            tempfile.gettempdir(), f"{self.name}.lock")
+        self._lock_file = open(lock_path, "a+b")
+        self._thread_lock = threading.Lock()
+        self._slot_index = {}
+
+        size = _HEADER.size + self.slots * _SLOT.size
+        with self._write_lock():
+            try:
+                self._shm = shared_memory.SharedMemory(name=self.name, create=True, size=size)
+                self._shm.buf[:size] = bytes(size)
+                _HEADER.pack_into(self._shm.buf, 0, _MAGIC, _LAYOUT_VERSION, self.slots, 0, 0)
+            except FileExistsError:
+                self._shm = shared_memory.SharedMemory(name=self.name)
+                magic, layout, slots, _, _ = _HEADER.unpack_from(self._shm.buf, 0)
+                if magic != _MAGIC or layout != _LAYOUT_VERSION or slots != self.slots:
+                    self._shm.close()
+                    raise RuntimeError(f"Shared memory segment '{self.name}' has an incompatible layout")
+        # The segment must survive this process; don't let the resource tracker unlink it
+        resource_tracker.unregister(self._shm._name, "shared_memory")
+        self._buf = self._shm.buf
+
+    def update(self, field, value, timestamp, unit=None, battery_id=DEFAULT_BATTERY):
+        """Same contract as ``MemoryLiveState.update``."""
+        ts = to_ns(timestamp)
+        with self._write_lock():
+            offset = self._find_slot(battery_id, claim=True)
+            (seq, charge, discharge, charge_ts, discharge_ts, _updated, flags, old_unit,
+             raw_id) = _SLOT.unpack_from(self._buf, offset)
+            seq += seq & 1  # odd: the previous writer died mid-update
+            has, is_int = (_HAS_CHARGE, _CHARGE_INT) if field == "charge" else (_HAS_DISCHARGE, _DISCHARGE_INT)
+            if flags & has and ts < (charge_ts if field == "charge" else discharge_ts):
+                return
+
+            if field == "charge":
+                charge, charge_ts = float(value), ts
+            else:
+                discharge, discharge_ts = float(value), ts
+            flags |= has
+            flags = flags | is_int if isinstance(value, int) else flags & ~is_int
+            new_unit = _encode_unit(unit) if unit else old_unit
+
+            _SEQ.pack_into(self._buf, offset, seq + 1)
+            _SLOT.pack_into(self._buf, offset, seq + 1, charge, discharge, charge_ts, discharge_ts,
+                            time.time_ns(), flags, new_unit, raw_id)
+            _SEQ.pack_into(self._buf, offset, seq + 2)
+
+    def get(self, battery_id=DEFAULT_BATTERY):
+        """Same contract as ``MemoryLiveState.get``."""
+        slot = self._read_slot(battery_id)
+        if slot is None:
+            return empty_state()
+        _seq, charge, discharge, charge_ts, discharge_ts, _updated, flags, unit, _id = slot
+        return {
+            "charge": _decode_value(charge, flags, _HAS_CHARGE, _CHARGE_INT),
+            "discharge": _decode_value(discharge, flags, _HAS_DISCHARGE, _DISCHARGE_INT),
+            "unit": unit.rstrip(b"\0").decode(errors="ignore") or "kW",
+            "timestamp": format_timestamp(max(charge_ts, discharge_ts)),
+        }
+
+    def version(self, battery_id=DEFAULT_BATTERY):
+        """Seqlock sequence of the battery's slot; advances on every update from any process."""
+        offset = self._find_slot(battery_id)
+        return _SEQ.unpack_from(self._buf, offset)[0] // 2 if offset is not None else 0
+
+    def last_modified(self, battery_id=DEFAULT_BATTERY):
+        slot = self._read_slot(battery_id)
+        return datetime.fromtimestamp(slot[5] / 1e9, timezone.utc) if slot else None
+
+    def write_version(self):
+        """Same contract as ``MemoryLiveState.write_version``, counted across all processes."""
+        return _WRITE_VERSION.unpack_from(self._buf, _WRITE_VERSION_OFFSET)[0]
+
+    def bump_write_version(self):
+        with self._write_lock():
+            version = _WRITE_VERSION.unpack_from(self._buf, _WRITE_VERSION_OFFSET)[0] + 1
+            _WRITE_VERSION.pack_into(self._buf, _WRITE_VERSION_OFFSET, version)
+            return version
+
+    def close(self):
+        self._buf = None
+        self._shm.close()
+        self._lock_file.close()
+
+    def _read_slot(self, battery_id):
+        offset = self._find_slot(battery_id)
+        if offset is None:
+            return None
+        backoff = ReadBackoff()
+        while True:
+            before = _SEQ.unpack_from(self._buf, offset)[0]
+            if not before & 1:  # odd: a writer is in the middle of an update
+                slot = _SLOT.unpack_from(self._buf, offset)
+                if _SEQ.unpack_from(self._buf, offset)[0] == before:
+                    return slot
+            if not backoff.wait():
+                return self._recover_slot(offset)
+
+    def _recover_slot(self, offset):
+        """
+        Read a slot under the write lock. Holding it, no writer is active, so a sequence
+        that is still odd belongs to a writer that died mid-update: the slot is released
+        with whatever values that writer left.
+        """
+        with self._write_lock():
+            seq = _SEQ.unpack_from(self._buf, offset)[0]
+            if seq & 1:
+                log.warning(f"⚠️ Live state slot at offset {offset} was left mid-update by a dead writer; releasing it")
+                _SEQ.pack_into(self._buf, offset, seq + 1)
+            return _SLOT.unpack_from(self._buf, offset)
+
+    def _find_slot(self, battery_id, claim=False):
+        """
+        Offset of the battery's slot, found by linear probing from a hash of its id.
+        Claiming a free slot requires the write lock to be held.
+        """
+        offset = self._slot_index.get(battery_id)
+        if offset is not None:
+            return offset
+
+        raw_id = battery_id.encode()[:64].ljust(64, b"\0")
+        start = zlib.crc32(raw_id) % self.slots
+        for i in range(self.slots):
+            offset = _HEADER.size + ((start + i) % self.slots) * _SLOT.size
+            stored = bytes(self._buf[offset + _ID_OFFSET:offset + _SLOT.size])
+            if stored == raw_id:
+                self._slot_index[battery_id] = offset
+                return offset
+            if stored == bytes(64):
+                if not claim:
+                    return None
+                self._buf[offset + _ID_OFFSET:offset + _SLOT.size] = raw_id
+                self._slot_index[battery_id] = offset
+                return offset
+        raise RuntimeError(f"Live state segment is full ({self.slots} batteries)")
+
+    def _write_lock(self):
+        return FileLock(self._thread_lock, self._lock_file)
+
+
+def pid_alive(pid):
+    """Whether a process with this pid exists."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class ReadBackoff:
+    """
+    Pacing of a seqlock reader's retries: spin first, then sleep with exponential backoff.
+    Readers give up once ``wait`` returns False and fall back to taking the write lock,
+    so a writer that died mid-update cannot make them spin forever.
+    """
+
+    __slots__ = ("attempts", "delay", "waited")
+
+    def __init__(self):
+        self.attempts = 0
+        self.delay = _READ_BACKOFF_SECONDS
+        self.waited = 0.0
+
+    def wait(self):
+        """Pause before the next attempt; False once the retries are used up."""
+        self.attempts += 1
+        if self.attempts <= _READ_SPINS:
+            return True
+        if self.waited >= _READ_TIMEOUT_SECONDS:
+            return False
+        time.sleep(self.delay)
+        self.waited += self.delay
+        self.delay = min(self.delay * 2, _READ_BACKOFF_MAX_SECONDS)
+        return True
+
+
+class FileLock:
+    """Thread lock plus an exclusive flock, so writers serialize within and across processes."""
+
+    def __init__(self, thread_lock, lock_file):
+        self.thread_lock = thread_lock
+        self.lock_file = lock_file
+
+    def __enter__(self):
+        self.thread_lock.acquire()
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+
+    def __exit__(self, *exc):
+        fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+        self.thread_lock.release()
+
+
+def _encode_unit(unit):
+    """The unit in at most 12 UTF-8 bytes, cut on a character boundary."""
+    return unit.encode()[:12].decode(errors="ignore").encode()
+
+
+def _decode_value(value, flags, has, is_int):
+    if not flags & has:
+        return None
+    return int(value) if flags & is_int else value
+
+
+def create_live_state(backend=None):
+    """Create the live-state store selected by ``LIVE_STATE_BACKEND`` ("shm" or "memory")."""
+    backend = backend or Config.LIVE_STATE_BACKEND
+    if backend == "shm":
+        return SharedMemoryLiveState()
+    if backend == "memory":
+        return MemoryLiveState()
+    raise ValueError(f"Unknown live state backend: {backend}")
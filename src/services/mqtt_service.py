@@ -1,7 +1,276 @@
 import json
+import queue
+import threading
+import time
+from collections import deque
+
 import paho.mqtt.client as mqtt
-import requests
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+from src.core.battery import parse_battery_topic, subscription_topics
+from src.core.codec import decode_record, is_binary
 from src.core.config import Config
+from src.core.log import get_logger
+from src.core.metrics import REGISTRY, start_metrics_server
+from src.core.tracing import get_trace, mark
+from src.services.sinks import create_sink
+
+log = get_logger(__name__)
+
+_MESSAGES = REGISTRY.counter("bridge_messages_total", "Messages handled by the MQTT bridge, by result", ("result",))
+_QUEUE_DEPTH = REGISTRY.gauge("bridge_queue_depth", "Messages waiting for a bridge worker")
+_SINK_SECONDS = REGISTRY.histogram("bridge_sink_write_duration_seconds", "Duration of one batch write to the sink")
+
+
+class _AckTracker:
+    """
+    Acknowledges QoS 1 messages once they were handled, in the order they arrived.
+
+    MQTT requires PUBACKs in arrival order, but workers finish their batches in any
+    order, so the ack of a message waits until every earlier message is done as well.
+    """
+
+    def __init__(self):
+        self.ack = None  # callable(mid), set once the client exists
+        self._pending = deque()  # [mid, done] in arrival order
+        self._lock = threading.Lock()
+
+    def track(self, mid):
+        entry = [mid, False]
+        with self._lock:
+            self._pending.append(entry)
+        return entry
+
+    def discard(self, entry):
+        """Stop tracking a message that was not queued; it stays unacknowledged."""
+        with self._lock:
+            self._pending.remove(entry)
+            while self._pending and self._pending[0][1]:
+                self.ack(self._pending.popleft()[0])
+
+    def done(self, entries):
+        with self._lock:
+            for entry in entries:
+                entry[1] = True
+            while self._pending and self._pending[0][1]:
+                self.ack(self._pending.popleft()[0])
+
+    def reset(self):
+        """Forget the messages of a lost connection; the broker sends them again on reconnect."""
+        with self._lock:
+            self._pending.clear()
+
+    def __len__(self):
+        return len(self._pending)
+
+
+class MessageDispatcher:
+    """
+    Decouples the paho network loop from storage.
+
+    ``on_message`` only puts the raw message on a bounded queue; a pool of worker
+    threads drains it in batches, decodes the payloads and hands them to the sink.
+    Counters and the queue depth are logged every ``MQTT_BRIDGE_STATS_INTERVAL`` seconds
+    and exported as metrics.
+
+    With ``qos`` 1 a message is acknowledged only after its batch was written, and a
+    failed write is retried until it succeeds instead of being dropped, so a crash or
+    an outage leaves the message with the broker, which delivers it again. If the queue
+    stays full the message is not acknowledged either and the dispatcher is ``paused``:
+    the bridge disconnects until the queue has drained and then receives the message again.
+    """
+
+    def __init__(self, sink, workers=None, queue_size=None, batch_size=None, enqueue_timeout=None, qos=None,
+                 retry_interval=None, max_retry_delay=None):
+        self.sink = sink
+        self.batch_size = batch_size or Config.MQTT_BRIDGE_BATCH_SIZE
+        self.enqueue_timeout = (Config.MQTT_BRIDGE_ENQUEUE_TIMEOUT_MS / 1000.0
+                                if enqueue_timeout is None else enqueue_timeout)
+        self.qos = Config.MQTT_BRIDGE_QOS if qos is None else qos
+        self.retry_interval = retry_interval or Config.MQTT_BRIDGE_RETRY_INTERVAL_MS / 1000.0
+        self.max_retry_delay = max_retry_delay or Config.MQTT_BRIDGE_MAX_RETRY_DELAY_MS / 1000.0
+        self.queue = queue.Queue(maxsize=queue_size or Config.MQTT_BRIDGE_QUEUE_SIZE)
+        self.acks = _AckTracker() if self.qos > 0 else None
+        self._stats_lock = threading.Lock()
+        self._stats = {"received": 0, "written": 0, "invalid": 0, "failed": 0, "dropped": 0, "retried": 0,
+                       "deferred": 0}
+        self._stopping = threading.Event()
+        self.paused = False
+        self._workers = [
+            threading.Thread(target=self._work, name=f"mqtt-bridge-worker-{i}", daemon=True)
+            for i in range(workers or Config.MQTT_BRIDGE_WORKERS)
+        ]
+        _QUEUE_DEPTH.set_function(self.queue.qsize)
+
+    def start(self):
+        for worker in self._workers:
+            worker.start()
+        threading.Thread(target=self._report, name="mqtt-bridge-stats", daemon=True).start()
+
+    def stop(self, timeout=10.0):
+        """Let the workers drain the queue, then close the sink."""
+        deadline = time.monotonic() + timeout
+        while not self.queue.empty() and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self._stopping.set()
+        for worker in self._workers:
+            worker.join(max(0.0, deadline - time.monotonic()))
+        self.sink.close()
+
+    def submit(self, topic, payload, mid=None):
+        """
+        Queue a raw MQTT message. Called from the paho network loop, so it must stay cheap
+        and waits at most ``enqueue_timeout`` for room in the queue.
+
+        Args:
+            mid: Message id of a QoS 1 message to acknowledge once it is written.
+
+        Returns:
+            True if the message was queued. A QoS 0 message that was not is dropped, a QoS 1
+            message stays unacknowledged (see ``paused``).
+        """
+        # The arrival time is kept for traced messages, whose envelope is only seen when decoding
+        entry = self.acks.track(mid) if mid is not None and self.acks is not None else None
+        try:
+            # With MQTT v5 the receive maximum (<= queue size) keeps the queue from filling up
+            # with unacked messages, MQTT 3.1.1 has no such limit
+            self.queue.put((topic, payload, time.time_ns(), entry), timeout=self.enqueue_timeout)
+        except queue.Full:
+            if entry is None:
+                self._count("dropped")
+            else:
+                self.acks.discard(entry)
+                self._count("deferred")
+            return False
+        self._count("received")
+        return True
+
+    def wait_for_room(self):
+        """Block until the queue is at most half full (or the dispatcher stops)."""
+        while self.queue.qsize() > self.queue.maxsize // 2 and not self._stopping.wait(0.1):
+            pass
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["queue_depth"] = self.queue.qsize()
+        if self.acks is not None:
+            stats["awaiting_ack"] = len(self.acks)
+        return stats
+
+    def _count(self, key, n=1):
+        with self._stats_lock:
+            self._stats[key] += n
+        _MESSAGES.labels(key).inc(n)
+
+    def _work(self):
+        while not self._stopping.is_set():
+            try:
+                batch = [self.queue.get(timeout=0.5)]
+            except queue.Empty:
+                continue
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            records = []
+            for topic, payload, received_at, _ in batch:
+                record = decode_message(topic, payload, received_at)
+                if record is None:
+                    self._count("invalid")
+                else:
+                    records.append(record)
+
+            # Invalid messages are acknowledged too, redelivering them would not help
+            if (not records or self._write(records)) and self.acks is not None:
+                self.acks.done([entry for _, _, _, entry in batch if entry is not None])
+
+    def _write(self, records):
+        """
+        Hand a batch to the sink. With acks, retry with exponential backoff until it
+        succeeds or the dispatcher stops.
+
+        Returns:
+            True if the batch was written (records the sink rejected as invalid included).
+        """
+        delay = self.retry_interval
+        while True:
+            try:
+                with _SINK_SECONDS.time():
+                    rejected = self.sink.write(records)
+                self._count("invalid", rejected)
+                self._count("written", len(records) - rejected)
+                return True
+            except Exception as e:
+                if self.acks is None or self._stopping.is_set():
+                    log.error(f"❌ Error writing {len(records)} records: {e}")
+                    self._count("failed", len(records))
+                    return False
+                log.warning(f"❌ Error writing {len(records)} records ({e}), retrying in {delay:.2f}s")
+                self._count("retried", len(records))
+                self._stopping.wait(delay)
+                delay = min(delay * 2, self.max_retry_delay)
+
+    def _report(self):
+        last = self.stats()
+        while not self._stopping.wait(Config.MQTT_BRIDGE_STATS_INTERVAL):
+            stats = self.stats()
+            rate = (stats["written"] - last["written"]) / Config.MQTT_BRIDGE_STATS_INTERVAL
+            log.info(f"📊 Bridge: {rate:.1f} msg/s written, queue depth {stats['queue_depth']}",
+                     extra=dict(stats, rate=round(rate, 1)))
+            last = stats
+
+
+def decode_message(topic, payload, received_at=None):
+    """
+    Decode a telemetry message into a record for the sink.
+
+    Payloads are JSON or binary records (``src.core.codec``), told apart by their first
+    byte. The battery id comes from the topic (``battery/<id>/charge``); the legacy topics
+    map to the default battery. A trace envelope in the payload gets the
+    ``bridge_received`` stage, at ``received_at`` (epoch ns) when given.
+
+    Returns:
+        The record dict, or None if the topic is unknown or the payload is invalid.
+    """
+    parsed = parse_battery_topic(topic)
+    if parsed is None:
+        log.debug("❌ No sink mapping defined for topic", extra={"topic": topic})
+        return None
+    battery_id, field = parsed
+
+    if is_binary(payload):
+        try:
+            record = decode_record(payload, field)
+        except ValueError as e:
+            log.debug(f"❌ Invalid binary record received: {e}", extra={"topic": topic})
+            return None
+    else:
+        try:
+            record = json.loads(payload)
+        except (ValueError, json.JSONDecodeError) as e:
+            log.debug(f"❌ Invalid JSON format received: {e}", extra={"topic": topic})
+            return None
+    if not isinstance(record, dict) or field not in record:
+        log.debug(f"❌ Missing '{field}' field in message", extra={"topic": topic})
+        return None
+    record["battery_id"] = battery_id
+    trace = get_trace(record)
+    if trace is not None:
+        mark(trace, "bridge_received", at=received_at)
+    return record
+
+
+def bridge_topics(share_group=None):
+    """
+    Topic filters the bridge subscribes to: the legacy topics and the per-battery
+    wildcards, as shared subscriptions (``$share/<group>/...``) when a group is set.
+    """
+    share_group = Config.MQTT_BRIDGE_SHARE_GROUP if share_group is None else share_group
+    topics = subscription_topics()
+    return [f"$share/{share_group}/{topic}" for topic in topics] if share_group else topics
 
 
 def on_connect(client, userdata, flags, rc, properties):
@@ -10,65 +279,101 @@ def on_connect(client, userdata, flags, rc, properties):
     Uses the new callback API version (v2).
     """
     if rc == 0:
-        print(f"✅ Connected to MQTT broker at {Config.MQTT_BROKER}:{Config.MQTT_PORT}")
+        log.info(f"✅ Connected to MQTT broker at {Config.MQTT_BROKER}:{Config.MQTT_PORT}",
+                 extra={"session_present": flags.session_present})
 
-        # Subscribe to multiple topics
+        # Subscribing again is harmless when the broker kept the session
+        topics = bridge_topics()
         try:
-            client.subscribe([(Config.MQTT_TOPIC, 0), (Config.MQTT_TOPIC_DISCHARGE, 0)])
-            print(f"✅ Subscribed to topics: {Config.MQTT_TOPIC}, {Config.MQTT_TOPIC_DISCHARGE}")
+            client.subscribe([(topic, userdata.qos) for topic in topics])
+            log.info(f"✅ Subscribed to topics: {', '.join(topics)}")
         except Exception as e:
-            print(f"❌ Failed to subscribe to topics: {e}")
-
-        print(f"✅ Subscribed to topics: {Config.MQTT_TOPIC}, {Config.MQTT_TOPIC_DISCHARGE}")
+            log.error(f"❌ Failed to subscribe to topics: {e}")
     else:
-        print(f"❌ Failed to connect to MQTT broker, return code {rc}")
+        log.error(f"❌ Failed to connect to MQTT broker, return code {rc}")
 
 
-def on_message(client, userdata, msg):
-    payload = msg.payload.decode()
+def on_disconnect(client, userdata, disconnect_flags, rc, properties):
+    if userdata.acks is not None:
+        userdata.acks.reset()
+    if rc != 0:
+        log.warning(f"❌ MQTT bridge lost connection ({rc}), reconnecting...")
+
 
-    print(f"📩 Received MQTT message on topic: {msg.topic} -> {payload}")
-    endpoint = ""
-    if msg.topic == Config.MQTT_TOPIC:
-        endpoint = Config.WRITE_CHARGE_ENDPOINT
+def on_message(client, userdata, msg):
+    """
+    Hand the message to the dispatcher; decoding and writing happen on the worker pool.
+    If a QoS 1 message finds the queue full, disconnect (keeping the session) so the
+    network loop stops receiving; ``start_mqtt`` reconnects once the queue has drained.
+    """
+    mid = msg.mid if msg.qos > 0 else None
+    if not userdata.submit(msg.topic, msg.payload, mid) and mid is not None and not userdata.paused:
+        userdata.paused = True
+        log.warning("⏸️ Bridge queue full, pausing until it drains; the broker keeps the unacknowledged messages")
+        client.disconnect()
 
-    elif msg.topic == Config.MQTT_TOPIC_DISCHARGE:
-        endpoint = Config.WRITE_DISCHARGE_ENDPOINT
 
-    if not endpoint:
-        print(f"❌ No endpoint defined for topic: {msg.topic}")
-        return
+def connect_bridge(dispatcher, client_id=None, session_expiry=None, host=None, port=None, protocol=None):
+    """
+    Connect an MQTT client feeding ``dispatcher``; the caller runs its network loop.
 
-    try:
-        parsed = json.loads(payload)
-        response = requests.post(endpoint, json=parsed)
+    The session outlives disconnects for ``session_expiry`` seconds
+    (MQTT_BRIDGE_SESSION_EXPIRY), so the broker keeps the subscription and the
+    unacknowledged messages of a restarting instance with the same ``client_id``.
+    Over MQTT 3.1.1 (``protocol`` "3.1.1") the session is kept until the broker's own expiry.
+    """
+    session_expiry = Config.MQTT_BRIDGE_SESSION_EXPIRY if session_expiry is None else session_expiry
+    v5 = (protocol or Config.MQTT_BRIDGE_PROTOCOL) == "5"
+    client = mqtt.Client(callback_api_version=mqtt.CallbackAPIVersion.VERSION2,
+                         client_id=client_id or Config.MQTT_BRIDGE_CLIENT_ID,
+                         protocol=mqtt.MQTTv5 if v5 else mqtt.MQTTv311,
+                         clean_session=None if v5 else session_expiry == 0, userdata=dispatcher)
+    client.on_connect = on_connect
+    client.on_disconnect = on_disconnect
+    client.on_message = on_message
+    if dispatcher.acks is not None:
+        client.manual_ack_set(True)
+        dispatcher.acks.ack = lambda mid: client.ack(mid, dispatcher.qos)
 
-        if response.status_code == 200:
-            print(f"✅ Wrote to InfluxDB successfully")
-        else:
-            print(f"❌ Failed to post to InfluxDB: {response.text}")
+    host, port = host or Config.MQTT_BROKER, port or Config.MQTT_PORT
+    if not v5:
+        client.connect(host, port)
+        return client
 
-    except (ValueError, json.JSONDecodeError) as e:
-        print(f"❌ Invalid JSON format received: {e}")
-    except Exception as e:
-        print(f"❌ Error sending charge data: {e}")
+    properties = Properties(PacketTypes.CONNECT)
+    properties.SessionExpiryInterval = session_expiry
+    if dispatcher.acks is not None:
+        # Bounds the unacknowledged messages in flight, so ``submit`` never blocks on a full queue
+        properties.ReceiveMaximum = min(Config.MQTT_BRIDGE_RECEIVE_MAXIMUM, dispatcher.queue.maxsize, 65535)
+    client.connect(host, port, clean_start=session_expiry == 0, properties=properties)
+    return client
 
 
 def start_mqtt():
-    client = mqtt.Client(callback_api_version=mqtt.CallbackAPIVersion.VERSION2)
-    client.on_connect = on_connect
-    client.on_message = on_message
+    if Config.MQTT_BRIDGE_METRICS_PORT:
+        start_metrics_server(Config.MQTT_BRIDGE_METRICS_PORT)
+    dispatcher = MessageDispatcher(create_sink())
+    dispatcher.start()
 
     try:
-        print(f"🚀 Connecting MQTT service to {Config.MQTT_BROKER}:{Config.MQTT_PORT}...")
-        client.connect(Config.MQTT_BROKER, Config.MQTT_PORT)
-        client.loop_forever()  # Keep the loop running
+        log.info(f"🚀 Connecting MQTT service {Config.MQTT_BRIDGE_CLIENT_ID} "
+                 f"to {Config.MQTT_BROKER}:{Config.MQTT_PORT}...")
+        client = connect_bridge(dispatcher)
+        while True:
+            client.loop_forever()  # Keep the loop running, reconnecting after connection losses
+            if not dispatcher.paused:
+                break
+            dispatcher.wait_for_room()
+            dispatcher.paused = False
+            log.info("▶️ Bridge queue drained, reconnecting")
+            client.reconnect()
+    except KeyboardInterrupt:
+        pass
     except Exception as e:
-        print(f"❌ Error connecting to MQTT broker: {e}")
+        log.error(f"❌ Error connecting to MQTT broker: {e}")
+    finally:
+        dispatcher.stop()
 
 
 if __name__ == "__main__":
     start_mqtt()
-
-
-
@@ -0,0 +1,181 @@
+import threading
+import time
+import zlib
+from collections import OrderedDict, deque
+from datetime import datetime, timezone
+
+from src.core.config import Config
+from src.core.metrics import REGISTRY
+from src.core.read_formats import compress
+
+_REQUESTS = REGISTRY.counter("read_cache_requests_total", "Cacheable /read requests, by cache result", ("result",))
+_HIT = _REQUESTS.labels("hit")
+_MISS = _REQUESTS.labels("miss")
+_ENTRIES = REGISTRY.gauge("read_cache_entries", "Responses held in the /read cache")
+
+
+class CachedRead:
+    __slots__ = ("body", "etag", "start_time", "stop_time", "battery_id", "expires", "variants")
+
+    def __init__(self, body, etag, start_time, stop_time, battery_id, expires):
+        self.body = body
+        self.etag = etag
+        self.start_time = start_time
+        self.stop_time = stop_time
+        self.battery_id = battery_id
+        self.expires = expires
+        self.variants = {}  # content coding -> compressed body
+
+    def encoded(self, encoding):
+        """The body compressed with ``encoding``, compressed once per entry."""
+        body = self.variants.get(encoding)
+        if body is None:
+            body = self.variants[encoding] = compress(self.body, encoding)
+        return body
+
+
+class ReadCache:
+    """
+    Write-versioned cache of serialized /read responses.
+
+    Every write bumps the write version and drops the cached entries whose time window
+    overlaps the written timestamps, so polls over an unchanged range are answered from
+    memory. Entries for windows ending at now() are open-ended (any newer write
+    invalidates them) and additionally expire after ``ttl`` seconds, because points age
+    out of a relative window even without writes. For the same reason the ETag of a
+    relative window includes the bounds it was resolved to.
+
+    With several worker processes the version is the counter of the shared live state
+    (``write_versions``). Writes handled by another worker show up as counter steps this
+    cache did not make; their time ranges are unknown here, so they drop every entry.
+    """
+
+    def __init__(self, max_entries=None, ttl=None, max_rows=None, write_versions=None):
+        self.max_entries = max_entries or Config.READ_CACHE_MAX_ENTRIES
+        self.ttl = ttl or Config.READ_CACHE_TTL
+        self.max_rows = max_rows or Config.READ_CACHE_MAX_ROWS
+        self.write_versions = write_versions or _LocalVersions()
+        self.last_modified = datetime.now(timezone.utc)
+        self._entries = OrderedDict()
+        # (version, first, last, battery ids) of recent writes, to detect writes that raced a query
+        self._recent_writes = deque(maxlen=1024)
+        self._lock = threading.Lock()
+        self._expected = self.write_versions.write_version()  # counter value after our last write
+        self._foreign_at = self._expected  # counter value when writes by other processes were last seen
+        _ENTRIES.set_function(lambda: len(self._entries))
+
+    @property
+    def version(self):
+        """Current write version, to pass to ``put`` as ``seen_version``."""
+        with self._lock:
+            return self._sync(self.write_versions.write_version())
+
+    def get(self, key):
+        with self._lock:
+            self._sync(self.write_versions.write_version())
+            entry = self._entries.get(key)
+            if entry is None:
+                _MISS.inc()
+                return None
+            if entry.expires is not None and entry.expires < time.monotonic():
+                del self._entries[key]
+                _MISS.inc()
+                return None
+            self._entries.move_to_end(key)
+            _HIT.inc()
+            return entry
+
+    def put(self, key, params, rows, body, seen_version):
+        """
+        Cache a serialized result computed from data as of ``seen_version``.
+
+        The entry is not stored if a write overlapping its window landed while the
+        query was running.
+
+        Returns:
+            The CachedRead (stored or not), carrying the ETag for the response.
+        """
+        start_time = params["start_time"]
+        stop_time = None if is_open_ended(params["stop"]) else params["stop_time"]
+        expires = time.monotonic() + self.ttl if stop_time is None or params["start"].startswith("-") else None
+        tagged = key
+        if expires is not None:
+            # A relative window slides with the clock, so the same key and version do not mean the
+            # same rows once the entry expired; tag the bounds it was resolved to as well
+            tagged = (key, params["start_time"].isoformat(), params["stop_time"].isoformat())
+        etag = f"r{zlib.crc32(repr(tagged).encode()):08x}-{seen_version}"
+        entry = CachedRead(body, etag, start_time, stop_time, params["battery_id"], expires)
+
+        if len(rows) > self.max_rows:
+            return entry
+        with self._lock:
+            self._sync(self.write_versions.write_version())
+            if seen_version < self._foreign_at:
+                return entry  # another process wrote while the query was running
+            if len(self._recent_writes) == self._recent_writes.maxlen and self._recent_writes[0][0] > seen_version:
+                return entry  # lost track of the writes since the query started
+            for version, first, last, battery_ids in self._recent_writes:
+                if version > seen_version and _overlaps(entry, first, last, battery_ids):
+                    return entry
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+    def record_write(self, first, last=None, battery_ids=None):
+        """
+        Bump the write version and drop cached windows overlapping [first, last].
+
+        Args:
+            first: Earliest written timestamp.
+            last: Latest written timestamp (defaults to ``first``).
+            battery_ids: Batteries written to, or None if unknown (affects every battery).
+        """
+        last = last or first
+        with self._lock:
+            self._sync(self.write_versions.write_version())
+            version = self.write_versions.bump_write_version()
+            # A step of more than one means another process wrote concurrently
+            self._sync(version - 1)
+            self._expected = version
+            self.last_modified = datetime.now(timezone.utc)
+            self._recent_writes.append((version, first, last, battery_ids))
+            stale = [key for key, entry in self._entries.items() if _overlaps(entry, first, last, battery_ids)]
+            for key in stale:
+                del self._entries[key]
+
+    def _sync(self, current):
+        """Drop everything if the counter moved past our own writes. Caller holds the lock."""
+        if current != self._expected:
+            self._entries.clear()
+            self._foreign_at = max(self._foreign_at, current)
+            self._expected = current
+        return current
+
+
+class _LocalVersions:
+    """Write counter of a single-process cache."""
+
+    def __init__(self):
+        self._version = 0
+
+    def write_version(self):
+        return self._version
+
+    def bump_write_version(self):
+        self._version += 1
+        return self._version
+
+
+def is_open_ended(stop):
+    """Whether a /read stop bound moves with the clock."""
+    return stop == "now()" or stop.startswith("-")
+
+
+def _overlaps(entry, first, last, battery_ids=None):
+    if last < entry.start_time:
+        return False
+    if entry.battery_id is not None and battery_ids is not None and entry.battery_id not in battery_ids:
+        return False
+    return entry.stop_time is None or first < entry.stop_time
@@ -0,0 +1,269 @@
+from datetime import datetime, timedelta, timezone
+
+from src.core.battery import FIELDS
+from src.core.config import Config
+from src.core.log import get_logger
+from src.services.flux_query import battery_filter, parse_duration
+
+log = get_logger(__name__)
+
+# How long a finished window may take to be written by its task run
+_SETTLE = timedelta(seconds=30)
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+class RollupTier:
+    """
+    One rollup resolution, maintained by an InfluxDB task.
+
+    Each window of ``every`` is stored in the ``battery_rollup_<name>`` measurement as
+    ``<field>_min``, ``<field>_max``, ``<field>_sum`` and ``<field>_count``, timestamped
+    with the window start and tagged with battery_id. The 1m tier is computed from the
+    raw points and every coarser tier from the tier below, so each run reads few rows.
+    Every run recomputes the last ``lookback`` so points arriving a little late are
+    included; older backfills are not rolled up. Results are grouped by battery_id
+    only, which makes it the one tag ``to()`` writes.
+    """
+
+    def __init__(self, name, seconds, source, offset, lookback):
+        self.name = name
+        self.every = timedelta(seconds=seconds)
+        self.source = source
+        self.offset = offset
+        self.lookback = lookback
+        self.measurement = f"battery_rollup_{name}"
+        self.task_name = f"battery_rollup_{name}"
+        self.valid_from = None  # first window start with complete rollups, set by ensure_rollup_tasks
+
+    def ready_until(self, now):
+        """End of the last window that is final at ``now``."""
+        offset = timedelta(seconds=parse_duration(self.offset))
+        return floor_time(now - offset - _SETTLE, self.every)
+
+    def task_flux(self, bucket, org):
+        """Flux script of the task maintaining this tier."""
+        header = (
+            'import "date"\n\n'
+            f'option task = {{name: "{self.task_name}", every: {self.name}, offset: {self.offset}}}\n\n'
+            f'data = from(bucket: "{bucket}")\n'
+            f'  |> range(start: date.truncate(t: -{self.lookback}, unit: {self.name}))\n'
+        )
+        if self.source is None:
+            fields = " or ".join(f'r._field == "{field}"' for field in FIELDS)
+            body = (
+                f'  |> filter(fn: (r) => r._measurement == "battery_data" and ({fields}))\n'
+                '  |> toFloat()\n\n'
+                'rollup = (tables=<-, fn, stat) => tables\n'
+                f'  |> aggregateWindow(every: {self.name}, fn: fn, createEmpty: false, timeSrc: "_start")\n'
+                '  |> group(columns: ["battery_id"])\n'
+                f'  |> map(fn: (r) => ({{r with _measurement: "{self.measurement}", _field: r._field + "_" + stat}}))\n\n'
+                'union(tables: [\n'
+                '  data |> rollup(fn: min, stat: "min"),\n'
+                '  data |> rollup(fn: max, stat: "max"),\n'
+                '  data |> rollup(fn: sum, stat: "sum"),\n'
+                '  data |> rollup(fn: count, stat: "count"),\n'
+                '])\n'
+            )
+        else:
+            fields = " or ".join(f'r._field == "{field}_" + stat' for field in FIELDS)
+            body = (
+                f'  |> filter(fn: (r) => r._measurement == "battery_rollup_{self.source}")\n\n'
+                'rollup = (tables=<-, fn, stat) => tables\n'
+                f'  |> filter(fn: (r) => {fields})\n'
+                f'  |> aggregateWindow(every: {self.name}, fn: fn, createEmpty: false, timeSrc: "_start")\n'
+                '  |> group(columns: ["battery_id"])\n'
+                f'  |> set(key: "_measurement", value: "{self.measurement}")\n\n'
+                'union(tables: [\n'
+                '  data |> rollup(fn: min, stat: "min"),\n'
+                '  data |> rollup(fn: max, stat: "max"),\n'
+                '  data |> rollup(fn: sum, stat: "sum"),\n'
+                '  data |> rollup(fn: sum, stat: "count"),\n'
+                '])\n'
+            )
+        return header + body + f'  |> to(bucket: "{bucket}", org: "{org}")\n'
+
+
+# Finest first; offsets leave the finer tier time to finish the same boundary
+ROLLUP_TIERS = (
+    RollupTier("1m", 60, None, "10s", "5m"),
+    RollupTier("1h", 3600, "1m", "1m", "3h"),
+    RollupTier("1d", 86400, "1h", "5m", "3d"),
+)
+
+
+def ensure_rollup_tasks(influx_client, bucket=None, org=None, tiers=ROLLUP_TIERS, create=True):
+    """
+    Create the rollup tasks, or update their Flux if it changed, and record from when
+    each tier holds complete windows.
+
+    A tier is complete from the first window after both its own task and the tiers it is
+    built from existed; older data is answered from raw points.
+
+    Args:
+        create: Create and update tasks. When False the existing tasks are only looked
+            up, as server workers do once the master process has set them up; a tier
+            without a task (and every tier built from it) is then left unused.
+
+    Returns:
+        The tiers, with ``valid_from`` set.
+    """
+    # Imported here so modules that only plan queries don't pull in the domain models
+    from influxdb_client.domain.task_create_request import TaskCreateRequest
+    from influxdb_client.domain.task_update_request import TaskUpdateRequest
+
+    bucket = bucket or Config.INFLUXDB_BUCKET
+    org = org or Config.INFLUXDB_ORG
+    tasks_api = influx_client.tasks_api()
+
+    source_valid = None
+    for tier in tiers:
+        flux = tier.task_flux(bucket, org)
+        existing = tasks_api.find_tasks(name=tier.task_name, org=org)
+        if not existing and not create:
+            break
+        if existing:
+            task = existing[0]
+            if task.flux != flux and create:
+                tasks_api.update_task_request(task.id, TaskUpdateRequest(flux=flux, status="active"))
+                log.info(f"🔄 Updated rollup task {tier.task_name}")
+        else:
+            task = tasks_api.create_task(task_create_request=TaskCreateRequest(
+                org=org, flux=flux, status="active", description=f"Battery data rollups per {tier.name}"))
+            log.info(f"✅ Created rollup task {tier.task_name}")
+
+        created = task.created_at or datetime.now(timezone.utc)
+        if created.tzinfo is None:
+            created = created.replace(tzinfo=timezone.utc)
+        tier.valid_from = ceil_time(max(created, source_valid or created), tier.every)
+        source_valid = tier.valid_from
+    return tiers
+
+
+def plan_stats_segments(start, stop, tiers, now=None):
+    """
+    Split [start, stop) into time segments, each answered by the coarsest tier covering it.
+
+    Whole days come from the 1d tier, the hours around them from 1h, and so on down to
+    raw points for the partial minutes at the edges. Tiers without ``valid_from`` are
+    skipped.
+
+    Returns:
+        List of (tier or None for raw points, segment start, segment stop), in time order.
+    """
+    now = now or datetime.now(timezone.utc)
+    usable = [tier for tier in sorted(tiers, key=lambda t: t.every, reverse=True) if tier.valid_from]
+    return _plan(start, stop, usable, now)
+
+
+def _plan(start, stop, tiers, now):
+    if start >= stop:
+        return []
+    if not tiers:
+        return [(None, start, stop)]
+    tier, finer = tiers[0], tiers[1:]
+    first = ceil_time(max(start, tier.valid_from), tier.every)
+    last = floor_time(min(stop, tier.ready_until(now)), tier.every)
+    if first >= last:
+        return _plan(start, stop, finer, now)
+    return _plan(start, first, finer, now) + [(tier, first, last)] + _plan(last, stop, finer, now)
+
+
+def build_stats_query(bucket, segments, battery_id=None):
+    """
+    Flux query returning min/max/sum/count of charge and discharge per segment.
+
+    Raw segments aggregate the points, rollup segments combine the stored windows
+    (min of minima, max of maxima, sums of sums and counts). Rows carry the field in
+    ``_field`` (possibly with a ``_<stat>`` suffix), the statistic in ``stat`` and the
+    value in ``_value``.
+    """
+    fields = " or ".join(f'r._field == "{field}"' for field in FIELDS)
+    streams = []
+    for i, (tier, start, stop) in enumerate(segments):
+        name = f"segment{i}"
+        source = (
+            f'{name} = from(bucket: "{bucket}")\n'
+            f'  |> range(start: {_literal(start)}, stop: {_literal(stop)})\n'
+        )
+        if tier is None:
+            source += (
+                f'  |> filter(fn: (r) => {battery_filter(battery_id)} and ({fields}))\n'
+                '  |> toFloat()\n'
+                '  |> group(columns: ["_field"])\n'
+            )
+            combine = {"min": "min()", "max": "max()", "sum": "sum()", "count": "count() |> toFloat()"}
+            tables = [f'{name} |> {fn} |> set(key: "stat", value: "{stat}")' for stat, fn in combine.items()]
+        else:
+            source += (
+                f'  |> filter(fn: (r) => {battery_filter(battery_id, tier.measurement)})\n'
+                '  |> group(columns: ["_field"])\n'
+            )
+            combine = {"min": "min()", "max": "max()", "sum": "sum()", "count": "sum()"}
+            tables = []
+            for stat, fn in combine.items():
+                stat_fields = " or ".join(f'r._field == "{field}_{stat}"' for field in FIELDS)
+                tables.append(f'{name} |> filter(fn: (r) => {stat_fields}) |> {fn} |> set(key: "stat", value: "{stat}")')
+        streams.append((source, tables))
+
+    query = "\n".join(source for source, _ in streams)
+    tables = ",\n  ".join(table for _, group in streams for table in group)
+    return query + f'\nunion(tables: [\n  {tables},\n])\n  |> keep(columns: ["_field", "stat", "_value"])'
+
+
+def read_stats(query_api, bucket, start, stop, tiers, battery_id=None, now=None):
+    """
+    Summary statistics of charge and discharge over [start, stop).
+
+    Returns:
+        Dictionary with "charge" and "discharge" ({"min", "max", "mean", "count"}) and the
+        "segments" used, as {"tier", "start", "stop"} with tier "raw" for raw points.
+    """
+    segments = plan_stats_segments(start, stop, tiers, now)
+    totals = {field: {"min": None, "max": None, "sum": 0.0, "count": 0} for field in FIELDS}
+    if segments:
+        try:
+            for record in query_api.query_stream(build_stats_query(bucket, segments, battery_id)):
+                field = record.get_field()
+                field = field if field in totals else field.rsplit("_", 1)[0]
+                _combine(totals[field], record.values["stat"], record.get_value())
+        except Exception as e:
+            raise RuntimeError(f"Error reading statistics from InfluxDB: {str(e)}")
+
+    result = {}
+    for field, total in totals.items():
+        count = int(total["count"])
+        result[field] = {
+            "min": total["min"],
+            "max": total["max"],
+            "mean": total["sum"] / count if count else None,
+            "count": count,
+        }
+    result["segments"] = [
+        {"tier": tier.name if tier else "raw", "start": _literal(seg_start), "stop": _literal(seg_stop)}
+        for tier, seg_start, seg_stop in segments
+    ]
+    return result
+
+
+def floor_time(moment, step):
+    return moment - (moment - _EPOCH) % step
+
+
+def ceil_time(moment, step):
+    remainder = (moment - _EPOCH) % step
+    return moment + (step - remainder) if remainder else moment
+
+
+def _combine(total, stat, value):
+    if value is None:
+        return
+    if stat == "min":
+        total["min"] = value if total["min"] is None else min(total["min"], value)
+    elif stat == "max":
+        total["max"] = value if total["max"] is None else max(total["max"], value)
+    else:
+        total[stat] += value
+
+
+def _literal(moment):
+    return moment.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
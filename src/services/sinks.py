@@ -0,0 +1,135 @@
+import requests
+from influxdb_client import InfluxDBClient
+from requests.adapters import HTTPAdapter
+
+from src.core.config import Config
+from src.core.log import get_logger
+from src.core.tracing import get_trace, mark
+from src.core.validation import BATTERY_RECORD_SCHEMA
+from src.services.compression import create_compressor
+from src.services.influx_service import create_write_api, record_point, write_point, write_traces
+
+log = get_logger(__name__)
+
+
+class InfluxSink:
+    """
+    Writes bridged records straight into InfluxDB through the batching write pipeline,
+    skipping the HTTP hop to the Flask API. Writes are durable: ``write`` returns only
+    once InfluxDB accepted the points (or the spool has them on disk), so the bridge
+    acknowledges no message that could still be dropped.
+    """
+
+    def __init__(self):
+        log.info(f"Connecting MQTT bridge to InfluxDB at {Config.INFLUXDB_URL}")
+        self.influx_client = InfluxDBClient(
+            url=Config.INFLUXDB_URL,
+            token=Config.INFLUXDB_TOKEN,
+            org=Config.INFLUXDB_ORG
+        )
+        self.write_api = create_write_api(self.influx_client)
+        self.compressor = create_compressor()
+
+    def write(self, records):
+        """
+        Write a list of record dicts in one call.
+
+        Returns:
+            Number of records rejected as invalid.
+
+        Raises:
+            RuntimeError: If the write failed.
+        """
+        points = []
+        traces = []
+        rejected = 0
+        for record in records:
+            try:
+                valid = BATTERY_RECORD_SCHEMA.validate(record)
+            except ValueError as e:
+                log.warning(f"❌ Invalid record: {e}", extra={"record": record})
+                rejected += 1
+                continue
+            trace = get_trace(record)
+            kept = [valid] if self.compressor is None else self.compressor.compress(valid, keep=trace is not None)
+            points.extend(record_point(r) for r in kept)
+            if trace is not None:
+                traces.append((mark(trace, "bridge_sent"), record["battery_id"], _traced_field(record)))
+        if points:
+            write_point(self.write_api, Config.INFLUXDB_BUCKET, Config.INFLUXDB_ORG, points, durable=True)
+        if traces:
+            for trace, _, _ in traces:
+                mark(trace, "stored")
+            write_traces(self.write_api, Config.INFLUXDB_BUCKET, Config.INFLUXDB_ORG, traces)
+        return rejected
+
+    def close(self):
+        held = self.compressor.flush() if self.compressor is not None else []
+        if held:
+            write_point(self.write_api, Config.INFLUXDB_BUCKET, Config.INFLUXDB_ORG, [record_point(r) for r in held])
+        if hasattr(self.write_api, "close"):
+            self.write_api.close()
+        self.influx_client.close()
+
+
+class HttpSink:
+    """
+    Posts bridged records to the API's /writeBatch endpoint over a pooled keep-alive session.
+    Requests ask for a durable ack (``?ack=durable``), so the API answers only once the
+    records are stored.
+    """
+
+    def __init__(self, endpoint=None, pool_size=None):
+        self.endpoint = endpoint or Config.WRITE_BATCH_ENDPOINT
+        pool_size = pool_size or Config.MQTT_BRIDGE_WORKERS
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def write(self, records):
+        """
+        Post a list of record dicts in one request.
+
+        Returns:
+            Number of records the API rejected as invalid.
+
+        Raises:
+            RuntimeError: If the request failed or the API could not store some records.
+        """
+        for record in records:
+            trace = get_trace(record)
+            if trace is not None:
+                mark(trace, "bridge_sent")
+        try:
+            response = self.session.post(self.endpoint, json=records, params={"ack": "durable"},
+                                         timeout=Config.MQTT_BRIDGE_HTTP_TIMEOUT)
+        except requests.RequestException as e:
+            raise RuntimeError(f"Failed to post to {self.endpoint}: {e}")
+        if response.status_code not in (200, 207):
+            raise RuntimeError(f"Failed to post to {self.endpoint}: {response.status_code} {response.text}")
+
+        summary = response.json()
+        if summary.get("unwritten"):
+            # Written chunks are stored again on the retry, which InfluxDB treats as overwrites
+            raise RuntimeError(f"{summary['unwritten']} records could not be stored by {self.endpoint}")
+        if summary.get("failed"):
+            log.warning(f"❌ {summary['failed']} records rejected by the API", extra={"errors": summary.get("errors")})
+        return summary.get("failed", 0)
+
+    def close(self):
+        self.session.close()
+
+
+def _traced_field(record):
+    return "charge" if record.get("charge") is not None else "discharge"
+
+
+def create_sink(kind=None):
+    """Create the bridge sink selected by ``MQTT_BRIDGE_SINK`` ("influx" or "http")."""
+    kind = kind or Config.MQTT_BRIDGE_SINK
+    if kind == "influx":
+        return InfluxSink()
+    if kind == "http":
+        return HttpSink()
+    raise ValueError(f"Unknown MQTT bridge sink: {kind}")
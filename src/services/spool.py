@@ -0,0 +1,546 @@
+import fcntl
+import mmap
+import os
+import random
+import struct
+import threading
+import time
+import zlib
+
+from src.core.config import Config
+from src.core.log import get_logger
+from src.core.metrics import REGISTRY
+from src.services.influx_writer import WRITE_POINTS, WRITE_RETRIES, WRITE_SECONDS, notify_drop
+
+log = get_logger(__name__)
+
+_BACKLOG_BYTES = REGISTRY.gauge("influx_spool_backlog_bytes", "Bytes in the write spool not yet replayed to InfluxDB")
+
+# Segment file: header, then records until a zero length. The header's consumed offset
+# is where the replayer continues after a restart.
+_SEGMENT_HEADER = struct.Struct("<4sIQQ")  # magic, layout version, sequence, consumed offset
+_CONSUMED = struct.Struct("<Q")
+_CONSUMED_OFFSET = _SEGMENT_HEADER.size - _CONSUMED.size
+_RECORD_HEADER = struct.Struct("<III")  # payload length, crc32 of the payload, line count
+_MAGIC = b"BSP1"
+_LAYOUT_VERSION = 1
+_SUFFIX = ".seg"
+_LOCK_NAME = "slot.lock"
+
+
+class _Segment:
+    """One memory-mapped, preallocated segment file."""
+
+    __slots__ = ("path", "sequence", "size", "map", "end", "sealed")
+
+    def __init__(self, path, sequence, size, create):
+        self.path = path
+        self.sequence = sequence
+        flags = os.O_RDWR | (os.O_CREAT | os.O_EXCL if create else 0)
+        fd = os.open(path, flags, 0o644)
+        try:
+            if create:
+                os.ftruncate(fd, size)
+            self.size = os.fstat(fd).st_size
+            self.map = mmap.mmap(fd, self.size)
+        finally:
+            os.close(fd)
+        if create:
+            _SEGMENT_HEADER.pack_into(self.map, 0, _MAGIC, _LAYOUT_VERSION, sequence, _SEGMENT_HEADER.size)
+        self.end = _SEGMENT_HEADER.size
+        self.sealed = False
+
+    @property
+    def consumed(self):
+        return _CONSUMED.unpack_from(self.map, _CONSUMED_OFFSET)[0]
+
+    @consumed.setter
+    def consumed(self, offset):
+        _CONSUMED.pack_into(self.map, _CONSUMED_OFFSET, offset)
+
+    def recover(self):
+        """
+        Find the end of the valid records.
+
+        Returns:
+            False if the file is not a spool segment.
+        """
+        magic, layout, sequence, consumed = _SEGMENT_HEADER.unpack_from(self.map, 0)
+        if magic != _MAGIC or layout != _LAYOUT_VERSION or sequence != self.sequence:
+            return False
+        offset = _SEGMENT_HEADER.size
+        while offset + _RECORD_HEADER.size <= self.size:
+            length, crc, _ = _RECORD_HEADER.unpack_from(self.map, offset)
+            start = offset + _RECORD_HEADER.size
+            if not length or start + length > self.size or zlib.crc32(self.map[start:start + length]) != crc:
+                break
+            offset = start + length
+        self.end = offset
+        if not _SEGMENT_HEADER.size <= consumed <= offset:
+            self.consumed = _SEGMENT_HEADER.size
+        return True
+
+    def clear_tail(self):
+        """Zero everything after the last record, where a torn append may have left payload bytes."""
+        self.map[self.end:] = bytes(self.size - self.end)
+
+    def close(self):
+        self.map.flush()
+        self.map.close()
+
+
+class Spool:
+    """
+    Append-only, segment-based write-ahead log of line-protocol writes on local disk.
+
+    Records go into preallocated, memory-mapped segment files, so an append is a CRC
+    and a memory copy. The payload is copied before the record header, so a process
+    that dies mid-append leaves a zero length where the record would have started;
+    CRCs catch torn pages after a power loss. Mapped pages survive a process crash and
+    are written to disk by the kernel, or explicitly by ``sync``.
+
+    The reader's position is stored in the header of its segment. Fully replayed
+    segments are deleted. When the spool grows past ``max_bytes`` the oldest segment is
+    dropped even if it was not replayed, so a long outage costs the oldest data rather
+    than the disk.
+
+    A spool belongs to one process at a time; see ``claim_slot``.
+    """
+
+    def __init__(self, directory, segment_bytes=None, max_bytes=None):
+        self.directory = directory
+        self.segment_bytes = segment_bytes or Config.INFLUXDB_SPOOL_SEGMENT_BYTES
+        self.max_bytes = max_bytes or Config.INFLUXDB_SPOOL_MAX_BYTES
+        self.evicted_bytes = 0
+        self._segments = []
+        self._prefixes = {}
+        self._lock = threading.Lock()
+        self._readers = 0  # ``read`` calls using segments outside the lock
+        self._retired = []  # dropped segments whose mapping is closed once no reader uses it
+        os.makedirs(directory, exist_ok=True)
+        self._recover()
+
+    def append(self, bucket, org, lines):
+        """
+        Append one write (a list of line-protocol strings).
+
+        Returns:
+            Size of the stored record in bytes.
+        """
+        prefix = self._prefixes.get((bucket, org))
+        if prefix is None:
+            prefix = self._prefixes.setdefault((bucket, org), f"{bucket}\n{org}\n".encode())
+        payload = prefix + "\n".join(lines).encode()
+        header = _RECORD_HEADER.pack(len(payload), zlib.crc32(payload), len(lines))
+        size = len(header) + len(payload)
+
+        with self._lock:
+            segment = self._segments[-1]
+            # Keep room for the zero length that ends the segment
+            if segment.end + size + _RECORD_HEADER.size > segment.size:
+                segment = self._roll(size)
+            start = segment.end + len(header)
+            segment.map[start:start + len(payload)] = payload
+            segment.map[segment.end:start] = header
+            segment.end = start + len(payload)
+        return size
+
+    def read(self, max_lines):
+        """
+        Read records from the replay position on, up to about ``max_lines`` lines.
+        Reading does not advance the position; ``commit`` does.
+
+        Returns:
+            (records, position): records as (bucket, org, body, line count) with the
+            lines joined by newlines, and the position after the last one.
+        """
+        with self._lock:
+            segments = list(self._segments)
+            position = self._position
+            self._readers += 1
+        try:
+            return self._read(segments, position, max_lines)
+        finally:
+            with self._lock:
+                self._readers -= 1
+                if not self._readers:
+                    for segment in self._retired:
+                        segment.map.close()
+                    self._retired = []
+
+    def _read(self, segments, position, max_lines):
+        records = []
+        lines = 0
+        for segment in segments:
+            if segment.sequence < position[0]:
+                continue
+            offset = position[1] if segment.sequence == position[0] else _SEGMENT_HEADER.size
+            end = min(segment.end, segment.size)  # records below end are complete, even while appends go on
+            while offset < end and lines < max_lines:
+                length = 0
+                if offset + _RECORD_HEADER.size <= end:
+                    length, crc, count = _RECORD_HEADER.unpack_from(segment.map, offset)
+                start = offset + _RECORD_HEADER.size
+                if not length or start + length > end:
+                    # A length past the end can only come from a damaged segment: skip its rest
+                    log.error(f"❌ Spool record at offset {offset} of {segment.path} has an invalid length "
+                              f"({length}), skipping the rest of the segment")
+                    offset = end
+                    break
+                payload = segment.map[start:start + length]
+                offset = start + length
+                if zlib.crc32(payload) != crc:
+                    log.error(f"❌ Skipping corrupt spool record in {segment.path}")
+                    continue
+                bucket, org, body = payload.split(b"\n", 2)
+                records.append((bucket.decode(), org.decode(), body.decode(), count))
+                lines += count
+            position = (segment.sequence, offset)
+            if lines >= max_lines or not segment.sealed:
+                break
+        return records, position
+
+    def commit(self, position):
+        """Mark everything before ``position`` as replayed and delete finished segments."""
+        with self._lock:
+            if position <= self._position:
+                return
+            self._position = position
+            for segment in list(self._segments):
+                if segment.sequence > position[0] or segment is self._segments[-1]:
+                    if segment.sequence == position[0]:
+                        segment.consumed = position[1]
+                    break
+                if segment.sequence == position[0]:
+                    segment.consumed = position[1]
+                    if position[1] >= segment.end:
+                        self._drop(segment)
+                    break
+                self._drop(segment)
+
+    def sync(self):
+        """Flush the active segment to disk."""
+        with self._lock:
+            segment = self._segments[-1]
+        segment.map.flush()
+
+    def backlog(self):
+        """Bytes appended but not yet replayed."""
+        with self._lock:
+            total = 0
+            for segment in self._segments:
+                if segment.sequence > self._position[0]:
+                    total += segment.end - _SEGMENT_HEADER.size
+                elif segment.sequence == self._position[0]:
+                    total += segment.end - self._position[1]
+            return total
+
+    def close(self):
+        with self._lock:
+            for segment in self._segments:
+                segment.close()
+            self._segments = []
+            for segment in self._retired:
+                segment.map.close()
+            self._retired = []
+
+    def _recover(self):
+        sequences = sorted(int(name[:-len(_SUFFIX)]) for name in os.listdir(self.directory)
+                           if name.endswith(_SUFFIX) and name[:-len(_SUFFIX)].isdigit())
+        for sequence in sequences:
+            path = self._path(sequence)
+            segment = _Segment(path, sequence, self.segment_bytes, create=False)
+            if segment.size < _SEGMENT_HEADER.size or not segment.recover():
+                log.error(f"❌ Ignoring invalid spool segment {path}")
+                segment.map.close()
+                os.replace(path, path + ".invalid")
+                continue
+            if self._segments:
+                self._segments[-1].sealed = True
+            self._segments.append(segment)
+
+        if self._segments:
+            self._segments[-1].clear_tail()
+        else:
+            self._segments.append(_Segment(self._path(1), 1, self.segment_bytes, create=True))
+        first = self._segments[0]
+        self._position = (first.sequence, first.consumed)
+        # Drop sealed segments that were replayed entirely before the restart
+        while first.sealed and first.consumed >= first.end:
+            self._drop(first)
+            first = self._segments[0]
+            self._position = (first.sequence, first.consumed)
+
+        backlog = self.backlog()
+        if backlog:
+            log.info(f"🔄 Recovered {backlog} bytes of unreplayed writes from {self.directory}")
+
+    def _roll(self, record_size):
+        """Seal the active segment and start a new one. Caller holds the lock."""
+        active = self._segments[-1]
+        active.sealed = True
+        active.map.flush()
+        size = max(self.segment_bytes, _SEGMENT_HEADER.size + record_size + _RECORD_HEADER.size)
+        while self._segments and sum(s.size for s in self._segments) + size > self.max_bytes:
+            oldest = self._segments[0]
+            replayed = self._position[1] if oldest.sequence == self._position[0] else _SEGMENT_HEADER.size
+            lost = oldest.end - replayed if oldest.sequence >= self._position[0] else 0
+            if lost > 0:
+                self.evicted_bytes += lost
+                log.error(f"❌ Spool over {self.max_bytes} bytes, dropping {lost} bytes of unreplayed writes")
+            self._drop(oldest)
+            if not self._segments:
+                break
+        segment = _Segment(self._path(active.sequence + 1), active.sequence + 1, size, create=True)
+        self._segments.append(segment)
+        if self._position[0] < self._segments[0].sequence:
+            self._position = (self._segments[0].sequence, _SEGMENT_HEADER.size)
+        return segment
+
+    def _drop(self, segment):
+        """
+        Delete a segment and close its mapping. Caller holds the lock; while a ``read`` is
+        in progress the mapping is closed once the read is done.
+        """
+        self._segments.remove(segment)
+        os.remove(segment.path)
+        if self._readers:
+            self._retired.append(segment)
+        else:
+            segment.map.close()
+
+    def _path(self, sequence):
+        return os.path.join(self.directory, f"{sequence:016d}{_SUFFIX}")
+
+
+def claim_slot(directory):
+    """
+    Claim the first spool slot (``<directory>/<n>``) not locked by another process.
+
+    Every process writing to InfluxDB, such as each API worker, appends to a spool of
+    its own. The lock is held until the returned file is closed or the process exits.
+
+    Returns:
+        (slot directory, open lock file).
+    """
+    os.makedirs(directory, exist_ok=True)
+    index = 0
+    while True:
+        lock_file = _try_lock(os.path.join(directory, str(index)))
+        if lock_file is not None:
+            return os.path.join(directory, str(index)), lock_file
+        index += 1
+
+
+def claim_orphaned_slots(directory, own):
+    """
+    Lock slots left behind with data by processes that are gone (for example after
+    scaling down the number of workers), so their writes are replayed too.
+
+    Returns:
+        List of (slot directory, open lock file).
+    """
+    claimed = []
+    for name in sorted(os.listdir(directory)) if os.path.isdir(directory) else ():
+        path = os.path.join(directory, name)
+        if path == own or not name.isdigit():
+            continue
+        if not any(entry.endswith(_SUFFIX) for entry in os.listdir(path)):
+            continue
+        lock_file = _try_lock(path)
+        if lock_file is not None:
+            claimed.append((path, lock_file))
+    return claimed
+
+
+def _try_lock(path):
+    os.makedirs(path, exist_ok=True)
+    lock_file = open(os.path.join(path, _LOCK_NAME), "a")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        return None
+    return lock_file
+
+
+class SpoolWriter:
+    """
+    Write API that appends to a local Spool and replays it to InfluxDB in the background.
+
+    ``write`` returns as soon as the record is in the spool, so InfluxDB being slow or
+    down never reaches the request path. A replayer thread sends the spooled records
+    in requests of up to ``batch_size`` lines every ``flush_interval`` seconds (or as
+    soon as a full batch is waiting), retrying failed requests with exponential backoff
+    for as long as InfluxDB is unavailable. Requests InfluxDB rejects as invalid are
+    dropped. Spooled records survive restarts and are replayed once the writer starts
+    again.
+
+    ``write`` and ``close`` match BatchingWriter, so it can stand in for ``app.write_api``.
+    ``on_drop`` too: it gets the lines InfluxDB rejected, or None when the spool evicted
+    unreplayed data.
+    """
+
+    def __init__(self, write_api, directory=None, batch_size=None, flush_interval=None, sync_interval=None,
+                 retry_interval=None, max_retry_delay=None, jitter=None):
+        self.write_api = write_api
+        self.batch_size = batch_size or Config.INFLUXDB_BATCH_SIZE
+        self.flush_interval = flush_interval or Config.INFLUXDB_FLUSH_INTERVAL_MS / 1000.0
+        self.sync_interval = sync_interval or Config.INFLUXDB_SPOOL_SYNC_INTERVAL_MS / 1000.0
+        self.retry_interval = retry_interval or Config.INFLUXDB_RETRY_INTERVAL_MS / 1000.0
+        self.max_retry_delay = max_retry_delay or Config.INFLUXDB_MAX_RETRY_DELAY_MS / 1000.0
+        self.jitter = Config.INFLUXDB_RETRY_JITTER_MS / 1000.0 if jitter is None else jitter
+
+        directory = directory or Config.INFLUXDB_SPOOL_DIR
+        slot, self._lock_file = claim_slot(directory)
+        self.spool = Spool(slot)
+        self._orphans = [(Spool(path), lock_file) for path, lock_file in claim_orphaned_slots(directory, slot)]
+
+        self._stats_lock = threading.Lock()
+        self._stats = {"enqueued": 0, "written": 0, "failed": 0, "retries": 0, "requests": 0}
+        self._pending_lines = 0
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._closed = False
+        self.on_drop = None
+        _BACKLOG_BYTES.set_function(lambda: sum(spool.backlog() for spool, _ in [(self.spool, None)] + self._orphans))
+        self._thread = threading.Thread(target=self._run, name="influx-spool-replayer", daemon=True)
+        self._thread.start()
+
+    def write(self, bucket, org, record, durable=False):
+        """
+        Append a Point, a line-protocol string, or a list of those to the spool.
+
+        Args:
+            durable: If True, flush the spool to disk before returning.
+
+        Raises:
+            RuntimeError: If the writer is closed.
+        """
+        if self._closed:
+            raise RuntimeError("InfluxDB writer is closed")
+        records = record if isinstance(record, (list, tuple)) else [record]
+        lines = [r if isinstance(r, str) else r.to_line_protocol() for r in records]
+        evicted = self.spool.evicted_bytes
+        self.spool.append(bucket, org, lines)
+        if self.spool.evicted_bytes != evicted:
+            notify_drop(self.on_drop, None)
+        if durable:
+            self.spool.sync()
+        self._count("enqueued", len(lines))
+        # Only decides when to wake the replayer early, so racing increments are harmless
+        self._pending_lines += len(lines)
+        if self._pending_lines >= self.batch_size:
+            self._wakeup.set()
+
+    def close(self, timeout=10.0):
+        """
+        Stop the replayer after one last attempt to send the backlog. Whatever InfluxDB
+        did not take stays in the spool for the next start.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._stopping.set()
+        self._wakeup.set()
+        self._thread.join(timeout)
+        for spool, lock_file in [(self.spool, self._lock_file)] + self._orphans:
+            spool.close()
+            lock_file.close()
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["buffered"] = self.spool.backlog()
+        stats["evicted_bytes"] = self.spool.evicted_bytes
+        return stats
+
+    def _count(self, key, n=1):
+        with self._stats_lock:
+            self._stats[key] += n
+        if key in ("enqueued", "written", "failed"):
+            WRITE_POINTS.labels(key).inc(n)
+
+    def _run(self):
+        last_sync = time.monotonic()
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            stopping = self._stopping.is_set()
+            self._pending_lines = 0
+
+            for spool, _ in [(self.spool, None)] + self._orphans:
+                if not self._drain(spool, retry=not stopping):
+                    break
+            self._orphans = [(spool, lock_file) for spool, lock_file in self._orphans
+                             if spool.backlog() or self._release(spool, lock_file)]
+
+            if stopping:
+                self.spool.sync()
+                return
+            if time.monotonic() - last_sync >= self.sync_interval:
+                self.spool.sync()
+                last_sync = time.monotonic()
+
+    def _drain(self, spool, retry):
+        """
+        Replay a spool until it is empty.
+
+        Returns:
+            False if InfluxDB stayed unavailable (only possible when stopping).
+        """
+        while True:
+            records, position = spool.read(self.batch_size)
+            if not records:
+                return True
+            groups = {}
+            for bucket, org, body, count in records:
+                group = groups.setdefault((bucket, org), ([], [0]))
+                group[0].append(body)
+                group[1][0] += count
+            for (bucket, org), (bodies, count) in groups.items():
+                error = self._write_with_retry(bucket, org, "\n".join(bodies), retry)
+                if error is _UNAVAILABLE:
+                    return False
+                if error:
+                    log.error(f"❌ Dropping {count[0]} spooled points rejected by InfluxDB: {error}")
+                    self._count("failed", count[0])
+                    notify_drop(self.on_drop, "\n".join(bodies).split("\n"))
+                else:
+                    self._count("written", count[0])
+            spool.commit(position)
+
+    def _write_with_retry(self, bucket, org, body, retry):
+        attempt = 0
+        while True:
+            try:
+                self._count("requests")
+                with WRITE_SECONDS.time():
+                    self.write_api.write(bucket=bucket, org=org, record=body)
+                return None
+            except Exception as e:
+                status = getattr(e, "status", None)
+                if status is not None and status != 429 and status < 500:
+                    return f"Failed to write data: {str(e)}"
+                if not retry or self._stopping.is_set():
+                    return _UNAVAILABLE
+
+                delay = min(self.retry_interval * (2 ** attempt), self.max_retry_delay)
+                delay += random.uniform(0, self.jitter)
+                attempt += 1
+                self._count("retries")
+                WRITE_RETRIES.inc()
+                log.warning(f"❌ InfluxDB write failed ({e}), replaying spool again in {delay:.2f}s")
+                # Appends keep coming during an outage; keep them on disk
+                self.spool.sync()
+                # Wake up early on close, the spool keeps the data either way
+                self._stopping.wait(delay)
+
+    @staticmethod
+    def _release(spool, lock_file):
+        spool.close()
+        lock_file.close()
+        return False
+
+
+_UNAVAILABLE = object()